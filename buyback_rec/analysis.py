@@ -5,11 +5,14 @@ import pyarrow as pa
 import json
 from matplotlib import pyplot as plt
 from datetime import datetime, timedelta
+from pyarrow import compute as pc
 from pyarrow import dataset as ds
 from pyarrow import parquet as pq
 from pathlib import Path
 import warnings
 from dtypes import SCHEMA_BUYBACK, SCHEMA_OVERVIEW, SCHEMA_SETTINGS
+from candle_store import all_of
+from result_store import RESULT_DATASETS, STORED_SCHEMAS, fill_run_constants
 from uuid import uuid4
 
 
@@ -17,26 +20,296 @@ plt.style.use("dark_background")
 
 
 def load_datasets():
+    """Opens the settings, overviews and records datasets, written with either encoding (see `result_store.STORED_SCHEMAS`).
+    Identifiers and assets are read dictionary encoded, and the run constants missing from compact records are filled
+    by giving the settings to `query` and `final_records`.
+    """
     db_path = Path.cwd() / "buyback_rec/database"
-    id_path = db_path / "sim_ids"
-    overviews_path = db_path / "overviews"
-    records_path = db_path / "sim_records"
-
-    ids = ds.dataset(id_path, format="parquet")
-    overviews = ds.dataset(overviews_path, format="parquet")
-    records = ds.dataset(records_path, format="parquet")
+    ids, overviews, records = [
+        ds.dataset(
+            db_path / RESULT_DATASETS[name],
+            format="parquet",
+            schema=STORED_SCHEMAS[name],
+        )
+        for name in ["settings", "overviews", "results"]
+    ]
 
     return ids, overviews, records
 
 
+def matching_runs(
+    ids: ds.Dataset,
+    records: ds.Dataset | None = None,
+    asset1: str | None = None,
+    asset2: str | None = None,
+    discounts: list[float] | None = None,
+    ratios: list[float] | None = None,
+    redistribute_on_refresh: bool | None = None,
+    start_time: datetime | None = None,
+    end_time: datetime | None = None,
+) -> pa.Array:
+    """Gets the identifiers of the runs matching the given settings, and starting in [`start_time`, `end_time`). Only
+    the columns filtered on are read. The start of runs stored before the settings held it is read from the
+    `start_time` of `records`.
+
+    Returns:
+        pa.Array: identifiers of the matching runs
+    """
+    conditions = []
+    if asset1 is not None:
+        conditions.append(pc.field("asset1") == asset1)
+    if asset2 is not None:
+        conditions.append(pc.field("asset2") == asset2)
+    if redistribute_on_refresh is not None:
+        conditions.append(
+            pc.field("redistribute_on_refresh") == redistribute_on_refresh
+        )
+    ladder = {"discounts": discounts, "ratios": ratios}
+    ladder = {name: values for name, values in ladder.items() if values is not None}
+    dated = start_time is not None or end_time is not None
+    columns = ["identifier"] + list(ladder)
+    if dated:
+        columns.append("start_time")
+    settings = ids.to_table(columns=columns, filter=all_of(conditions))
+    matches = np.ones(len(settings), dtype=bool)
+    for name, values in ladder.items():
+        matches &= list_equals(settings[name], values)
+    settings = settings.filter(pa.array(matches))
+    identifiers = settings["identifier"].cast(pa.string())
+    if not dated:
+        return identifiers.combine_chunks()
+
+    in_range = []
+    if start_time is not None:
+        in_range.append(
+            pc.field("start_time") >= pa.scalar(start_time, pa.timestamp("s"))
+        )
+    if end_time is not None:
+        in_range.append(pc.field("start_time") < pa.scalar(end_time, pa.timestamp("s")))
+    in_range = all_of(in_range)
+    undated = identifiers.filter(pc.is_null(settings["start_time"]))
+    identifiers = settings.filter(in_range)["identifier"].cast(pa.string())
+    if not len(undated):
+        return identifiers.combine_chunks()
+    if records is None:
+        raise ValueError("The records are needed to filter older runs by date")
+    undated = records.to_table(
+        columns=["identifier"],
+        filter=pc.field("identifier").isin(undated.combine_chunks()) & in_range,
+    )["identifier"].cast(pa.string())
+    return pc.unique(pa.chunked_array(identifiers.chunks + undated.chunks, pa.string()))
+
+
+def list_equals(lists: pa.ChunkedArray, values: list[float]) -> np.ndarray:
+    """Compares each list of a list column with `values`, to the precision of the column's values."""
+    lists = lists.combine_chunks()
+    matches = pc.equal(pc.list_value_length(lists), len(values)).to_numpy(
+        zero_copy_only=False
+    )
+    if not matches.any():
+        return matches
+    same_length = lists.filter(pa.array(matches))
+    flat = same_length.flatten().to_numpy(zero_copy_only=False)
+    values = np.asarray(values, dtype=flat.dtype)
+    matches[matches] = (flat.reshape(-1, len(values)) == values).all(axis=1)
+    return matches
+
+
+def run_filter(
+    identifiers: pa.Array, condition: pc.Expression | None = None
+) -> pc.Expression:
+    """Builds the filter selecting the rows of the runs `identifiers` (see `matching_runs`) that match `condition`.
+    Results are written sorted by `identifier` (see `result_store.write_sorted`), so scans skip the row groups holding
+    none of them.
+    """
+    in_runs = pc.field("identifier").isin(identifiers)
+    return in_runs if condition is None else in_runs & condition
+
+
+def query(
+    dataset: ds.Dataset,
+    columns: list[str] | None = None,
+    filter: pc.Expression | None = None,
+    ids: ds.Dataset | None = None,
+) -> pa.Table:
+    """Reads the `columns` (all by default) of the rows of `dataset` matching `filter`, pushing both down to the scan.
+    Given the settings `ids`, the run constants of compact records are filled in (see `with_run_constants`).
+    """
+    return with_run_constants(dataset.to_table(columns=columns, filter=filter), ids)
+
+
+def with_run_constants(table: pa.Table, ids: ds.Dataset | None = None) -> pa.Table:
+    """Fills the run constants (`start_time` and `start_price`) of records stored compact (see
+    `result_store.compact_outputs`) from the settings `ids` of their runs, if `table` holds any of them.
+    """
+    constants = [
+        name for name in ["start_time", "start_price"] if name in table.column_names
+    ]
+    if ids is None or not constants or "identifier" not in table.column_names:
+        return table
+    run_ids = pc.unique(table["identifier"].cast(pa.string()))
+    settings = ids.to_table(
+        columns=["identifier", "start_time", "start_price"],
+        filter=pc.field("identifier").isin(run_ids),
+    )
+    filled = fill_run_constants(table, settings)
+    for name in constants:
+        table = table.set_column(table.schema.get_field_index(name), name, filled[name])
+    return table
+
+
+def plain_strings(table: pa.Table, names: list[str]) -> pa.Table:
+    """Decodes the dictionary encoded columns `names` of `table`, so that tables scanned from different files (each
+    with its own dictionaries) can be grouped together.
+    """
+    for name in names:
+        field = table.schema.field(name)
+        if pa.types.is_dictionary(field.type):
+            table = table.set_column(
+                table.schema.get_field_index(name),
+                name,
+                table[name].cast(field.type.value_type),
+            )
+    return table
+
+
+def last_rows(table: pa.Table, keys: list[str]) -> pa.Table:
+    """Keeps the last row of each group of `keys`, in the order of `table`."""
+    table = plain_strings(table, keys)
+    row_idxs = pa.array(np.arange(len(table)))
+    last_idxs = (
+        pa.table({"row": row_idxs, **{key: table[key] for key in keys}})
+        .group_by(keys, use_threads=False)
+        .aggregate([("row", "max")])["row_max"]
+    )
+    return table.take(last_idxs.take(pc.array_sort_indices(last_idxs)))
+
+
+def final_records(
+    records: ds.Dataset,
+    columns: list[str] | None = None,
+    filter: pc.Expression | None = None,
+    keys: list[str] | None = None,
+    ids: ds.Dataset | None = None,
+) -> pa.Table:
+    """Gets the last record of each (identifier, discount), i.e. the state of each discount at the end of its run. The
+    records are scanned batch by batch in the order they were written, each run's in time order, and only the last row
+    of each group seen so far is kept, so memory scales with the number of runs rather than of records. Given the
+    settings `ids`, the run constants of compact records are filled in (see `with_run_constants`).
+    """
+    if keys is None:
+        keys = ["identifier", "discount"]
+    if columns is not None:
+        columns = keys + [name for name in columns if name not in keys]
+    finals = None
+    for batch in records.to_batches(columns=columns, filter=filter):
+        if not batch.num_rows:
+            continue
+        batch_finals = last_rows(pa.Table.from_batches([batch]), keys=keys)
+        if finals is None:
+            finals = batch_finals
+            continue
+        finals = last_rows(pa.concat_tables([finals, batch_finals]), keys=keys)
+    if finals is None:
+        schema = (
+            records.schema
+            if columns is None
+            else pa.schema([records.schema.field(name) for name in columns])
+        )
+        return schema.empty_table()
+    return with_run_constants(finals, ids)
+
+
+def aggregate(
+    dataset: ds.Dataset,
+    by: list[str],
+    aggregations: list[tuple[str, str]],
+    filter: pc.Expression | None = None,
+) -> pa.Table:
+    """Groups the rows of `dataset` matching `filter` by the columns `by`, and aggregates them with `aggregations`, a
+    list of (column, function) with function any of "count", "sum", "min", "max" and "mean". Each batch is reduced as
+    it is scanned and the partial aggregates are then combined, so only the columns involved are read and memory
+    scales with the number of groups.
+
+    Returns:
+        pa.Table: the `by` columns and a "{column}_{function}" column for each aggregation
+    """
+    partial_functions = {
+        "count": [("count", "sum")],
+        "sum": [("sum", "sum")],
+        "min": [("min", "min")],
+        "max": [("max", "max")],
+        "mean": [("sum", "sum"), ("count", "sum")],
+    }
+    partial_aggregations = sorted(
+        {
+            (column, partial)
+            for column, function in aggregations
+            for partial, _ in partial_functions[function]
+        }
+    )
+    columns = by + sorted({column for column, _ in aggregations} - set(by))
+    partials = []
+    for batch in dataset.to_batches(columns=columns, filter=filter):
+        if batch.num_rows:
+            partials.append(
+                plain_strings(pa.Table.from_batches([batch]), by)
+                .group_by(by)
+                .aggregate(partial_aggregations)
+            )
+    combined_aggregations = sorted(
+        {
+            (f"{column}_{partial}", combine)
+            for column, function in aggregations
+            for partial, combine in partial_functions[function]
+        }
+    )
+    if partials:
+        combined = (
+            pa.concat_tables(partials).group_by(by).aggregate(combined_aggregations)
+        )
+    else:
+        combined = pa.table(
+            {
+                **{name: pa.array([], dataset.schema.field(name).type) for name in by},
+                **{
+                    f"{name}_{combine}": pa.array([], pa.float64())
+                    for name, combine in combined_aggregations
+                },
+            }
+        )
+
+    aggregated = {name: combined[name] for name in by}
+    for column, function in aggregations:
+        if function == "mean":
+            aggregated[f"{column}_mean"] = pc.divide(
+                pc.cast(combined[f"{column}_sum_sum"], pa.float64()),
+                combined[f"{column}_count_sum"],
+            )
+        else:
+            partial, combine = partial_functions[function][0]
+            aggregated[f"{column}_{function}"] = combined[
+                f"{column}_{partial}_{combine}"
+            ]
+    return pa.table(aggregated)
+
+
 if __name__ == "__main__":
     ids, overviews, records = load_datasets()
-    ov_df = overviews.to_table().to_pandas()
-    r_df = records.to_table().to_pandas()
+    runs = matching_runs(ids=ids, discounts=[0, 23.6, 38.2, 61.8])
 
-    ends = r_df.sort_values(
-        by=["identifier", "running_allocated"], ascending=[False, False]
-    ).drop_duplicates(subset=["identifier", "discount"])
+    ends = final_records(
+        records=records,
+        columns=[
+            "ratio",
+            "running_allocated",
+            "running_purchased",
+            "remaining_amount",
+            "running_return",
+        ],
+        filter=run_filter(runs),
+        ids=ids,
+    ).to_pandas()
     print(
         ends[
             [
@@ -48,6 +321,17 @@ if __name__ == "__main__":
             ]
         ]
     )
+    print(
+        aggregate(
+            dataset=overviews,
+            by=["discount"],
+            aggregations=[
+                ("end_discount_running_return", "mean"),
+                ("identifier", "count"),
+            ],
+            filter=run_filter(runs),
+        ).to_pandas()
+    )
 
     ends.plot(x="remaining_amount", y="running_return", kind="scatter")
     plt.show()
@@ -0,0 +1,333 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pyarrow import parquet as pq
+import argparse
+import contextlib
+import json
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections.abc import Callable
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from dtypes import SCHEMA_CANDLE
+from candle_store import DAILY, write_candles
+from buyback_sim import (
+    PRICE_STATISTICS,
+    Buyback,
+    buyback_overview,
+    get_breakpoints,
+    get_price_statistics,
+    simple_buyback_sim,
+)
+
+HOURLY = 3600
+MINUTE = 60
+
+BENCHMARK_LADDER = dict(
+    ratios=[0.4, 0.3, 0.2, 0.1],
+    discounts=[0, 23.6, 38.2, 61.8],
+    initial_allocation=100_000,
+    refresh_amount=10_000,
+    redistribute_on_refresh=True,
+)  # ladder simulated by every benchmark, the one of `buyback_sim`'s example run
+
+
+@dataclass
+class BenchmarkCase:
+    """Synthetic candle history of a benchmark and the windows simulated over it."""
+
+    name: str
+    granularity: int  # candle duration in seconds
+    history_days: int  # length of the synthetic history
+    sim_len_days: int
+    step_days: float
+    refresh_interval_days: int
+    seed: int = 0
+
+    @property
+    def n_candles(self) -> int:
+        return self.history_days * DAILY // self.granularity
+
+
+BENCHMARK_CASES = [
+    BenchmarkCase("daily_1y", DAILY, 365, 120, 24, 5),
+    BenchmarkCase("daily_8y", DAILY, 8 * 365, 120, 24, 5),
+    BenchmarkCase("hourly_120d", HOURLY, 120, 30, 1.25, 1),
+    BenchmarkCase("hourly_3y", HOURLY, 3 * 365, 120, 5, 5),
+    BenchmarkCase("minute_7d", MINUTE, 7, 2, 0.5, 1),
+    BenchmarkCase("minute_1y", MINUTE, 365, 30, 7, 5),
+]
+
+
+def synthetic_candles(
+    granularity: int,
+    n_candles: int,
+    asset1: str = "SYN",
+    asset2: str = "USD",
+    start_time: datetime = datetime(2021, 1, 1),
+    start_price: float = 1.0,
+    daily_volatility: float = 0.05,
+    seed: int = 0,
+) -> pa.Table:
+    """Generates `n_candles` candles (following SCHEMA_CANDLE) of a geometric Brownian motion with `daily_volatility`,
+    the same for a given `seed`. Each candle is built from a few steps of the path, so that its high and low bracket
+    its open and close, and opens at the previous close.
+    """
+    rng = np.random.default_rng(seed)
+    n_steps = 4  # steps of the path within each candle
+    step_volatility = daily_volatility * np.sqrt(granularity / DAILY / n_steps)
+    log_prices = np.log(start_price) + np.cumsum(
+        rng.normal(-0.5 * step_volatility**2, step_volatility, n_candles * n_steps)
+    ).reshape(n_candles, n_steps)
+    closes = np.exp(log_prices[:, -1])
+    opens = np.concatenate([[start_price], closes[:-1]])
+    highs = np.maximum(np.exp(log_prices.max(axis=1)), opens)
+    lows = np.minimum(np.exp(log_prices.min(axis=1)), opens)
+    start_times = np.datetime64(start_time, "s") + np.arange(
+        n_candles
+    ) * np.timedelta64(granularity, "s")
+    return pa.table(
+        {
+            "asset1": pa.repeat(pa.scalar(asset1), n_candles),
+            "asset2": pa.repeat(pa.scalar(asset2), n_candles),
+            "start_time": start_times,
+            "low": lows,
+            "high": highs,
+            "open": opens,
+            "close": closes,
+            "volume": rng.lognormal(10, 1, n_candles),
+        }
+    ).cast(SCHEMA_CANDLE)
+
+
+def benchmark_stages(
+    case: BenchmarkCase, candles: pa.Table, db_root: Path
+) -> dict[str, Callable[[], dict[str, pa.Table]]]:
+    """Builds the stages timed for `case`, each returning its outputs as named tables. The full `simple_buyback_sim`
+    path loads the candles from the store under `db_root`, the other stages run on them in memory.
+    """
+    asset_pair = candles.to_pandas()
+    run_window = timedelta(days=case.sim_len_days)
+    step_size = timedelta(days=case.step_days)
+    refresh_interval = timedelta(days=case.refresh_interval_days)
+
+    def simulate() -> pa.Table:
+        buyback = Buyback(
+            identifier="benchmark",
+            ratios=BENCHMARK_LADDER["ratios"],
+            discounts=BENCHMARK_LADDER["discounts"],
+            amount_allocated=BENCHMARK_LADDER["initial_allocation"],
+        )
+        return buyback.simulate_buybacks(
+            asset_pair,
+            refresh_amounts=BENCHMARK_LADDER["refresh_amount"],
+            refresh_intervals=refresh_interval,
+            redistribute_on_refresh=BENCHMARK_LADDER["redistribute_on_refresh"],
+        )
+
+    history = simulate()
+
+    def breakpoints() -> dict[str, pa.Table]:
+        break_indicies = get_breakpoints(
+            timestamps=asset_pair.start_time,
+            window_time=run_window,
+            step_time=step_size,
+        )
+        starts, stops = np.array(break_indicies, dtype=np.int64).reshape(-1, 2).T
+        return {"breakpoints": pa.table({"start": starts, "stop": stops})}
+
+    def price_statistics() -> dict[str, pa.Table]:
+        statistics = get_price_statistics(asset_pair)
+        return {
+            "statistics": pa.table(
+                {name: [value] for name, value in zip(PRICE_STATISTICS, statistics)}
+            )
+        }
+
+    def full_simulation(batched: bool) -> dict[str, pa.Table]:
+        with contextlib.chdir(db_root):
+            results, settings, overviews = simple_buyback_sim(
+                refresh_interval_days=case.refresh_interval_days,
+                sim_len_days=case.sim_len_days,
+                step_days=case.step_days,
+                sim_start_price=1,
+                batched=batched,
+                pairs=[(candles["asset1"][0].as_py(), candles["asset2"][0].as_py())],
+                granularity=case.granularity,
+                reuse_results=False,
+                **BENCHMARK_LADDER,
+            )
+        return {"results": results, "settings": settings, "overviews": overviews}
+
+    return {
+        "get_breakpoints": breakpoints,
+        "simulate_buybacks": lambda: {"history": simulate()},
+        "buyback_overview": lambda: {
+            "overview": pa.Table.from_batches(
+                [buyback_overview(result=history, data=asset_pair)]
+            )
+        },
+        "get_price_statistics": price_statistics,
+        "simple_buyback_sim": lambda: full_simulation(batched=False),
+        "simple_buyback_sim_batched": lambda: full_simulation(batched=True),
+    }
+
+
+def time_stage(
+    stage: Callable[[], dict[str, pa.Table]], repeat: int = 3
+) -> tuple[dict[str, pa.Table], float, int]:
+    """Runs `stage` once to warm up (imports and caches), `repeat` times for its best time, then once more with
+    `tracemalloc` for its peak memory, which covers the Python and NumPy allocations but not Arrow's memory pool.
+
+    Returns:
+        tuple[dict[str, pa.Table], float, int]: outputs of the stage, best time in seconds and peak memory in bytes
+    """
+    outputs = stage()
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        stage()
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        stage()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return outputs, min(seconds), peak_bytes
+
+
+def tables_match(expected: pa.Table, actual: pa.Table, rtol: float = 1e-5) -> bool:
+    """Compares two tables column by column, floating point columns to a relative tolerance of `rtol`. `expected` is
+    cast to the types of `actual` first, as Parquet files store second timestamps in milliseconds.
+    """
+    if expected.column_names != actual.column_names or len(expected) != len(actual):
+        return False
+    expected = expected.cast(actual.schema)
+    for name in expected.column_names:
+        expected_values = expected[name].to_pandas()
+        actual_values = actual[name].to_pandas()
+        if pd.api.types.is_float_dtype(expected_values):
+            if not np.allclose(
+                expected_values, actual_values, rtol=rtol, atol=1e-6, equal_nan=True
+            ):
+                return False
+        elif not expected_values.equals(actual_values):
+            return False
+    return True
+
+
+def run_benchmarks(
+    cases: list[BenchmarkCase] | None = None,
+    baseline_path: Path | None = None,
+    repeat: int = 3,
+    save_baseline: bool = False,
+    rtol: float = 1e-5,
+    max_slowdown: float = 1.5,
+    min_slowdown_seconds: float = 0.01,
+) -> pd.DataFrame:
+    """Times every stage of the simulation pipeline (see `benchmark_stages`) on the synthetic candles of each of
+    `cases` (all of `BENCHMARK_CASES` by default) and compares them to the baseline stored under `baseline_path`, one
+    directory per case holding the outputs of each stage and their timings. A stage regressed if its outputs differ
+    from the baseline's (see `tables_match`), or if it ran more than `max_slowdown` times and `min_slowdown_seconds`
+    slower than it. With `save_baseline` the baseline is replaced by this run instead.
+
+    Returns:
+        pd.DataFrame: one row per case and stage with its timing, peak memory and comparison to the baseline
+    """
+    if cases is None:
+        cases = BENCHMARK_CASES
+    if baseline_path is None:
+        baseline_path = Path.cwd() / "buyback_rec/database/benchmarks"
+
+    report = []
+    for case in cases:
+        candles = synthetic_candles(
+            granularity=case.granularity, n_candles=case.n_candles, seed=case.seed
+        )
+        case_path = Path(baseline_path) / case.name
+        timings_path = case_path / "timings.json"
+        baseline_timings = (
+            json.loads(timings_path.read_text()) if timings_path.exists() else {}
+        )
+        timings = {}
+        with tempfile.TemporaryDirectory() as db_root:
+            write_candles(
+                candles,
+                candles_path=Path(db_root) / "buyback_rec/database/candlestick_data",
+                granularity=case.granularity,
+            )
+            for stage_name, stage in benchmark_stages(
+                case=case, candles=candles, db_root=Path(db_root)
+            ).items():
+                outputs, seconds, peak_bytes = time_stage(stage, repeat=repeat)
+                timings[stage_name] = {"seconds": seconds, "peak_bytes": peak_bytes}
+                row = dict(
+                    case=case.name,
+                    stage=stage_name,
+                    n_candles=case.n_candles,
+                    seconds=seconds,
+                    peak_mib=peak_bytes / 2**20,
+                    baseline_seconds=np.nan,
+                    slowdown=np.nan,
+                    matches_baseline=None,
+                    regressed=False,
+                )
+                if save_baseline:
+                    case_path.mkdir(parents=True, exist_ok=True)
+                    for output_name, table in outputs.items():
+                        pq.write_table(
+                            table.replace_schema_metadata(None),
+                            case_path / f"{stage_name}-{output_name}.parquet",
+                        )
+                elif stage_name in baseline_timings:
+                    row["baseline_seconds"] = baseline_timings[stage_name]["seconds"]
+                    row["slowdown"] = seconds / row["baseline_seconds"]
+                    row["matches_baseline"] = all(
+                        tables_match(
+                            pq.read_table(
+                                case_path / f"{stage_name}-{output_name}.parquet"
+                            ),
+                            table.replace_schema_metadata(None),
+                            rtol=rtol,
+                        )
+                        for output_name, table in outputs.items()
+                    )
+                    row["regressed"] = (
+                        not row["matches_baseline"]
+                        or row["slowdown"] > max_slowdown
+                        and seconds - row["baseline_seconds"] > min_slowdown_seconds
+                    )
+                report.append(row)
+        if save_baseline:
+            timings_path.write_text(json.dumps(timings, indent=2))
+    return pd.DataFrame(report)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the buyback simulation pipeline on synthetic candles."
+    )
+    parser.add_argument(
+        "cases",
+        nargs="*",
+        help=f"cases to run, all by default: {', '.join(case.name for case in BENCHMARK_CASES)}",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--save", action="store_true", help="store this run as the baseline"
+    )
+    args = parser.parse_args()
+
+    cases = [
+        case for case in BENCHMARK_CASES if case.name in args.cases or not args.cases
+    ]
+    report = run_benchmarks(cases=cases, repeat=args.repeat, save_baseline=args.save)
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(report)
+    if report["regressed"].any():
+        sys.exit(1)
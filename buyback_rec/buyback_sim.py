@@ -10,7 +10,23 @@ from pyarrow import parquet as pq
 from pathlib import Path
 import warnings
 from dtypes import SCHEMA_BUYBACK, SCHEMA_OVERVIEW, SCHEMA_SETTINGS
-from uuid import uuid4
+from candle_store import DAILY, candle_pairs, load_candles, open_candles, time_filter
+from derived_candles import derived_candles, stored_granularities
+from result_store import (
+    FLUSH_WINDOWS,
+    BackgroundWriter,
+    ResultWriter,
+    load_runs,
+    save_results,
+    sort_runs,
+    stored_identifiers,
+)
+from instrumentation import Instrumentation, count, stage
+from uuid import UUID, uuid4, uuid5
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from collections.abc import Callable, Iterator
 import scipy
 
 plt.style.use("dark_background")
@@ -27,6 +43,86 @@ class NpEncoder(json.JSONEncoder):
         return super(NpEncoder, self).default(obj)
 
 
+class HistoryBuffer:
+    """Growable typed column buffers holding the rows of a table following `schema` (e.g. SCHEMA_BUYBACK). Rows are
+    written straight into preallocated NumPy arrays whose capacity doubles when full, and the Arrow table is built
+    once by `to_table`, without copying the numeric columns. String columns are stored as codes into a list of
+    their distinct values.
+    """
+
+    def __init__(self, schema: pa.Schema, capacity: int = 64):
+        self.schema = schema
+        self.n_rows = 0
+        self._columns = {}
+        self._categories = {}
+        for field in schema:
+            if pa.types.is_string(field.type):
+                dtype = np.int32
+                self._categories[field.name] = {}
+            elif pa.types.is_timestamp(field.type):
+                dtype = np.dtype(f"datetime64[{field.type.unit}]")
+            else:
+                dtype = field.type.to_pandas_dtype()
+            self._columns[field.name] = np.empty(capacity, dtype=dtype)
+
+    def __len__(self) -> int:
+        return self.n_rows
+
+    def _reserve(self, n_rows: int) -> None:
+        capacity = len(next(iter(self._columns.values())))
+        if n_rows <= capacity:
+            return
+        while capacity < n_rows:
+            capacity *= 2
+        for name, values in self._columns.items():
+            grown = np.empty(capacity, dtype=values.dtype)
+            grown[: self.n_rows] = values[: self.n_rows]
+            self._columns[name] = grown
+
+    def append(self, **columns) -> None:
+        """Appends rows given as one value or array of values per column, single values are repeated for every row."""
+        n_new = max(np.size(value) for value in columns.values())
+        self._reserve(self.n_rows + n_new)
+        rows = slice(self.n_rows, self.n_rows + n_new)
+        for name, value in columns.items():
+            if name in self._categories:
+                categories = self._categories[name]
+                value = [
+                    categories.setdefault(str(item), len(categories))
+                    for item in np.atleast_1d(value)
+                ]
+            self._columns[name][rows] = value
+        self.n_rows += n_new
+
+    def rows(self, start: int = 0) -> list[dict]:
+        """Gets the rows appended from row `start` on, as dicts of column values."""
+        columns = {}
+        for name, values in self._columns.items():
+            values = values[start : self.n_rows].tolist()
+            if name in self._categories:
+                categories = list(self._categories[name])
+                values = [categories[code] for code in values]
+            columns[name] = values
+        return [dict(zip(columns, row)) for row in zip(*columns.values())]
+
+    def to_table(self, schema: pa.Schema | None = None) -> pa.Table:
+        """Builds the Arrow table of all appended rows, `schema` may add metadata to the buffer's schema."""
+        schema = self.schema if schema is None else schema
+        arrays = []
+        for field in schema:
+            values = self._columns[field.name][: self.n_rows]
+            if field.name in self._categories:
+                dictionary = pa.array(list(self._categories[field.name]), pa.string())
+                arrays.append(
+                    pa.DictionaryArray.from_arrays(
+                        values, dictionary
+                    ).dictionary_decode()
+                )
+            else:
+                arrays.append(pa.array(values, type=field.type))
+        return pa.Table.from_arrays(arrays, schema=schema)
+
+
 @dataclass
 class Buyback:
     identifier: str
@@ -34,6 +130,8 @@ class Buyback:
     discounts: np.ndarray
     ref_price: float = None
     amount_allocated: float = None
+    # counts the candles simulated, refreshes and fills of `simulate_buybacks`
+    instrumentation: Instrumentation | None = None
 
     def __post_init__(self):
         self.ratios = np.array(self.ratios)
@@ -54,7 +152,7 @@ class Buyback:
         self.n_discount_buybacks = np.zeros((len(self.discounts),))
         self.n_buybacks = 0
         self._schema = SCHEMA_BUYBACK
-        self.history = []
+        self.history = HistoryBuffer(SCHEMA_BUYBACK)
         if (self.discounts > 100).any():
             raise ValueError("Items in `discounts` cannot be greater than 100%")
 
@@ -91,9 +189,10 @@ class Buyback:
         run_start_time: np.timedelta64 | None = None,
         run_start_price: float | None = None,
         append_history: bool = True,
-    ) -> pa.RecordBatch:
+    ) -> bool:
         """Checks if the amount allocated within `account_index` should be used for buybacks within the
-        period provided by `data` (which is expected to only contain data within the latest refresh)
+        period provided by `data` (which is expected to only contain data within the latest refresh). Returns True if
+        a buyback was made, which is recorded in `history` if `append_history` is set.
         """
         if run_start_time is None:
             run_start_time = data.iloc[0]["start_time"]
@@ -112,138 +211,640 @@ class Buyback:
             self.amounts[account_index] = 0
             self.amount_spent = self.amount_spent + spent
             self.amount_purchased = self.amount_purchased + purchased
-            record_dict = {
-                "identifier": [str(self.identifier)],
-                "start_time": [run_start_time],
-                "last_reset_time": [data.iloc[0]["start_time"]],
-                "trigger_time": [price_hit.iloc[0]["start_time"]],
-                "amount": [spent],
-                "price": [buyback_price],
-                "purchased": [purchased],
-                "ref_price": [self.ref_price],
-                "ratio": [ratio],
-                "discount": [discount],
-                "start_price": [run_start_price],
-                "running_allocated": [self.amount_allocated],
-                "running_spent": [self.amount_spent],
-                "running_purchased": [self.amount_purchased],
-                "running_return": [
-                    self.amount_purchased * buyback_price / self.amount_spent
-                ],
-                "remaining_amount": [self.open_amount],
-                "num_discount_buybacks": [self.n_discount_buybacks[account_index]],
-                "num_discount_refresh": [self.n_discount_refresh[account_index]],
-                "num_buybacks": [self.n_buybacks],
-                "num_refresh": [self.n_refresh],
-            }
-            record = pa.record_batch(record_dict, SCHEMA_BUYBACK)
             if append_history:
-                self.history.append(record)
-        else:
-            record = None
+                self.history.append(
+                    identifier=str(self.identifier),
+                    start_time=run_start_time,
+                    last_reset_time=data.iloc[0]["start_time"],
+                    trigger_time=price_hit.iloc[0]["start_time"],
+                    amount=spent,
+                    price=buyback_price,
+                    purchased=purchased,
+                    ref_price=self.ref_price,
+                    ratio=ratio,
+                    discount=discount,
+                    start_price=run_start_price,
+                    running_allocated=self.amount_allocated,
+                    running_spent=self.amount_spent,
+                    running_purchased=self.amount_purchased,
+                    running_return=self.amount_purchased
+                    * buyback_price
+                    / self.amount_spent,
+                    remaining_amount=self.open_amount,
+                    num_discount_buybacks=self.n_discount_buybacks[account_index],
+                    num_discount_refresh=self.n_discount_refresh[account_index],
+                    num_buybacks=self.n_buybacks,
+                    num_refresh=self.n_refresh,
+                )
+            return True
+
+        return False
+
+    def check_do_buybacks(
+        self,
+        lows: np.ndarray,
+        start_times: np.ndarray,
+        run_start_time: np.datetime64 | None = None,
+        run_start_price: float | None = None,
+        append_history: bool = True,
+        scale_factor: float | None = None,
+    ) -> int:
+        """Vectorized equivalent of calling `check_do_buyback` for every account index in order. The first candle
+        trading below each discount's limit price is resolved in a single pass over the running minimum of `lows`,
+        which are expected to only contain data within the latest refresh, rescaled by `scale_factor` if given.
+        Returns the number of buybacks made.
+        """
+        buyback_prices = self.ref_price * (100 - self.discounts) / 100
+        hit_idxs = first_touch_indicies(lows, buyback_prices, scale_factor)
+        trigger_times = np.full(len(hit_idxs), np.datetime64("NaT"), start_times.dtype)
+        hit = hit_idxs < len(lows)
+        trigger_times[hit] = start_times[hit_idxs[hit]]
+        return self.fill_orders(
+            trigger_times=trigger_times,
+            last_reset_time=start_times[0],
+            run_start_time=run_start_time,
+            run_start_price=run_start_price,
+            append_history=append_history,
+        )
+
+    def fill_orders(
+        self,
+        trigger_times: np.ndarray,
+        last_reset_time: np.datetime64,
+        run_start_time: np.datetime64 | None = None,
+        run_start_price: float | None = None,
+        append_history: bool = True,
+    ) -> int:
+        """Fills the pending order of every account whose limit price was traded through since the last refresh, given
+        the first time each was touched in `trigger_times` (NaT if it wasn't). Returns the number of buybacks made.
+        """
+        if run_start_time is None:
+            run_start_time = last_reset_time
+        buyback_prices = self.ref_price * (100 - self.discounts) / 100
+        filled = np.flatnonzero((self.amounts > 0) & ~np.isnat(trigger_times))
+        if not len(filled):
+            return 0
 
-        return record
+        n_filled = len(filled)
+        prices = buyback_prices[filled]
+        spent = self.amounts[filled]
+        purchased = spent / prices
+        # running totals are accumulated in account order, identical to the sequential `check_do_buyback` calls
+        running_spent = np.cumsum(np.concatenate([[self.amount_spent], spent]))[1:]
+        running_purchased = np.cumsum(
+            np.concatenate([[self.amount_purchased], purchased])
+        )[1:]
+        fill_order = np.full(len(self.amounts), n_filled)
+        fill_order[filled] = np.arange(n_filled)
+        cleared = fill_order[np.newaxis, :] <= np.arange(n_filled)[:, np.newaxis]
+        remaining = np.where(cleared, 0, self.amounts[np.newaxis, :]).sum(axis=1)
+
+        self.n_discount_buybacks[filled] += 1
+        self.amounts[filled] = 0
+        self.amount_spent = running_spent[-1]
+        self.amount_purchased = running_purchased[-1]
+        if append_history:
+            self.history.append(
+                identifier=str(self.identifier),
+                start_time=run_start_time,
+                last_reset_time=last_reset_time,
+                trigger_time=trigger_times[filled],
+                amount=spent,
+                price=prices,
+                purchased=purchased,
+                ref_price=self.ref_price,
+                ratio=self.ratios[filled],
+                discount=self.discounts[filled],
+                start_price=run_start_price,
+                running_allocated=self.amount_allocated,
+                running_spent=running_spent,
+                running_purchased=running_purchased,
+                running_return=running_purchased * prices / running_spent,
+                remaining_amount=remaining,
+                num_discount_buybacks=self.n_discount_buybacks[filled],
+                num_discount_refresh=self.n_discount_refresh[filled],
+                num_buybacks=self.n_buybacks + np.arange(1, n_filled + 1),
+                num_refresh=self.n_refresh,
+            )
+        self.n_buybacks += n_filled
+        return n_filled
 
     def simulate_buybacks(
         self,
-        price_data: pd.DataFrame | pa.Table,
+        price_data: pd.DataFrame | pa.Table | pa.RecordBatch | dict[str, np.ndarray],
         refresh_amounts: float | np.ndarray = None,
         refresh_intervals: timedelta | np.ndarray = None,
         redistribute_on_refresh: bool = False,
+        scale_factor: float | None = None,
     ) -> pa.Table:
         """Method to run a simulation of the buyback structure using the input price candlestick `price_data`. Optionally, additional allocations for buybacks may be added at points during the simulation as specified by the `refresh_amounts` and `refresh_intervals` arrays. If a single value is passed for these arguments it is assumed that the amount specified is repeated every refresh interval until the end date of the simulation. Additionally, a flag can enable the pending limit orders to be withdrawn and resubmitted/redistributed along with the refresh amount if `redistribute_on_refresh` is set to True.
 
         Args:
-            data (pd.DataFrame | pa.Table): Price data used for the buyback simulation. Requires columns `start_time`, `open`, and `low`.
+            data (pd.DataFrame | pa.Table | pa.RecordBatch | dict[str, np.ndarray]): Price data used for the buyback simulation. Requires columns `start_time`, `open`, and `low`, which are read as NumPy arrays without building a DataFrame (see `candle_arrays`).
             refresh_amounts (float | np.ndarray, optional): Amount of assets used to add to the buyback pool. If a single value, it is assumed that this amount is allocated for each refresh interval. If `None`, the allocation is set to 0 for each refresh interval. Defaults to None.
             refresh_intervals (timedelta | np.ndarray, optional): Duration from the last allocation refreshment that the next allocation refresh will occur. If a single timedelta, the refresh interval is assumed to be repeated. If `None` allocations are not refreshed at any point and the refresh interval is set to the entire interval spanned by the `data`. Defaults to None.
             redistribute_on_refresh (bool, optional): Flag, if set to True will gather all amounts in pending orders and redistribute according to the `ratios` each refresh interval. Defaults to False
+            scale_factor (float, optional): Factor the prices of `price_data` are simulated rescaled by, applied to the reference prices and the running minimum of the lows as they are used rather than to a copy of the candles. Defaults to None.
 
         Returns:
             pa.Table: Table containing the history of buybacks transacted
         """
-        if isinstance(price_data, pa.Table):
-            price_data = price_data.to_pandas()
-        first_timestamp = price_data.iloc[0]["start_time"]
-        full_duration = price_data.iloc[-1]["start_time"] - first_timestamp
-
-        if refresh_intervals is None:
-            refresh_intervals = np.array([full_duration])
-        elif not isinstance(refresh_intervals, np.ndarray):
-            # if it's a single value explicitly create each refresh time
-            refresh_intervals = np.arange(
-                refresh_intervals, full_duration + refresh_intervals, refresh_intervals
+        n_buybacks = self.n_buybacks
+        candles = candle_arrays(price_data, columns=["start_time", "open", "low"])
+        start_times = candles["start_time"]
+        opens = candles["open"]
+        lows = candles["low"]
+        run_start_price = opens[0]
+        if scale_factor is not None:
+            run_start_price = run_start_price * scale_factor
+        refresh_amounts, refresh_intervals, start_idxs, refresh_idxs = (
+            get_refresh_schedule(
+                start_times=start_times,
+                refresh_amounts=refresh_amounts,
+                refresh_intervals=refresh_intervals,
             )
-
-        # NOTE: it would be quicker to just require a consistent time delta and use some integer multiple (index) for the refresh interval.
-        refresh_timestamps = first_timestamp + refresh_intervals
-        refresh_idxs = np.array(
-            [
-                np.argmin(abs(price_data.loc[:, "start_time"] - refresh))
-                for refresh in refresh_timestamps
-            ]
         )
-        start_idxs = np.roll(refresh_idxs, shift=1)
-        start_idxs[0] = 0
-
-        if refresh_amounts is None:
-            refresh_amounts = np.zeros(refresh_intervals.shape)
-        elif not isinstance(refresh_amounts, np.ndarray):
-            # if it's a single value explicitly create each new allocation
-            refresh_amounts = np.ones(refresh_intervals.shape) * refresh_amounts
-
-        # TODO: there is potentially a case here where there is some time less than the refresh interval that isn't accounted for
-        for start_idx, refresh_idx, refresh_amount in list(
-            zip(start_idxs, refresh_idxs, refresh_amounts)
-        ):
-            run_start_time = price_data.iloc[0]["start_time"]
-            run_start_price = price_data.iloc[0]["open"]
-            self.ref_price = price_data.loc[start_idx, "open"]
-            refresh_view = price_data.loc[start_idx:refresh_idx, :]
-            for account_index in range(len(self.ratios)):
-                self.check_do_buyback(
-                    account_index=account_index,
-                    data=refresh_view,
-                    run_start_time=run_start_time,
-                    run_start_price=run_start_price,
-                )
+
+        for p_idx, (start_idx, refresh_idx) in enumerate(zip(start_idxs, refresh_idxs)):
+            self.ref_price = opens[start_idx]
+            if scale_factor is not None:
+                self.ref_price = self.ref_price * scale_factor
+            self.check_do_buybacks(
+                lows=lows[start_idx : refresh_idx + 1],
+                start_times=start_times[start_idx : refresh_idx + 1],
+                run_start_time=start_times[0],
+                run_start_price=run_start_price,
+                scale_factor=scale_factor,
+            )
+            if p_idx == len(refresh_amounts):
+                break  # the final period ends with the data rather than a refresh
 
             # Refresh allocations for next buyback
             if redistribute_on_refresh:
                 self.redistribute_amount()
-            self.add_amount_proportionally(refresh_amount)
+            self.add_amount_proportionally(refresh_amounts[p_idx])
+
+        if self.instrumentation is not None:
+            self.instrumentation.count("candles_simulated", len(start_times))
+            self.instrumentation.count("refreshes", len(refresh_amounts))
+            self.instrumentation.count("fills", self.n_buybacks - n_buybacks)
+        self._schema = self._schema.with_metadata(
+            encode_metadata(
+                ratios=self.ratios,
+                discounts=self.discounts,
+                refresh_amounts=refresh_amounts,
+                refresh_intervals=refresh_intervals,
+            )
+        )
+        return self.history.to_table(schema=self._schema)
+
+
+def candle_arrays(
+    price_data: pd.DataFrame | pa.Table | pa.RecordBatch | dict[str, np.ndarray],
+    columns: list[str],
+) -> dict[str, np.ndarray]:
+    """Gets `columns` of candle data as NumPy arrays. Arrow columns held in a single chunk without nulls are zero-copy
+    views of the Arrow buffers, which are the file's own pages when read with `read_candles` from an IPC file.
+    Columns split over several chunks are combined first, and DataFrame columns are their underlying arrays.
+    """
+    arrays = {}
+    for name in columns:
+        column = price_data[name]
+        if isinstance(column, pa.ChunkedArray):
+            column = (
+                column.chunk(0) if column.num_chunks == 1 else column.combine_chunks()
+            )
+        if isinstance(column, pa.Array):
+            arrays[name] = column.to_numpy(zero_copy_only=not column.null_count)
+        else:
+            arrays[name] = np.asarray(column)
+    return arrays
+
+
+def read_candles(path: Path, columns: list[str] | None = None) -> pa.Table:
+    """Reads a candle file through a memory map. Arrow IPC (Feather) files are mapped as is, so with `candle_arrays`
+    the simulation reads their pages directly. Parquet files are decoded from the mapped file.
+    """
+    path = Path(path)
+    if path.suffix in [".arrow", ".feather", ".ipc"]:
+        table = pa.ipc.open_file(pa.memory_map(str(path))).read_all()
+        return table if columns is None else table.select(columns)
+    return pq.read_table(path, columns=columns, memory_map=True)
 
-        metadata = {
-            "ratios": self.ratios,
-            "discounts": self.discounts,
-            "refresh_amounts": refresh_amounts,
-            "refresh_intervals": refresh_intervals,
-        }
 
-        for key, value in metadata.items():
-            if np.issubdtype(value.dtype, np.timedelta64):
-                value = list(value.astype("timedelta64[s]").astype(int))
-            metadata[key] = json.dumps(value, cls=NpEncoder)
+def nearest_indicies(sorted_times: np.ndarray, times: np.ndarray) -> np.ndarray:
+    """Gets the index of the entry of `sorted_times` nearest to each of `times` (the earlier one on ties) by binary search."""
+    if len(sorted_times) == 1:
+        return np.zeros(len(times), dtype=np.int64)
+    after = np.searchsorted(sorted_times, times).clip(1, len(sorted_times) - 1)
+    before = after - 1
+    return np.where(
+        sorted_times[after] - times < times - sorted_times[before], after, before
+    )
+
+
+def get_refresh_schedule(
+    start_times: np.ndarray,
+    refresh_amounts: float | np.ndarray = None,
+    refresh_intervals: timedelta | np.ndarray = None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Expands the `refresh_amounts` and `refresh_intervals` arguments of `Buyback.simulate_buybacks` into one entry per
+    refresh and finds the candle index range (`start_idxs` to `refresh_idxs`, inclusive) covered by each refresh. Each
+    refresh happens at the candle nearest to its time, found by binary search in the sorted `start_times`, so missing
+    candles are skipped over. If the refreshes end before the last candle, the remaining candles are simulated as a
+    final period ending without a refresh: `start_idxs` and `refresh_idxs` then have one more entry than
+    `refresh_amounts` and `refresh_intervals`, and the period isn't counted as a refresh.
 
-        self._schema = self._schema.with_metadata(metadata)
-        return pa.Table.from_batches(self.history, schema=self._schema)
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: `refresh_amounts`, `refresh_intervals`, `start_idxs` and `refresh_idxs`
+    """
+    first_timestamp = start_times[0]
+    full_duration = start_times[-1] - first_timestamp
+
+    if refresh_intervals is None:
+        refresh_intervals = np.array([full_duration])
+    elif not isinstance(refresh_intervals, np.ndarray):
+        # if it's a single value explicitly create each refresh time
+        refresh_intervals = np.arange(
+            refresh_intervals, full_duration + refresh_intervals, refresh_intervals
+        )
+
+    if refresh_amounts is None:
+        refresh_amounts = np.zeros(refresh_intervals.shape)
+    elif not isinstance(refresh_amounts, np.ndarray):
+        # if it's a single value explicitly create each new allocation
+        refresh_amounts = np.ones(refresh_intervals.shape) * refresh_amounts
+
+    refresh_idxs = nearest_indicies(start_times, first_timestamp + refresh_intervals)
+    if refresh_idxs[-1] < len(start_times) - 1:
+        # the refreshes end before the data does, the remaining candles are a final period without a refresh
+        refresh_idxs = np.append(refresh_idxs, len(start_times) - 1)
+    start_idxs = np.roll(refresh_idxs, shift=1)
+    start_idxs[0] = 0
+
+    return refresh_amounts, refresh_intervals, start_idxs, refresh_idxs
+
+
+def encode_metadata(
+    ratios: np.ndarray,
+    discounts: np.ndarray,
+    refresh_amounts: np.ndarray,
+    refresh_intervals: np.ndarray,
+) -> dict[str, str]:
+    """Encodes the settings of a simulation into schema metadata, the inverse of `decode_metadata`."""
+    metadata = {
+        "ratios": ratios,
+        "discounts": discounts,
+        "refresh_amounts": refresh_amounts,
+        "refresh_intervals": refresh_intervals,
+    }
+
+    for key, value in metadata.items():
+        if np.issubdtype(value.dtype, np.timedelta64):
+            value = list(value.astype("timedelta64[s]").astype(int))
+        metadata[key] = json.dumps(value, cls=NpEncoder)
+    return metadata
+
+
+def first_touch_indicies(
+    lows: np.ndarray, prices: np.ndarray, scale_factor: float | None = None
+) -> np.ndarray:
+    """Gets the index of the first candle in `lows` trading below each of `prices`, or `len(lows)` if the price is never reached.
+    With `scale_factor` the lows are compared rescaled, which only takes rescaling their running minimum.
+    """
+    running_min = np.minimum.accumulate(lows)
+    if scale_factor is not None:
+        # scaling by a positive factor keeps the order, so this is the running minimum of the rescaled lows
+        running_min *= scale_factor
+    # the negated running minimum is sorted, so the first touch of every price is a binary search
+    return np.searchsorted(-running_min, -np.asarray(prices), side="right")
 
 
 def get_breakpoints(
-    timestamps: list | np.ndarray | pd.DataFrame,
+    timestamps: list | np.ndarray | pd.Series | pd.DataFrame,
     window_time: timedelta,
     step_time: timedelta,
-):
-    """Gets the break point indicies assuming the `timestamps` data is sorted and has a constant time step."""
-    if not isinstance(timestamps, pd.DataFrame):
-        timestamps = pd.DataFrame(timestamps, columns=["start_time"])
+) -> list[tuple[int, int]]:
+    """Gets the (inclusive) candle index range of each `window_time` window of the sorted `timestamps`, one starting
+    every `step_time` from the first candle. Each window starts at the first candle at or after its start time and
+    ends at the last candle within `window_time` of that candle, both found by binary search, so missing candles are
+    skipped over and windows may differ in their number of candles (see `window_length_groups`). Start times falling
+    in the same gap give a single window, and only windows ending within the candles are included.
+    """
+    if isinstance(timestamps, pd.DataFrame):
+        timestamps = timestamps["start_time"]
+    times = pd.DatetimeIndex(timestamps).values
+    window_time = pd.Timedelta(window_time).to_timedelta64()
+    step_time = pd.Timedelta(step_time).to_timedelta64()
+    if not len(times) or times[0] + window_time > times[-1]:
+        return []
+
+    n_steps = (times[-1] - window_time - times[0]) // step_time + 1
+    step_starts = times[0] + np.arange(n_steps) * step_time
+    starts = np.unique(np.searchsorted(times, step_starts, side="left"))
+    starts = starts[times[starts] + window_time <= times[-1]]
+    stops = np.searchsorted(times, times[starts] + window_time, side="right") - 1
+    return [(int(start), int(stop)) for start, stop in zip(starts, stops)]
+
 
-    idx_time = (timestamps.iloc[1] - timestamps.iloc[0]).iloc[0]
-    step_idx = int(window_time / step_time)
-    window_idx = int(window_time / idx_time)
-    window_start_times = timestamps[:-window_idx:step_idx]
-    window_start_idx = window_start_times.index
-    return [(start_idx, start_idx + window_idx) for start_idx in window_start_idx]
+def window_length_groups(break_indicies: list[tuple[int, int]]) -> list[np.ndarray]:
+    """Groups the (inclusive) `break_indicies` windows by their number of candles, as only equally long windows can be
+    stacked (see `stack_windows`). Windows over evenly spaced candles all fall in a single group.
+
+    Returns:
+        list[np.ndarray]: positions in `break_indicies` of the windows of each length, in order
+    """
+    lengths = np.array([stop - start for start, stop in break_indicies])
+    return [np.flatnonzero(lengths == length) for length in np.unique(lengths)]
+
+
+def stack_windows(
+    values: np.ndarray, break_indicies: list[tuple[int, int]]
+) -> np.ndarray:
+    """Stacks the equally long (inclusive) `break_indicies` windows of `values` into a 2-D (window x candle) array (see `window_length_groups`). Evenly spaced windows, as returned by `get_breakpoints` over evenly spaced candles, are a strided view of `values` and are not copied."""
+    starts = np.array([start for start, _ in break_indicies])
+    window_len = break_indicies[0][1] - break_indicies[0][0] + 1
+    windows = np.lib.stride_tricks.sliding_window_view(values, window_len)
+    steps = np.diff(starts)
+    if not len(steps):
+        return windows[starts[0] : starts[0] + 1]
+    if steps[0] > 0 and (steps == steps[0]).all():
+        return windows[starts[0] :: steps[0]][: len(starts)]
+    return windows[starts]
+
+
+def batch_refresh_history(
+    ratios: np.ndarray,
+    discounts: np.ndarray,
+    amounts: np.ndarray,
+    allocated: np.ndarray,
+    refresh_amounts: np.ndarray,
+    redistribute_on_refresh: np.ndarray,
+    start_times: np.ndarray,
+    opens: np.ndarray,
+    lows: np.ndarray,
+    start_idxs: np.ndarray,
+    refresh_idxs: np.ndarray,
+    run_windows: np.ndarray | None = None,
+    scale_factors: np.ndarray | None = None,
+) -> tuple[dict[str, list[np.ndarray]], list[np.ndarray]]:
+    """Advances the buyback state of a stack of runs sharing one refresh schedule. Every run has its own ladder
+    (`ratios`, `discounts` and starting `amounts`, each run x account), `allocated` total, `refresh_amounts`
+    (refresh x run, with no entry for a final period ending without a refresh, see `get_refresh_schedule`) and
+    `redistribute_on_refresh` flag, and replays the window `run_windows` of the (window x candle) candle stacks,
+    which defaults to one run per window. The prices of each window are rescaled by its entry of
+    `scale_factors`, if given, as they are used (see `first_touch_indicies`), so the stacks can be views of the
+    candles.
+
+    Returns the columns of the SCHEMA_BUYBACK rows (without `identifier`) gathered one refresh at a time, along with
+    the run of each row.
+    """
+    n_runs, n_accounts = ratios.shape
+    rows = slice(None) if run_windows is None else run_windows
+    window_of_run = np.arange(n_runs) if run_windows is None else run_windows
+    amounts = amounts.copy()
+    spent = np.zeros(n_runs)
+    purchased = np.zeros(n_runs)
+    n_discount_refresh = np.zeros((n_runs, n_accounts))
+    n_discount_buybacks = np.zeros((n_runs, n_accounts))
+    n_refresh = np.zeros(n_runs, dtype=np.int64)
+    n_buybacks = np.zeros(n_runs, dtype=np.int64)
+    # cleared[d, j] is True if the order at account `j` has been checked by the time account `d` is checked
+    cleared = np.tril(np.ones((n_accounts, n_accounts), dtype=bool))
+
+    columns = {name: [] for name in SCHEMA_BUYBACK.names if name != "identifier"}
+    run_idxs = []
+    for p_idx, (start_idx, refresh_idx) in enumerate(zip(start_idxs, refresh_idxs)):
+        refresh_lows = lows[rows, start_idx : refresh_idx + 1]
+        ref_prices = opens[rows, start_idx]
+        running_min = np.minimum.accumulate(refresh_lows, axis=1)
+        if scale_factors is not None:
+            ref_prices = ref_prices * scale_factors[rows]
+            running_min *= scale_factors[rows, np.newaxis]
+        buyback_prices = ref_prices[:, np.newaxis] * (100 - discounts) / 100
+        # the running minimum never increases, so the candles above a price all come before its first touch
+        hit_idxs = np.stack(
+            [
+                (running_min >= buyback_prices[:, [a_idx]]).sum(axis=1)
+                for a_idx in range(n_accounts)
+            ],
+            axis=1,
+        )
+        filled = (amounts > 0) & (hit_idxs < refresh_lows.shape[1])
+
+        if filled.any():
+            fill_amounts = np.where(filled, amounts, 0)
+            fill_purchased = np.where(filled, amounts / buyback_prices, 0)
+            running_spent = np.cumsum(
+                np.concatenate([spent[:, np.newaxis], fill_amounts], axis=1), axis=1
+            )[:, 1:]
+            running_purchased = np.cumsum(
+                np.concatenate([purchased[:, np.newaxis], fill_purchased], axis=1),
+                axis=1,
+            )[:, 1:]
+            remaining = np.where(
+                filled[:, np.newaxis, :] & cleared, 0, amounts[:, np.newaxis, :]
+            ).sum(axis=2)
+            n_discount_buybacks += filled
+            running_n_buybacks = n_buybacks[:, np.newaxis] + np.cumsum(filled, axis=1)
+
+            r_idx, a_idx = np.nonzero(filled)
+            w_idx = window_of_run[r_idx]
+            run_idxs.append(r_idx)
+            columns["start_time"].append(start_times[w_idx, 0])
+            columns["last_reset_time"].append(start_times[w_idx, start_idx])
+            columns["trigger_time"].append(
+                start_times[w_idx, start_idx + hit_idxs[r_idx, a_idx]]
+            )
+            columns["amount"].append(fill_amounts[r_idx, a_idx])
+            columns["price"].append(buyback_prices[r_idx, a_idx])
+            columns["purchased"].append(fill_purchased[r_idx, a_idx])
+            columns["ref_price"].append(ref_prices[r_idx])
+            columns["ratio"].append(ratios[r_idx, a_idx])
+            columns["discount"].append(discounts[r_idx, a_idx])
+            columns["start_price"].append(
+                opens[w_idx, 0]
+                if scale_factors is None
+                else opens[w_idx, 0] * scale_factors[w_idx]
+            )
+            columns["running_allocated"].append(allocated[r_idx])
+            columns["running_spent"].append(running_spent[r_idx, a_idx])
+            columns["running_purchased"].append(running_purchased[r_idx, a_idx])
+            columns["running_return"].append(
+                running_purchased[r_idx, a_idx]
+                * buyback_prices[r_idx, a_idx]
+                / running_spent[r_idx, a_idx]
+            )
+            columns["remaining_amount"].append(remaining[r_idx, a_idx])
+            columns["num_discount_buybacks"].append(n_discount_buybacks[r_idx, a_idx])
+            columns["num_discount_refresh"].append(n_discount_refresh[r_idx, a_idx])
+            columns["num_buybacks"].append(running_n_buybacks[r_idx, a_idx])
+            columns["num_refresh"].append(n_refresh[r_idx])
+
+            amounts[filled] = 0
+            spent = running_spent[:, -1]
+            purchased = running_purchased[:, -1]
+            n_buybacks = running_n_buybacks[:, -1]
+        if p_idx == len(refresh_amounts):
+            break  # the final period ends with the data rather than a refresh
+
+        # Refresh allocations for next buyback
+        amounts = np.where(
+            redistribute_on_refresh[:, np.newaxis],
+            amounts.sum(axis=1)[:, np.newaxis] * ratios,
+            amounts,
+        )
+        added = refresh_amounts[p_idx][:, np.newaxis] * ratios
+        amounts = amounts + added
+        for amount in added.T:
+            allocated = allocated + amount
+        n_discount_refresh += 1
+        n_refresh += n_accounts
+
+    return columns, run_idxs
+
+
+def batch_simulate_buybacks(
+    identifiers: list[str],
+    ratios: np.ndarray,
+    discounts: np.ndarray,
+    amount_allocated: float,
+    start_times: np.ndarray,
+    opens: np.ndarray,
+    lows: np.ndarray,
+    refresh_amounts: float | np.ndarray = None,
+    refresh_intervals: timedelta | np.ndarray = None,
+    redistribute_on_refresh: bool = False,
+    instrumentation: Instrumentation | None = None,
+    scale_factors: np.ndarray | None = None,
+) -> pa.Table:
+    """Runs `Buyback.simulate_buybacks` for a stack of equally long windows at once. The buyback state of all windows
+    sharing a refresh schedule is advanced together one refresh interval at a time, so the cost of a backtest grows
+    with the number of refreshes rather than the number of windows.
+
+    Args:
+        identifiers (list[str]): Identifier of the buyback run for each window.
+        ratios (np.ndarray): Ratio of the allocation placed at each discount, see `Buyback`.
+        discounts (np.ndarray): Discount of each limit order, see `Buyback`.
+        amount_allocated (float): Initial allocation of each window.
+        start_times (np.ndarray): 2-D (window x candle) array of candle start times.
+        opens (np.ndarray): 2-D (window x candle) array of candle open prices.
+        lows (np.ndarray): 2-D (window x candle) array of candle low prices.
+        refresh_amounts (float | np.ndarray, optional): See `Buyback.simulate_buybacks`. Defaults to None.
+        refresh_intervals (timedelta | np.ndarray, optional): See `Buyback.simulate_buybacks`. Defaults to None.
+        redistribute_on_refresh (bool, optional): See `Buyback.simulate_buybacks`. Defaults to False.
+        instrumentation (Instrumentation | None, optional): Counts the candles simulated, refreshes and fills of all
+            windows, as `Buyback.instrumentation` does. Defaults to None.
+        scale_factors (np.ndarray | None, optional): Factor the prices of each window are simulated rescaled by, see
+            `batch_refresh_history`. Defaults to None.
+
+    Returns:
+        pa.Table: Table containing the history of buybacks transacted in all windows, ordered by window
+    """
+    # validate and normalize the ladder the same way a single run does
+    ladder = Buyback(
+        identifier=None,
+        ratios=ratios,
+        discounts=discounts,
+        amount_allocated=amount_allocated,
+    )
+
+    schedules = group_refresh_schedules(
+        start_times=start_times,
+        refresh_amounts=refresh_amounts,
+        refresh_intervals=refresh_intervals,
+    )
+
+    columns = {name: [] for name in SCHEMA_BUYBACK.names if name != "identifier"}
+    window_idxs = []
+    for (group_amounts, _, group_starts, group_refreshes), group in schedules:
+        n_runs = len(group)
+        group_columns, group_run_idxs = batch_refresh_history(
+            ratios=np.tile(ladder.ratios, (n_runs, 1)),
+            discounts=np.tile(ladder.discounts, (n_runs, 1)),
+            amounts=np.tile(ladder.amounts, (n_runs, 1)),
+            allocated=np.full(n_runs, ladder.amount_allocated, dtype=np.float64),
+            refresh_amounts=np.tile(group_amounts[:, np.newaxis], (1, n_runs)),
+            redistribute_on_refresh=np.full(n_runs, redistribute_on_refresh),
+            start_times=start_times,
+            opens=opens,
+            lows=lows,
+            start_idxs=group_starts,
+            refresh_idxs=group_refreshes,
+            run_windows=None if n_runs == len(start_times) else group,
+            scale_factors=scale_factors,
+        )
+        for name, values in group_columns.items():
+            columns[name].extend(values)
+        window_idxs.extend(group[r_idx] for r_idx in group_run_idxs)
+
+    if instrumentation is not None:
+        instrumentation.count("candles_simulated", start_times.size)
+        instrumentation.count(
+            "refreshes",
+            sum(len(schedule[0]) * len(group) for schedule, group in schedules),
+        )
+        instrumentation.count("fills", sum(len(idxs) for idxs in window_idxs))
+    first_schedule = schedules[0][0]
+    schema = SCHEMA_BUYBACK.with_metadata(
+        encode_metadata(
+            ratios=ladder.ratios,
+            discounts=ladder.discounts,
+            refresh_amounts=first_schedule[0],
+            refresh_intervals=first_schedule[1],
+        )
+    )
+    return history_table(
+        columns=columns,
+        run_idxs=window_idxs,
+        identifiers=identifiers,
+        schema=schema,
+    )
+
+
+def group_refresh_schedules(
+    start_times: np.ndarray,
+    refresh_amounts: float | np.ndarray = None,
+    refresh_intervals: timedelta | np.ndarray = None,
+) -> list[tuple[tuple[np.ndarray, ...], np.ndarray]]:
+    """Gets the refresh schedule (see `get_refresh_schedule`) of each window of the 2-D (window x candle) `start_times`
+    and groups the windows sharing one. Windows only share a schedule if their candles are evenly spaced.
+
+    Returns:
+        list[tuple[tuple[np.ndarray, ...], np.ndarray]]: each schedule along with the indicies of the windows using it, in order of first use
+    """
+    schedules = {}
+    for w_idx, window_times in enumerate(start_times):
+        schedule = get_refresh_schedule(
+            start_times=window_times,
+            refresh_amounts=refresh_amounts,
+            refresh_intervals=refresh_intervals,
+        )
+        key = (tuple(schedule[2]), tuple(schedule[3]))
+        schedules.setdefault(key, (schedule, []))[1].append(w_idx)
+    return [(schedule, np.array(group)) for schedule, group in schedules.values()]
+
+
+def history_table(
+    columns: dict[str, list[np.ndarray]],
+    run_idxs: list[np.ndarray],
+    identifiers: list[str],
+    schema: pa.Schema = SCHEMA_BUYBACK,
+) -> pa.Table:
+    """Assembles the SCHEMA_BUYBACK columns gathered by `batch_refresh_history` into one table ordered by run, where
+    `run_idxs` index into `identifiers`."""
+    if not run_idxs:
+        return schema.empty_table()
+
+    # rows were gathered one refresh at a time, a stable sort groups them by run while keeping their order
+    run_idxs = np.concatenate(run_idxs)
+    order = np.argsort(run_idxs, kind="stable")
+    columns = dict(columns)
+    columns["identifier"] = [np.array(identifiers, dtype=str)[run_idxs]]
+    return pa.Table.from_pydict(
+        {name: np.concatenate(columns[name])[order] for name in schema.names},
+        schema=schema,
+    )
 
 
 def decode_metadata(metadata):
@@ -257,15 +858,25 @@ def decode_metadata(metadata):
     return decoded
 
 
-def get_price_statistics(data: pd.DataFrame):
-    price_data = data[["open", "close", "high", "low"]]
-    row_price_means = price_data.values.mean(axis=1)
+def get_price_statistics(
+    data: pd.DataFrame | pa.Table | dict[str, np.ndarray],
+    scale_factor: float | None = None,
+):
+    """Gets the statistics of the prices of the candles `data` (see `PRICE_STATISTICS`), which are read as NumPy arrays
+    (see `candle_arrays`). With `scale_factor` the statistics are those of the candles rescaled by it.
+    """
+    candles = candle_arrays(
+        data, columns=["start_time", "open", "close", "high", "low"]
+    )
+    price_data = np.stack(
+        [candles[name] for name in ["open", "close", "high", "low"]], axis=1
+    )
 
-    date_deltas = (
-        data["start_time"] - data["start_time"][0]
-    )  # TODO: is resolution always milliseconds?
-    stacked_dates = np.tile(date_deltas.astype("int64"), 4)
-    stacked_prices = price_data.values.flatten()
+    date_deltas = (candles["start_time"] - candles["start_time"][0]) / np.timedelta64(
+        1, "ms"
+    )
+    stacked_dates = np.tile(date_deltas, 4)
+    stacked_prices = price_data.flatten(order="F")  # aligned with the dates
     price_std = stacked_prices.std()
     price_mean = stacked_prices.mean()
     stacked_prices_perc = (stacked_prices - stacked_prices[0]) / stacked_prices[0]
@@ -275,7 +886,13 @@ def get_price_statistics(data: pd.DataFrame):
     price_slope = regression.slope * 1e3 * 86400  # milliseconds to days
     regression_perc = scipy.stats.linregress(stacked_dates, stacked_prices_perc)
     price_slope_ppd = regression_perc.slope * 1e3 * 86400 * 100  # in % per day
-    final_over_start_price = data["close"].values[-1] - data["open"].values[0]
+    final_over_start_price = candles["close"][-1] - candles["open"][0]
+    if scale_factor is not None:
+        # the relative statistics don't depend on the scale of the prices
+        price_mean = price_mean * scale_factor
+        price_std = price_std * scale_factor
+        price_slope = price_slope * scale_factor
+        final_over_start_price = final_over_start_price * scale_factor
     return (
         price_mean,
         price_slope,
@@ -286,124 +903,297 @@ def get_price_statistics(data: pd.DataFrame):
     )
 
 
-def buyback_overview(result: pd.DataFrame, data: pd.DataFrame) -> pa.RecordBatch:
+PRICE_STATISTICS = [
+    "price_mean",
+    "price_slope",
+    "price_slope_ppd",
+    "final_over_start_price",
+    "price_std",
+    "price_rel_std",
+]  # overview columns returned by `get_price_statistics`, in order
+
+
+def rolling_price_statistics(
+    asset_pair: pd.DataFrame,
+    break_indicies: list[tuple[int, int]],
+    sim_start_price: float | None = None,
+) -> np.ndarray:
+    """Gets the `get_price_statistics` of every (inclusive) `break_indicies` window of `asset_pair` from prefix sums
+    built once over the pair, so each window costs O(1) however long it is or however much it overlaps the others.
+    If `sim_start_price` is set the statistics are those of the window rescaled to open at `sim_start_price`, as in
+    `stack_pair_windows`. The results match `get_price_statistics` to float tolerance.
+
+    Returns:
+        np.ndarray: (window x statistic) array with the columns of `PRICE_STATISTICS`
+    """
+    prices = asset_pair[["open", "close", "high", "low"]].values.astype(np.float64)
+    start_times = asset_pair["start_time"].values
+    days = (start_times - start_times[0]) / np.timedelta64(1, "D")
+    # prices are taken relative to their overall mean to keep the prefix sums small
+    offset = prices.mean()
+    candle_sums = (prices - offset).sum(axis=1)
+    candle_squares = ((prices - offset) ** 2).sum(axis=1)
+
+    def window_sums(values: np.ndarray) -> np.ndarray:
+        prefix_sums = np.concatenate([[0], np.cumsum(values)])
+        return prefix_sums[stops] - prefix_sums[starts]
+
+    starts = np.array([start for start, _ in break_indicies])
+    stops = np.array([stop for _, stop in break_indicies]) + 1
+    n_prices = 4 * (stops - starts)  # every candle time is counted once per price
+    sum_days = 4 * window_sums(days)
+    sum_days_sq = 4 * window_sums(days**2)
+    sum_prices = window_sums(candle_sums)
+    sum_prices_sq = window_sums(candle_squares)
+    sum_days_prices = window_sums(days * candle_sums)
+
+    start_prices = prices[starts, 0]
+    scale_factors = None
+    if sim_start_price is not None:
+        scale_factors = sim_start_price / asset_pair["open"].values[starts]
+    return price_statistics_from_sums(
+        n_prices=n_prices,
+        sum_days=sum_days,
+        sum_days_sq=sum_days_sq,
+        sum_prices=sum_prices,
+        sum_prices_sq=sum_prices_sq,
+        sum_days_prices=sum_days_prices,
+        offset=offset,
+        start_prices=start_prices,
+        final_prices=prices[stops - 1, 1],
+        scale_factors=scale_factors,
+    )
+
+
+def price_statistics_from_sums(
+    n_prices: np.ndarray,
+    sum_days: np.ndarray,
+    sum_days_sq: np.ndarray,
+    sum_prices: np.ndarray,
+    sum_prices_sq: np.ndarray,
+    sum_days_prices: np.ndarray,
+    offset: float | np.ndarray,
+    start_prices: np.ndarray,
+    final_prices: np.ndarray,
+    scale_factors: np.ndarray | None = None,
+) -> np.ndarray:
+    """Gets the `get_price_statistics` of windows from the sums of their (day, price) points, with prices taken
+    relative to `offset`. Days may be counted from any origin. `start_prices` and `final_prices` are the first open
+    and last close of each window, and the statistics are rescaled by `scale_factors` if given.
+
+    Returns:
+        np.ndarray: (window x statistic) array with the columns of `PRICE_STATISTICS`
+    """
+    mean_offset = sum_prices / n_prices
+    price_std = np.sqrt(np.maximum(sum_prices_sq / n_prices - mean_offset**2, 0))
+    price_slope = (sum_days_prices - sum_days * sum_prices / n_prices) / (
+        sum_days_sq - sum_days**2 / n_prices
+    )  # per day
+    price_mean = mean_offset + offset
+    final_over_start_price = final_prices - start_prices
+    if scale_factors is not None:
+        price_mean = price_mean * scale_factors
+        price_std = price_std * scale_factors
+        price_slope = price_slope * scale_factors
+        final_over_start_price = final_over_start_price * scale_factors
+        start_prices = start_prices * scale_factors
+    price_rel_std = price_std / np.abs(start_prices)
+    price_slope_ppd = price_slope / start_prices * 100  # in % per day
+    return np.stack(
+        [
+            price_mean,
+            price_slope,
+            price_slope_ppd,
+            final_over_start_price,
+            price_std,
+            price_rel_std,
+        ],
+        axis=1,
+    )
+
+
+def buyback_overview(
+    result: pa.Table,
+    data: pd.DataFrame | pa.Table | dict[str, np.ndarray],
+    scale_factor: float | None = None,
+) -> pa.RecordBatch:
+    """Summarizes the buyback history `result` of a simulation over the candles `data`, rescaled by `scale_factor` if
+    given, see `grouped_buyback_overview`.
+    """
     metadata = decode_metadata(result.schema.metadata)
-    ratios = metadata["ratios"]
-    discounts = metadata["discounts"]
-
-    result = result.to_pandas()
-    identifiers = result["identifier"].drop_duplicates()
-
-    id_list = []
-    running_return_mean = []
-    end_running_return = []
-    ratio_list = []
-    discount_list = []
-    delay_min = []
-    delay_max = []
-    delay_mean = []
-    end_discount_running_return = []
-    end_n_discount_buybacks = []
-    end_n_discount_refresh = []
-    end_n_buybacks = []
-    end_n_refresh = []
-
-    (
-        price_mean,
-        price_slope,
-        price_slope_ppd,
-        final_over_start_price,
-        price_std,
-        price_rel_std,
-    ) = get_price_statistics(data)
-
-    price_means = []
-    price_slopes = []
-    price_slopes_ppd = []
-    final_over_start_prices = []
-    price_stds = []
-    price_rel_stds = []
-    # don't do `for (ident, ratio), subtable in result.groupby(["identifier", "ratio"]):` because we want metadata from the orders that didn't execute too
-    for ident in identifiers:  # group metadata for each backtest run
-        for r_idx, ratio in enumerate(ratios):
-            # will have duplicates across all discounts
-            id_list.append(ident)
-            running_return_mean.append(result["running_return"].mean())
-            end_running_return.append(result["running_return"].iloc[-1])
-
-            # unique to each discount
-            ratio_list.append(ratio)
-            discount_list.append(discounts[r_idx])
-            idxs = result[
-                (result["ratio"] == ratio) & (result["identifier"] == ident)
-            ].index
-            subtable = result.loc[idxs, :]
-            if not len(subtable):
-                delay_min.append(None)
-                delay_max.append(None)
-                delay_mean.append(None)
-                end_discount_running_return.append(None)
-                end_n_discount_buybacks.append(None)
-                end_n_discount_refresh.append(None)
+    return grouped_buyback_overview(
+        result=result,
+        ratios=metadata["ratios"],
+        discounts=metadata["discounts"],
+        price_statistics=get_price_statistics(data, scale_factor=scale_factor),
+    )
 
-            else:
-                subtable["trigger_delay"] = (
-                    subtable["trigger_time"] - subtable["start_time"]
-                )
-                subtable["discount_running_spent"] = subtable["amount"].cumsum()
-                subtable["discount_running_purchased"] = subtable["purchased"].cumsum()
-                subtable["discount_running_return"] = (
-                    subtable["discount_running_purchased"]
-                    * subtable["price"]
-                    / subtable["discount_running_spent"]
-                )
 
-                desc = subtable.describe()
-                delay_min.append(desc.loc["min", "trigger_delay"])
-                delay_max.append(desc.loc["max", "trigger_delay"])
-                delay_mean.append(desc.loc["mean", "trigger_delay"])
-                end_discount_running_return.append(
-                    subtable["discount_running_return"].values[-1]
-                )
-                end_n_discount_buybacks.append(
-                    subtable["num_discount_buybacks"].values[-1]
-                )
-                end_n_discount_refresh.append(
-                    subtable["num_discount_refresh"].values[-1]
-                )
+def ladder_accounts(
+    ratios: np.ndarray,
+    discounts: np.ndarray,
+    row_ratios: np.ndarray,
+    row_discounts: np.ndarray,
+    row_periods: list[np.ndarray],
+) -> np.ndarray:
+    """Gets the account of the ladder (`ratios`, `discounts`) each buyback history row was filled from, by its ratio
+    and discount. Accounts sharing both always hold the same amount and fill at the same candle, one after the other
+    in account order, so within each refresh period (the rows sharing all of `row_periods`, e.g. run and
+    `last_reset_time`) their rows are given to them in turn.
+    """
+    if pd.Index(discounts).is_unique:
+        return pd.Index(discounts).get_indexer(row_discounts)
+
+    ladder = pd.MultiIndex.from_arrays([ratios, discounts])
+    keys = ladder.unique()
+    row_keys = keys.get_indexer(pd.MultiIndex.from_arrays([row_ratios, row_discounts]))
+    account_keys = keys.get_indexer(ladder)
+    key_accounts = np.argsort(account_keys, kind="stable")
+    key_starts = np.searchsorted(account_keys[key_accounts], np.arange(len(keys)))
+    turns = pd.Series(row_keys).groupby([*row_periods, row_keys], sort=False).cumcount()
+    return key_accounts[key_starts[row_keys] + turns.values]
+
+
+def grouped_buyback_overview(
+    result: pa.Table,
+    ratios: np.ndarray,
+    discounts: np.ndarray,
+    price_statistics: tuple | pd.DataFrame,
+) -> pa.RecordBatch:
+    """Summarizes a buyback history `result` holding any number of runs sharing a ladder into one SCHEMA_OVERVIEW row
+    per (identifier, discount). Every column is computed with grouped reductions over the rows of each run and of
+    each discount, rather than by filtering the table for each row. Discounts that were never filled still get a row,
+    with nulls for the columns describing their fills.
+
+    Args:
+        result (pa.Table): Buyback history following SCHEMA_BUYBACK, with the rows of each run in the order they were made.
+        ratios (np.ndarray): Ratio of each discount of the ladder.
+        discounts (np.ndarray): Discounts of the ladder.
+        price_statistics (tuple | pd.DataFrame): Output of `get_price_statistics` for the candles of all runs, or a
+            DataFrame indexed by identifier with a column for each of `PRICE_STATISTICS`.
 
-            end_n_buybacks.append(result["num_buybacks"].max())
-            end_n_refresh.append(result["num_refresh"].max())
+    Returns:
+        pa.RecordBatch: Overview of the runs in order of their first row in `result`, and of the discounts in ladder order
+    """
+    # don't `groupby(["identifier", "ratio"])` alone because we want metadata from the orders that didn't execute too
+    ratios = np.asarray(ratios, dtype=np.float32)
+    discounts = np.asarray(discounts, dtype=np.float32)
+    n_accounts = len(discounts)
+    id_codes, identifiers = pd.factorize(
+        result["identifier"].to_numpy(zero_copy_only=False)
+    )
+    n_ids = len(identifiers)
+    if not n_ids:
+        return pa.RecordBatch.from_pylist([], schema=SCHEMA_OVERVIEW)
+
+    # rows grouped by run, keeping their order
+    row_order = np.argsort(id_codes, kind="stable")
+    id_codes = id_codes[row_order]
+    columns = {
+        name: result[name].to_numpy()[row_order]
+        for name in [
+            "start_time",
+            "last_reset_time",
+            "trigger_time",
+            "amount",
+            "price",
+            "purchased",
+            "ratio",
+            "discount",
+            "running_return",
+            "num_discount_buybacks",
+            "num_discount_refresh",
+            "num_buybacks",
+            "num_refresh",
+        ]
+    }
+    id_starts = np.searchsorted(id_codes, np.arange(n_ids))
+    id_ends = np.append(id_starts[1:], len(id_codes))
+    running_return_mean = np.array(
+        [
+            columns["running_return"][start:end].mean()
+            for start, end in zip(id_starts, id_ends)
+        ],
+        dtype=np.float32,
+    )
+    end_running_return = columns["running_return"][id_ends - 1]
+    end_n_buybacks = np.maximum.reduceat(columns["num_buybacks"], id_starts)
+    end_n_refresh = np.maximum.reduceat(columns["num_refresh"], id_starts)
+
+    # rows grouped by (run, discount), keeping their order
+    account_idxs = ladder_accounts(
+        ratios=ratios,
+        discounts=discounts,
+        row_ratios=columns["ratio"],
+        row_discounts=columns["discount"],
+        row_periods=[id_codes, columns["last_reset_time"]],
+    )
+    groups = id_codes * n_accounts + account_idxs
+    group_order = np.argsort(groups, kind="stable")
+    sorted_groups = groups[group_order]
+    counts = np.bincount(groups, minlength=n_ids * n_accounts)
+    filled = counts > 0
+    group_starts = np.searchsorted(sorted_groups, np.arange(n_ids * n_accounts))
+    filled_starts = group_starts[filled]
+    last_rows = group_order[group_starts[filled] + counts[filled] - 1]
+
+    def running_total(values: np.ndarray) -> np.ndarray:
+        """Final cumulative sum of each filled group, accumulated in row order."""
+        positions = np.arange(len(sorted_groups)) - group_starts[sorted_groups]
+        padded = np.zeros((n_ids * n_accounts, counts.max()), dtype=values.dtype)
+        padded[sorted_groups, positions] = values[group_order]
+        return np.cumsum(padded, axis=1)[filled, -1]
+
+    delays = (
+        (columns["trigger_time"] - columns["start_time"])
+        .astype("timedelta64[s]")
+        .astype(np.int64)[group_order]
+    )
+    delay_min = np.minimum.reduceat(delays, filled_starts)
+    delay_max = np.maximum.reduceat(delays, filled_starts)
+    delay_mean = np.trunc(
+        np.add.reduceat(delays, filled_starts) / counts[filled]
+    ).astype(np.int64)
+    end_discount_running_return = (
+        running_total(columns["purchased"])
+        * columns["price"][last_rows]
+        / running_total(columns["amount"])
+    )
+
+    def per_discount(values: np.ndarray, dtype: pa.DataType) -> pa.Array:
+        """Spreads the values of the filled groups over all groups, null where a discount was never filled."""
+        spread = np.zeros(n_ids * n_accounts, dtype=values.dtype)
+        spread[filled] = values
+        return pa.array(spread, mask=~filled, type=dtype)
 
-            # add price statistics
-            price_means.append(price_mean)
-            price_slopes.append(price_slope)
-            price_slopes_ppd.append(price_slope_ppd)
-            final_over_start_prices.append(final_over_start_price)
-            price_stds.append(price_std)
-            price_rel_stds.append(price_rel_std)
+    if isinstance(price_statistics, pd.DataFrame):
+        price_statistics = price_statistics.loc[identifiers, PRICE_STATISTICS].values
+    else:
+        price_statistics = np.tile(price_statistics, (n_ids, 1))
 
     overview = {
-        "identifier": id_list,
-        "ratio": ratio_list,
-        "discount": discount_list,
-        "delay_min": delay_min,
-        "delay_max": delay_max,
-        "delay_mean": delay_mean,
-        "end_num_discount_buybacks": end_n_discount_buybacks,
-        "end_num_discount_refresh": end_n_discount_refresh,
-        "end_num_buybacks": end_n_buybacks,
-        "end_num_refresh": end_n_refresh,
-        "end_running_return": end_running_return,
-        "end_discount_running_return": end_discount_running_return,
-        "running_return_mean": running_return_mean,
-        "price_mean": price_means,
-        "price_slope": price_slopes,
-        "price_slope_ppd": price_slopes_ppd,
-        "final_over_start_price": final_over_start_prices,
-        "price_std": price_stds,
-        "price_rel_std": price_rel_stds,
+        "identifier": np.repeat(np.asarray(identifiers, dtype=str), n_accounts),
+        "ratio": np.tile(ratios, n_ids),
+        "discount": np.tile(discounts, n_ids),
+        "delay_min": per_discount(delay_min, pa.duration("s")),
+        "delay_max": per_discount(delay_max, pa.duration("s")),
+        "delay_mean": per_discount(delay_mean, pa.duration("s")),
+        "end_num_discount_buybacks": per_discount(
+            columns["num_discount_buybacks"][last_rows], pa.int32()
+        ),
+        "end_num_discount_refresh": per_discount(
+            columns["num_discount_refresh"][last_rows], pa.int32()
+        ),
+        "end_num_buybacks": np.repeat(end_n_buybacks, n_accounts),
+        "end_num_refresh": np.repeat(end_n_refresh, n_accounts),
+        "end_running_return": np.repeat(end_running_return, n_accounts),
+        "end_discount_running_return": per_discount(
+            end_discount_running_return, pa.float32()
+        ),
+        "running_return_mean": np.repeat(running_return_mean, n_accounts),
     }
+    for name, values in zip(PRICE_STATISTICS, price_statistics.T):
+        overview[name] = np.repeat(values, n_accounts)
     return pa.record_batch(overview, schema=SCHEMA_OVERVIEW)
 
 
@@ -431,7 +1221,7 @@ def make_settings_record(
     if isinstance(refresh_intervals, (timedelta, np.timedelta64)):
         refresh_intervals = [refresh_intervals]
 
-    if identifier is not None:
+    if identifier is None:
         identifier = uuid4()
     return pa.record_batch(
         {
@@ -451,6 +1241,482 @@ def make_settings_record(
     )
 
 
+RUN_NAMESPACE = UUID(
+    "6b0f3d3e-2f57-4c1a-9a55-1f0c2b8e7d41"
+)  # namespace of the run identifiers, change it when the simulation's results change to stop reusing stored runs
+
+
+class WindowDigest:
+    """Hashes the candles of a window, its assets and the start times and prices of its candles, which together with
+    the settings of a run determine its results. Each column is hashed on its own, so the candles can be fed in
+    chunks as they are read (see `streaming.stream_buyback_sim`) and give the same digest as all at once.
+    """
+
+    columns = ["start_time", "low", "high", "open", "close"]
+
+    def __init__(self, asset1: str, asset2: str):
+        self.assets = f"{asset1}-{asset2}".encode()
+        self._column_digests = {name: hashlib.sha256() for name in self.columns}
+
+    def update(self, candles: pd.DataFrame | dict[str, np.ndarray]) -> None:
+        """Feeds the next candles of the window, as a DataFrame or column arrays."""
+        for name, digest in self._column_digests.items():
+            dtype = "datetime64[s]" if name == "start_time" else np.float32
+            values = np.asarray(candles[name]).astype(dtype, copy=False)
+            digest.update(np.ascontiguousarray(values))
+
+    def hexdigest(self) -> str:
+        digest = hashlib.sha256(self.assets)
+        for column_digest in self._column_digests.values():
+            digest.update(column_digest.digest())
+        return digest.hexdigest()
+
+
+def window_digests(
+    asset_pair: pd.DataFrame, break_indicies: list[tuple[int, int]]
+) -> list[str]:
+    """Gets the `WindowDigest` of each (inclusive) `break_indicies` window of `asset_pair`."""
+    # converted once for the pair rather than for every window
+    columns = {
+        name: asset_pair[name].values.astype(
+            "datetime64[s]" if name == "start_time" else np.float32, copy=False
+        )
+        for name in WindowDigest.columns
+    }
+    digests = []
+    for start, stop in break_indicies:
+        digest = WindowDigest(
+            asset_pair["asset1"].iloc[0], asset_pair["asset2"].iloc[0]
+        )
+        digest.update(
+            {name: values[start : stop + 1] for name, values in columns.items()}
+        )
+        digests.append(digest.hexdigest())
+    return digests
+
+
+def run_identifier(
+    window_digest: str,
+    ratios: list | np.ndarray,
+    discounts: list | np.ndarray,
+    initial_allocation: float,
+    refresh_amount: float,
+    refresh_interval: timedelta | np.timedelta64,
+    run_window: timedelta | np.timedelta64,
+    sim_start_price: float | None = None,
+    redistribute_on_refresh: bool = False,
+) -> str:
+    """Derives the identifier of a run from its settings and the digest of its window (see `window_digests`), so that
+    the same run always gets the same identifier and its stored results can be reused (see `result_store.load_runs`).
+    """
+    settings = dict(
+        ratios=[float(ratio) for ratio in np.atleast_1d(ratios)],
+        discounts=[float(discount) for discount in np.atleast_1d(discounts)],
+        initial_allocation=float(initial_allocation),
+        refresh_amount=float(refresh_amount),
+        refresh_interval=pd.Timedelta(refresh_interval).total_seconds(),
+        run_window=pd.Timedelta(run_window).total_seconds(),
+        sim_start_price=None if sim_start_price is None else float(sim_start_price),
+        redistribute_on_refresh=bool(redistribute_on_refresh),
+        window=window_digest,
+    )
+    return str(uuid5(RUN_NAMESPACE, json.dumps(settings, sort_keys=True)))
+
+
+def stack_pair_windows(
+    asset_pair: pd.DataFrame,
+    break_indicies: list[tuple[int, int]],
+    sim_start_price: float | None = None,
+) -> tuple[dict[str, np.ndarray], np.ndarray | None]:
+    """Stacks the `break_indicies` windows of each candle column of `asset_pair` (see `stack_windows`). The prices are
+    left as they are: if `sim_start_price` is set the factor rescaling each window to open at `sim_start_price` is
+    returned along with the stacks, to be applied by the simulation (see `batch_refresh_history`).
+
+    Returns:
+        tuple[dict[str, np.ndarray], np.ndarray | None]: (window x candle) stack of each column, and scale factor of each window
+    """
+    stacked = {
+        column: stack_windows(asset_pair[column].values, break_indicies)
+        for column in ["start_time", "low", "high", "open", "close"]
+    }
+    scale_factors = None
+    if sim_start_price is not None:
+        scale_factors = sim_start_price / stacked["open"][:, 0]
+    return stacked, scale_factors
+
+
+def window_start_prices(
+    asset_pair: pd.DataFrame,
+    break_indicies: list[tuple[int, int]],
+    sim_start_price: float | None = None,
+) -> np.ndarray:
+    """Gets the opening price of each `break_indicies` window of `asset_pair`, or `sim_start_price` for every window if
+    it is set, as the windows of `stack_pair_windows` are rescaled to open at it."""
+    start_prices = asset_pair["open"].values[[start for start, _ in break_indicies]]
+    if sim_start_price is None:
+        return start_prices
+    return np.full_like(start_prices, sim_start_price)
+
+
+def batch_simulate_pair(
+    asset_pair: pd.DataFrame,
+    break_indicies: list[tuple[int, int]],
+    ratios: list,
+    discounts: list,
+    initial_allocation: float,
+    refresh_amount: float,
+    refresh_interval: timedelta,
+    run_window: timedelta,
+    sim_start_price: float | None = None,
+    redistribute_on_refresh: bool = False,
+    identifiers: list[str] | None = None,
+    instrumentation: Instrumentation | None = None,
+) -> tuple[pa.Table, list[pa.RecordBatch], list[pa.RecordBatch]]:
+    """Simulates every `break_indicies` window of a single asset pair at once with `batch_simulate_buybacks`, the
+    windows are stacked (window x candle) views of the pair's candles rather than per-window copies, one stack per
+    window length (see `window_length_groups`), rescaled as they are simulated if `sim_start_price` is set. A new identifier is drawn for each window unless `identifiers` are given. Each stage is timed by `instrumentation` if given.
+
+    Returns:
+        tuple[pa.Table, list[pa.RecordBatch], list[pa.RecordBatch]]: buyback history of all windows, settings record and overview of each window
+    """
+    if identifiers is None:
+        identifiers = [str(uuid4()) for _ in break_indicies]
+    with stage(instrumentation, "windows"):
+        start_prices = window_start_prices(asset_pair, break_indicies, sim_start_price)
+    group_results = []
+    for group in window_length_groups(break_indicies):
+        with stage(instrumentation, "windows"):
+            stacked, scale_factors = stack_pair_windows(
+                asset_pair=asset_pair,
+                break_indicies=[break_indicies[w_idx] for w_idx in group],
+                sim_start_price=sim_start_price,
+            )
+
+        with stage(instrumentation, "simulate"):
+            group_results.append(
+                batch_simulate_buybacks(
+                    identifiers=[identifiers[w_idx] for w_idx in group],
+                    ratios=ratios,
+                    discounts=discounts,
+                    amount_allocated=initial_allocation,
+                    start_times=stacked["start_time"],
+                    opens=stacked["open"],
+                    lows=stacked["low"],
+                    refresh_amounts=refresh_amount,
+                    refresh_intervals=refresh_interval,
+                    redistribute_on_refresh=redistribute_on_refresh,
+                    instrumentation=instrumentation,
+                    scale_factors=scale_factors,
+                )
+            )
+    results = group_results[0]
+    if len(group_results) > 1:
+        results = sort_runs(pa.concat_tables(group_results), identifiers)
+
+    settings = []
+    with stage(instrumentation, "settings"):
+        for w_idx, identifier in enumerate(identifiers):
+            settings.append(
+                make_settings_record(
+                    ratios=ratios,
+                    discounts=discounts,
+                    initial_allocations=initial_allocation,
+                    refresh_amounts=refresh_amount,
+                    refresh_intervals=refresh_interval,
+                    run_duration=run_window,
+                    asset1=asset_pair["asset1"].iloc[0],
+                    asset2=asset_pair["asset2"].iloc[0],
+                    redistribute_on_refresh=redistribute_on_refresh,
+                    identifier=identifier,
+                    start_price=start_prices[w_idx],
+                )
+            )
+
+    with stage(instrumentation, "overview"):
+        metadata = decode_metadata(results.schema.metadata)
+        overviews = [
+            grouped_buyback_overview(
+                result=results,
+                ratios=metadata["ratios"],
+                discounts=metadata["discounts"],
+                price_statistics=pd.DataFrame(
+                    rolling_price_statistics(
+                        asset_pair=asset_pair,
+                        break_indicies=break_indicies,
+                        sim_start_price=sim_start_price,
+                    ),
+                    index=identifiers,
+                    columns=PRICE_STATISTICS,
+                ),
+            )
+        ]
+    return results, settings, overviews
+
+
+def pair_window(
+    candles: dict[str, np.ndarray], start: int, stop: int
+) -> dict[str, np.ndarray]:
+    """Gets the (inclusive) window [`start`, `stop`] of the candle columns `candles` of an asset pair (see
+    `candle_arrays`) as views of the columns, so that windows don't copy the candles however much they overlap.
+    """
+    return {name: values[start : stop + 1] for name, values in candles.items()}
+
+
+def simulate_window(
+    window_data: pd.DataFrame | dict[str, np.ndarray],
+    identifier: str,
+    ratios: list,
+    discounts: list,
+    initial_allocation: float,
+    refresh_amount: float,
+    refresh_interval: timedelta,
+    run_window: timedelta,
+    sim_start_price: float | None = None,
+    redistribute_on_refresh: bool = False,
+    instrumentation: Instrumentation | None = None,
+) -> tuple[pa.Table, list[pa.RecordBatch], list[pa.RecordBatch]]:
+    """Simulates a single window of an asset pair's candles, given as a DataFrame or as column arrays (see
+    `pair_window`). If `sim_start_price` is set the prices are rescaled to open at it as they are simulated, leaving
+    `window_data` as it is. Each stage is timed by `instrumentation` if given.
+
+    Returns:
+        tuple[pa.Table, list[pa.RecordBatch], list[pa.RecordBatch]]: buyback history, settings record and overview of the window
+    """
+    buyback = Buyback(
+        identifier=identifier,
+        ratios=ratios,
+        discounts=discounts,
+        amount_allocated=initial_allocation,
+        instrumentation=instrumentation,
+    )
+    candles = candle_arrays(window_data, columns=["asset1", "asset2", "open"])
+    start_price = candles["open"][0]
+    scale_factor = None
+    if sim_start_price is not None:
+        scale_factor = sim_start_price / start_price
+        start_price = start_price * scale_factor
+
+    with stage(instrumentation, "settings"):
+        settings_record = make_settings_record(
+            ratios=ratios,
+            discounts=discounts,
+            initial_allocations=initial_allocation,
+            refresh_amounts=refresh_amount,
+            refresh_intervals=refresh_interval,
+            run_duration=run_window,
+            asset1=candles["asset1"][0],
+            asset2=candles["asset2"][0],
+            redistribute_on_refresh=redistribute_on_refresh,
+            identifier=identifier,
+            start_price=start_price,
+        )
+    with stage(instrumentation, "simulate"):
+        result = buyback.simulate_buybacks(
+            window_data,
+            refresh_amounts=refresh_amount,
+            refresh_intervals=refresh_interval,
+            redistribute_on_refresh=redistribute_on_refresh,
+            scale_factor=scale_factor,
+        )
+    with stage(instrumentation, "overview"):
+        overview = buyback_overview(
+            result=result, data=window_data, scale_factor=scale_factor
+        )
+    return result, [settings_record], [overview]
+
+
+def _run_task(task: tuple[Callable, dict]):
+    """Calls a `(function, kwargs)` task, module level so that it can be sent to worker processes."""
+    function, kwargs = task
+    return function(**kwargs)
+
+
+def _run_instrumented_task(task: tuple[Callable, dict]):
+    """Calls a `(function, kwargs)` task with an `Instrumentation` of its own, returning its report along with the
+    task's outputs so that the timings taken in a worker process reach the parent's instrumentation.
+    """
+    function, kwargs = task
+    instrumentation = Instrumentation()
+    return function(**kwargs, instrumentation=instrumentation), instrumentation.report()
+
+
+def run_tasks(
+    tasks, n_workers: int | None = None, instrumentation: Instrumentation | None = None
+) -> list:
+    """Runs `(function, kwargs)` tasks in order, or across a pool of `n_workers` processes if more than one worker is
+    requested. Outputs are always returned in the order of `tasks`, regardless of which worker finishes first. If
+    `instrumentation` is given it is passed to every task, whose functions must then take it.
+    """
+    if n_workers is None or n_workers <= 1:
+        if instrumentation is not None:
+            tasks = (
+                (function, dict(kwargs, instrumentation=instrumentation))
+                for function, kwargs in tasks
+            )
+        return [_run_task(task) for task in tasks]
+
+    tasks = list(tasks)
+    chunksize = max(1, len(tasks) // (4 * n_workers))
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        if instrumentation is None:
+            return list(executor.map(_run_task, tasks, chunksize=chunksize))
+        outputs = []
+        for output, report in executor.map(
+            _run_instrumented_task, tasks, chunksize=chunksize
+        ):
+            instrumentation.merge(report)
+            outputs.append(output)
+        return outputs
+
+
+def iter_tasks(
+    tasks, n_workers: int | None = None, instrumentation: Instrumentation | None = None
+) -> Iterator:
+    """Lazy equivalent of `run_tasks`, yielding the outputs in the order of `tasks` as they are done. Tasks are drawn
+    from `tasks` as they are needed and at most `4 * n_workers` are in flight at a time, so neither the tasks nor
+    their outputs pile up in memory.
+    """
+    if n_workers is None or n_workers <= 1:
+        for function, kwargs in tasks:
+            if instrumentation is not None:
+                kwargs = dict(kwargs, instrumentation=instrumentation)
+            yield _run_task((function, kwargs))
+        return
+
+    run = _run_task if instrumentation is None else _run_instrumented_task
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        pending = deque()
+        tasks = iter(tasks)
+        while True:
+            for task in tasks:
+                pending.append(executor.submit(run, task))
+                if len(pending) >= 4 * n_workers:
+                    break
+            if not pending:
+                return
+            output = pending.popleft().result()
+            if instrumentation is not None:
+                output, report = output
+                instrumentation.merge(report)
+            yield output
+
+
+def load_candle_pairs(
+    candles_path: Path,
+    invert_pair: bool = False,
+    pairs: list[tuple[str, str] | tuple[str, str, str]] | None = None,
+    start_time: datetime | None = None,
+    end_time: datetime | None = None,
+    granularity: int = DAILY,
+    instrumentation: Instrumentation | None = None,
+) -> list[pd.DataFrame]:
+    """Loads the candles of each asset pair of the candle store at `candles_path` (all of them unless `pairs` is
+    given) with `start_time` in [`start_time`, `end_time`), one DataFrame per pair sorted by `start_time`. Stored
+    pairs have the pair, time range and columns pushed down to the Parquet scan (see `load_candles`), so only the
+    matching partitions and row groups are read. Other pairs and granularities, including (asset1, asset2, via)
+    crosses and the asset2-asset1 inverses loaded with `invert_pair`, are derived once and cached by
+    `derived_candles`. The candles and (in memory) bytes loaded are counted by `instrumentation` if given.
+    """
+    if pairs is None:
+        pairs = candle_pairs(open_candles(candles_path), granularity=granularity)
+
+    data = []
+    for pair in pairs:
+        asset1, asset2, via = (*pair, None)[:3]
+        if invert_pair:
+            asset1, asset2 = asset2, asset1
+        if via is None and granularity in stored_granularities(
+            candles_path, asset1, asset2
+        ):
+            table = load_candles(
+                candles_path=candles_path,
+                asset1=asset1,
+                asset2=asset2,
+                granularity=granularity,
+                start_time=start_time,
+                end_time=end_time,
+            )
+        else:
+            table = derived_candles(
+                candles_path=candles_path,
+                asset1=asset1,
+                asset2=asset2,
+                granularity=granularity,
+                via=via,
+            )
+            in_range = time_filter(start_time=start_time, end_time=end_time)
+            if in_range is not None:
+                table = table.filter(in_range)
+        count(instrumentation, "candles_loaded", len(table))
+        count(instrumentation, "candle_bytes_read", table.nbytes)
+        if len(table):
+            data.append(table.to_pandas())
+    return data
+
+
+def pipeline_outputs(
+    outputs: Iterator[tuple[pa.Table, list[pa.RecordBatch], list[pa.RecordBatch]]],
+    identifiers: list[str],
+    db_path: Path,
+    writer: ResultWriter | None = None,
+    instrumentation: Instrumentation | None = None,
+    write_windows: int = 128,
+) -> list[str]:
+    """Writes the (results, settings, overviews) `outputs` of simulation tasks through `writer` as they are done, or
+    through a `BackgroundWriter` of its own flushing every `FLUSH_WINDOWS` runs, closed once the outputs end or fail.
+    A `writer` given is flushed (and waited for) instead, so every run is in the database once this returns. The
+    outputs are handed to the writer about `write_windows` runs at a time, as encoding them costs about the same for
+    one run as for many.
+
+    Returns:
+        list[str]: `identifiers`, the runs whose outputs can be read back from the database (see `analysis.run_filter`)
+    """
+    own_writer = writer is None
+    if own_writer:
+        writer = BackgroundWriter(
+            db_path, flush_windows=FLUSH_WINDOWS, instrumentation=instrumentation
+        )
+    pending = []  # outputs not handed to the writer yet
+    try:
+        for output in outputs:
+            pending.append(output)
+            if sum(len(settings) for _, settings, _ in pending) < write_windows:
+                continue
+            with stage(instrumentation, "save"):
+                write_outputs(writer, pending)
+            pending = []
+    finally:
+        with stage(instrumentation, "save"):
+            write_outputs(writer, pending)
+            if own_writer:
+                writer.close()
+            else:
+                writer.flush()
+                if isinstance(writer, BackgroundWriter):
+                    writer.wait()
+    return identifiers
+
+
+def write_outputs(
+    writer: ResultWriter,
+    outputs: list[tuple[pa.Table, list[pa.RecordBatch], list[pa.RecordBatch]]],
+) -> None:
+    """Hands the (results, settings, overviews) `outputs` of simulation tasks to `writer` at once."""
+    if not outputs:
+        return
+    writer.write(
+        results=pa.concat_tables([results for results, _, _ in outputs]),
+        settings=pa.Table.from_batches(
+            [batch for _, settings, _ in outputs for batch in settings],
+            schema=SCHEMA_SETTINGS,
+        ),
+        overviews=pa.Table.from_batches(
+            [batch for _, _, overviews in outputs for batch in overviews],
+            schema=SCHEMA_OVERVIEW,
+        ),
+    )
+
+
 def simple_buyback_sim(
     ratios: list,
     discounts: list,
@@ -458,103 +1724,201 @@ def simple_buyback_sim(
     refresh_amount: float,
     refresh_interval_days: int,
     sim_len_days: int,
-    step_days: int,
+    step_days: float,
     sim_start_price: float | None = None,
     redistribute_on_refresh: bool = False,
     invert_pair: bool = False,
     save_to_db: bool = False,
-):
+    batched: bool = False,
+    n_workers: int | None = None,
+    pairs: list[tuple[str, str] | tuple[str, str, str]] | None = None,
+    start_time: datetime | None = None,
+    end_time: datetime | None = None,
+    granularity: int = DAILY,
+    writer: ResultWriter | None = None,
+    reuse_results: bool | None = None,
+    instrumentation: Instrumentation | None = None,
+    pipeline: bool = False,
+) -> tuple[pa.Table, pa.Table, pa.Table] | list[str]:
+    """Simulates the ladder of `ratios` and `discounts` over every `sim_len_days` window of the candles of `pairs`
+    (all stored pairs by default), one starting every `step_days` (see `get_breakpoints`). The windows are simulated
+    one at a time, or all of a pair at once if `batched` (see `batch_simulate_pair`), spread across `n_workers`
+    processes if given (see `run_tasks`). Each run is identified by its settings and candles (see `run_identifier`).
+
+    With `save_to_db` the outputs are written to the database, buffered by `writer` if given so that successive
+    calls share files (see `ResultWriter`). With `reuse_results`, which defaults to `save_to_db`, the runs already
+    stored are read from the database instead of simulated. With `pipeline` the outputs are written as each task is
+    done rather than collected and returned, so memory doesn't grow with the number of windows. It requires
+    `save_to_db`, and the writer (`writer`, if given) is flushed before returning. Each stage is timed by
+    `instrumentation` if given.
+
+    Returns:
+        tuple[pa.Table, pa.Table, pa.Table] | list[str]: results, settings and overviews of every run, ordered by
+        asset pair and window, or with `pipeline` the identifiers of the runs, to read them back from the database
+        (see `analysis.run_filter`)
+    """
+    if pipeline and not save_to_db:
+        raise ValueError(
+            "`pipeline` writes the outputs to the database rather than returning them, it requires `save_to_db`"
+        )
+    if reuse_results is None:  # only read stored runs when writing to the database
+        reuse_results = save_to_db
     run_window = timedelta(days=sim_len_days)  # 4 month windows
     step_size = timedelta(days=step_days)
     refresh_interval = timedelta(days=refresh_interval_days)
     db_path = Path.cwd() / "buyback_rec/database"
     candles_path = db_path / "candlestick_data"
-    id_path = db_path / "sim_ids"
-    overviews_path = db_path / "overviews"
-    records_path = db_path / "sim_records"
-    candles = ds.dataset(candles_path)
-    df = (
-        candles.to_table()
-        .to_pandas()
-        .sort_values(by=["asset1", "asset2", "start_time"])
-    )
-    if invert_pair:
-        df.loc[:, ["low", "high", "open", "close"]] = (
-            1 / df.loc[:, ["high", "low", "open", "close"]].values  # swap high/low
+    with stage(instrumentation, "load_candles"):
+        data = load_candle_pairs(
+            candles_path=candles_path,
+            invert_pair=invert_pair,
+            pairs=pairs,
+            start_time=start_time,
+            end_time=end_time,
+            granularity=granularity,
+            instrumentation=instrumentation,
         )
-    pairs = df[["asset1", "asset2"]].drop_duplicates().values
 
-    data = []
-    settings = []
-    results = []
-    overviews = []
-    for asset1, asset2 in pairs:
-        in_pair = (df["asset1"] == asset1) & (df["asset2"] == asset2)
-        data.append(
-            df[in_pair].copy().sort_values(by=["start_time"]).reset_index(drop=True)
-        )
+    sim_kwargs = dict(
+        ratios=ratios,
+        discounts=discounts,
+        initial_allocation=initial_allocation,
+        refresh_amount=refresh_amount,
+        refresh_interval=refresh_interval,
+        run_window=run_window,
+        sim_start_price=sim_start_price,
+        redistribute_on_refresh=redistribute_on_refresh,
+    )
 
+    # identifiers are derived up front in window order, so they don't depend on how the runs are scheduled
+    pair_windows = []
+    identifiers = []
     for asset_pair in data:
-        break_indicies = get_breakpoints(
-            timestamps=asset_pair.start_time,
-            window_time=run_window,
-            step_time=step_size,
-        )
+        with stage(instrumentation, "breakpoints"):
+            break_indicies = get_breakpoints(
+                timestamps=asset_pair.start_time,
+                window_time=run_window,
+                step_time=step_size,
+            )
+        with stage(instrumentation, "identifiers"):
+            pair_identifiers = [
+                run_identifier(window_digest=digest, **sim_kwargs)
+                for digest in window_digests(asset_pair, break_indicies)
+            ]
+        pair_windows.append((asset_pair, break_indicies, pair_identifiers))
+        identifiers.extend(pair_identifiers)
 
-        for (
-            start,
-            stop,
-        ) in break_indicies:  # simulate a buyback startegy over each period
-            identifier = uuid4()
-            buyback = Buyback(
-                identifier=identifier,
-                ratios=ratios,
-                discounts=discounts,
-                amount_allocated=initial_allocation,
+    stored_results = SCHEMA_BUYBACK.empty_table()
+    stored_settings = SCHEMA_SETTINGS.empty_table()
+    stored_overviews = SCHEMA_OVERVIEW.empty_table()
+    stored = set()
+    # runs already in the database are read rather than simulated again
+    if reuse_results and pipeline:  # their outputs stay in the database
+        with stage(instrumentation, "load_stored"):
+            stored = stored_identifiers(
+                db_path=db_path, identifiers=identifiers, writer=writer
+            )
+    elif reuse_results:
+        with stage(instrumentation, "load_stored"):
+            stored_results, stored_settings, stored_overviews = load_runs(
+                db_path=db_path, identifiers=identifiers, writer=writer
             )
-            window_data = asset_pair.loc[start:stop, :].copy().reset_index(drop=True)
-            if sim_start_price is not None:
-                scale_factor = sim_start_price / window_data["open"].iloc[0]
-                window_data[["low", "high", "open", "close"]] = (
-                    window_data[["low", "high", "open", "close"]] * scale_factor
+        count(
+            instrumentation,
+            "stored_bytes_read",
+            stored_results.nbytes + stored_settings.nbytes + stored_overviews.nbytes,
+        )
+        stored = set(stored_settings["identifier"].to_pylist())
+    count(instrumentation, "stored_windows", len(stored))
+
+    def make_tasks():
+        for asset_pair, break_indicies, pair_identifiers in pair_windows:
+            new_windows = [
+                (window, identifier)
+                for window, identifier in zip(break_indicies, pair_identifiers)
+                if identifier not in stored
+            ]
+            if not new_windows:
+                continue
+            count(instrumentation, "windows", len(new_windows))
+            if batched:  # simulate all periods of the pair at once
+                yield batch_simulate_pair, dict(
+                    asset_pair=asset_pair,
+                    break_indicies=[window for window, _ in new_windows],
+                    identifiers=[identifier for _, identifier in new_windows],
+                    **sim_kwargs,
                 )
+                continue
 
-            start_price = window_data["open"].iloc[0]
-            settings_record = make_settings_record(
-                ratios=ratios,
-                discounts=discounts,
-                initial_allocations=initial_allocation,
-                refresh_amounts=refresh_amount,
-                refresh_intervals=refresh_interval,
-                run_duration=run_window,
-                asset1=asset_pair["asset1"].iloc[0],
-                asset2=asset_pair["asset2"].iloc[0],
-                redistribute_on_refresh=redistribute_on_refresh,
-                identifier=identifier,
-                start_price=start_price,
+            # simulate a buyback startegy over each period, on views of the pair's candles
+            pair_candles = candle_arrays(
+                asset_pair,
+                columns=[
+                    "asset1",
+                    "asset2",
+                    "start_time",
+                    "low",
+                    "high",
+                    "open",
+                    "close",
+                ],
             )
-            results.append(
-                buyback.simulate_buybacks(
-                    window_data,
-                    refresh_amounts=refresh_amount,
-                    refresh_intervals=refresh_interval,
-                    redistribute_on_refresh=redistribute_on_refresh,
+            for (start, stop), identifier in new_windows:
+                with stage(instrumentation, "windows"):
+                    window_data = pair_window(pair_candles, start, stop)
+                yield simulate_window, dict(
+                    window_data=window_data, identifier=identifier, **sim_kwargs
                 )
-            )
 
-            settings.append(settings_record)
-            overview = buyback_overview(result=results[-1], data=window_data)
-            overviews.append(overview)
+    if pipeline:
+        # the outputs of each task are handed to a background writer as they come rather than collected, so memory
+        # doesn't grow with the number of windows and a crash only loses the runs not flushed yet
+        return pipeline_outputs(
+            outputs=iter_tasks(
+                make_tasks(), n_workers=n_workers, instrumentation=instrumentation
+            ),
+            identifiers=identifiers,
+            db_path=db_path,
+            writer=writer,
+            instrumentation=instrumentation,
+        )
+
+    settings = []
+    results = []
+    overviews = []
+    for task_results, task_settings, task_overviews in run_tasks(
+        make_tasks(), n_workers=n_workers, instrumentation=instrumentation
+    ):
+        results.append(task_results)
+        settings.extend(task_settings)
+        overviews.extend(task_overviews)
 
-    results = pa.concat_tables(results)
-    settings = pa.Table.from_batches(settings)
-    overviews = pa.Table.from_batches(overviews)
+    with stage(instrumentation, "collect"):
+        results = pa.concat_tables(results) if results else SCHEMA_BUYBACK.empty_table()
+        settings = pa.Table.from_batches(settings, schema=SCHEMA_SETTINGS)
+        overviews = pa.Table.from_batches(overviews, schema=SCHEMA_OVERVIEW)
 
-    if save_to_db:
-        pq.write_to_dataset(table=results, root_path=records_path)
-        pq.write_to_dataset(table=overviews, root_path=overviews_path)
-        pq.write_to_dataset(table=settings, root_path=id_path)
+    if save_to_db:  # buffered by `writer` across runs if given
+        with stage(instrumentation, "save"):
+            save_results(
+                db_path=db_path,
+                results=results,
+                settings=settings,
+                overviews=overviews,
+                writer=writer,
+                instrumentation=instrumentation,
+            )
 
+    if stored:
+        with stage(instrumentation, "collect"):
+            results, settings, overviews = [
+                sort_runs(pa.concat_tables([new, old]), identifiers)
+                for new, old in [
+                    (results, stored_results),
+                    (settings, stored_settings),
+                    (overviews, stored_overviews),
+                ]
+            ]
     return results, settings, overviews
 
 
@@ -0,0 +1,193 @@
+import pyarrow as pa
+from pyarrow import compute as pc
+from pyarrow import dataset as ds
+from pyarrow import parquet as pq
+import datetime
+import os
+from pathlib import Path
+from uuid import uuid4
+from dtypes import SCHEMA_CANDLE, SCHEMA_CANDLE_COMPACT, SCHEMA_CANDLE_PARTITIONS
+
+DAILY = 86400  # granularity of the candles the simulations run on, in seconds
+CANDLE_PARTITIONING = ds.partitioning(SCHEMA_CANDLE_PARTITIONS, flavor="hive")
+
+
+def pair_key(asset1: str, asset2: str) -> str:
+    """Value of the `pair` partition of an asset pair."""
+    return f"{asset1}-{asset2}"
+
+
+def open_candles(candles_path: Path) -> ds.Dataset:
+    """Opens the candle store at `candles_path`, partitioned by pair, granularity and year (see `SCHEMA_CANDLE_PARTITIONS`).
+    Files written with the compact encodings (see `write_candles`) are read as SCHEMA_CANDLE like the others.
+    """
+    return ds.dataset(
+        candles_path,
+        schema=pa.unify_schemas([SCHEMA_CANDLE, SCHEMA_CANDLE_PARTITIONS]),
+        format="parquet",
+        partitioning=CANDLE_PARTITIONING,
+    )
+
+
+def time_filter(
+    start_time: datetime.datetime | None = None,
+    end_time: datetime.datetime | None = None,
+) -> pc.Expression | None:
+    """Builds the filter selecting candles with `start_time` in [`start_time`, `end_time`)."""
+    conditions = []
+    if start_time is not None:
+        conditions.append(
+            pc.field("start_time") >= pa.scalar(start_time, pa.timestamp("s"))
+        )
+    if end_time is not None:
+        conditions.append(
+            pc.field("start_time") < pa.scalar(end_time, pa.timestamp("s"))
+        )
+    return all_of(conditions)
+
+
+def all_of(conditions: list[pc.Expression]) -> pc.Expression | None:
+    if not conditions:
+        return None
+    expression = conditions[0]
+    for condition in conditions[1:]:
+        expression = expression & condition
+    return expression
+
+
+def candle_filter(
+    asset1: str | None = None,
+    asset2: str | None = None,
+    granularity: int | None = DAILY,
+    start_time: datetime.datetime | None = None,
+    end_time: datetime.datetime | None = None,
+) -> pc.Expression | None:
+    """Builds the filter selecting the candles of a pair and granularity with `start_time` in [`start_time`, `end_time`).
+    The pair, granularity and year conditions only involve partition fields, so the scan skips every other directory,
+    and the `start_time` bounds skip the row groups whose statistics fall outside of the range.
+    """
+    conditions = []
+    if asset1 is not None and asset2 is not None:
+        conditions.append(pc.field("pair") == pair_key(asset1, asset2))
+    if granularity is not None:
+        conditions.append(pc.field("granularity") == granularity)
+    if start_time is not None:
+        conditions.append(pc.field("year") >= start_time.year)
+    if end_time is not None:
+        last_second = end_time - datetime.timedelta(seconds=1)  # `end_time` is excluded
+        conditions.append(pc.field("year") <= last_second.year)
+    in_range = time_filter(start_time=start_time, end_time=end_time)
+    if in_range is not None:
+        conditions.append(in_range)
+    return all_of(conditions)
+
+
+def candle_pairs(
+    candles: ds.Dataset, granularity: int | None = DAILY
+) -> list[tuple[str, str]]:
+    """Gets the sorted (asset1, asset2) pairs of the store from its partition directories, without reading any data."""
+    pairs = set()
+    for fragment in candles.get_fragments(
+        filter=candle_filter(granularity=granularity)
+    ):
+        pair = ds.get_partition_keys(fragment.partition_expression)["pair"]
+        pairs.add(tuple(pair.split("-", 1)))
+    return sorted(pairs)
+
+
+def load_candles(
+    candles_path: Path,
+    asset1: str,
+    asset2: str,
+    granularity: int = DAILY,
+    start_time: datetime.datetime | None = None,
+    end_time: datetime.datetime | None = None,
+    columns: list[str] | None = None,
+) -> pa.Table:
+    """Reads the `columns` (all of SCHEMA_CANDLE by default) of the candles of a pair, with `start_time` in
+    [`start_time`, `end_time`), sorted by `start_time`. Only the matching directories and row groups are read.
+    """
+    if columns is None:
+        columns = SCHEMA_CANDLE.names
+    candles = open_candles(candles_path)
+    table = candles.to_table(
+        columns=columns,
+        filter=candle_filter(
+            asset1=asset1,
+            asset2=asset2,
+            granularity=granularity,
+            start_time=start_time,
+            end_time=end_time,
+        ),
+    )
+    return table.sort_by("start_time") if "start_time" in columns else table
+
+
+def write_candles(
+    table: pa.Table, candles_path: Path, granularity: int = DAILY
+) -> list[Path]:
+    """Appends candles (following SCHEMA_CANDLE) to the store, split into their pair and year directories, with their
+    asset columns dictionary encoded (SCHEMA_CANDLE_COMPACT). Each file is named after its first `start_time` so that
+    a partition's files list in time order. The files are first written to a staging directory, which datasets
+    ignore, and each is then moved into place as a whole, in time order. An interrupted write therefore never leaves a
+    partial file, nor a later candle without the earlier ones.
+
+    Returns:
+        list[Path]: the files added
+    """
+    table = (
+        table.select(SCHEMA_CANDLE.names)
+        .cast(SCHEMA_CANDLE)
+        .sort_by(
+            [
+                ("asset1", "ascending"),
+                ("asset2", "ascending"),
+                ("start_time", "ascending"),
+            ]
+        )
+    )
+    pairs = pc.binary_join_element_wise(table["asset1"], table["asset2"], "-")
+    years = pc.year(table["start_time"]).cast(pa.int16())
+    table = (
+        table.cast(SCHEMA_CANDLE_COMPACT)
+        .append_column("pair", pairs)
+        .append_column(
+            "granularity", pa.repeat(pa.scalar(granularity, pa.int32()), len(table))
+        )
+        .append_column("year", years)
+    )
+
+    candles_path = Path(candles_path)
+    staging_path = candles_path / f".staging-{uuid4()}"
+    first_time = table["start_time"][0].as_py()
+    written = []
+    ds.write_dataset(
+        table,
+        staging_path,
+        format="parquet",
+        partitioning=CANDLE_PARTITIONING,
+        basename_template=f"{first_time:%Y%m%dT%H%M%S}-{uuid4().hex[:8]}-{{i}}.parquet",
+        file_visitor=lambda written_file: written.append(Path(written_file.path)),
+    )
+    added = []
+    for path in sorted(written, key=lambda path: path.relative_to(staging_path).parts):
+        final_path = candles_path / path.relative_to(staging_path)
+        final_path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(path, final_path)
+        added.append(final_path)
+    for directory in sorted(staging_path.rglob("*"), reverse=True):
+        directory.rmdir()
+    staging_path.rmdir()
+    return added
+
+
+def partition_candles(
+    source_path: Path, candles_path: Path, granularity: int = DAILY
+) -> None:
+    """Copies flat candle files (one or more pairs per file, as written by earlier versions of `database_builder`)
+    into the partitioned store at `candles_path`, one source file at a time.
+    """
+    for path in sorted(Path(source_path).glob("*.parquet")):
+        write_candles(
+            pq.read_table(path), candles_path=candles_path, granularity=granularity
+        )
@@ -1,18 +1,30 @@
+import argparse
 import numpy as np
 import pyarrow as pa
+from pyarrow import compute as pc
+from pyarrow import dataset as ds
 from pyarrow import parquet as pq
 import pandas as pd
 import http.client
 import json
 import datetime
+import random
+import threading
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
 from dtypes import SCHEMA_CANDLE
-from time import sleep
+from candle_store import candle_filter, open_candles, write_candles
+from time import monotonic, sleep
 from pathlib import Path
 
-conn = http.client.HTTPSConnection("api.exchange.coinbase.com")
+host = "api.exchange.coinbase.com"
 res_agg_lim = 300  # most aggregations coinbase will return at once
 req_per_min_lim = 10  # says 10 per second, but that doesn't seem right for public API
-sleep_time = 60 / req_per_min_lim
+# default rate of `fetch_pairs` in requests per second, raise it with `rate` (or --rate) where the limit allows
+req_per_sec_lim = req_per_min_lim / 60
+max_retries = 5
+backoff_time = 1  # seconds before the first retry, doubled after each failed attempt
 payload = ""
 headers = {"Content-Type": "application/json", "User-Agent": "someone"}
 token = "BTC"
@@ -32,23 +44,102 @@ token2 = "USD"
 # -----Candles------
 granularity = 86400  # 1 day = 86400 s
 start_date = datetime.datetime(2017, 1, 1)
-end_date = datetime.datetime.now()
-start = start_date
-stop = min(
-    start + datetime.timedelta(seconds=(res_agg_lim - 1) * granularity), end_date
-)
-running_table = SCHEMA_CANDLE.empty_table()
-table_size_lim = 100 * 1024**2  # X MB in bytes
 database = Path.cwd() / "buyback_rec/database"
-while start < end_date:
-    conn.request(
-        "GET",
-        f"/products/{token}-{token2}/candles?start={start.isoformat()}&end={stop.isoformat()}&granularity={granularity}",
-        payload,
-        headers,
-    )
-    res = conn.getresponse()
-    res_data = res.read()
+candles_path = database / "candlestick_data"
+
+
+class TokenBucket:
+    """Thread-safe token bucket shared by every request to the API. It holds up to `capacity` tokens and is refilled
+    at `rate` tokens per second, each request takes a token and waits for one if the bucket is empty. It holds at
+    least one token by default, so rates under one request per second still let requests through.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = max(1.0, rate) if capacity is None else capacity
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+
+class RetryableError(Exception):
+    """A request failed in a way that may succeed when retried (rate limited, server error or dropped connection)."""
+
+
+def request_candles(
+    conn: http.client.HTTPConnection,
+    token: str,
+    token2: str,
+    start: datetime.datetime,
+    stop: datetime.datetime,
+    granularity: int,
+) -> bytes:
+    """Sends a single candles request, raising `RetryableError` if it should be tried again."""
+    try:
+        conn.request(
+            "GET",
+            f"/products/{token}-{token2}/candles?start={start.isoformat()}&end={stop.isoformat()}&granularity={granularity}",
+            payload,
+            headers,
+        )
+        res = conn.getresponse()
+        res_data = res.read()
+    except (OSError, http.client.HTTPException) as error:
+        conn.close()  # reconnects on the next request
+        raise RetryableError(str(error)) from error
+    if res.status == 429 or res.status >= 500:
+        raise RetryableError(f"{res.status} {res.reason}")
+    if res.status != 200:
+        raise RuntimeError(
+            f"Candles request for {token}-{token2} failed with {res.status} {res.reason}: {res_data[:200]}"
+        )
+    return res_data
+
+
+def fetch_candles(
+    conn: http.client.HTTPConnection,
+    token: str,
+    token2: str,
+    start: datetime.datetime,
+    stop: datetime.datetime,
+    granularity: int,
+    bucket: TokenBucket | None = None,
+) -> pa.Table:
+    """Requests one page of candles (at most `res_agg_lim`) between `start` and `stop`, sorted by `start_time`. Each
+    attempt first takes a token from `bucket`, and failed attempts are retried up to `max_retries` times with
+    exponential backoff.
+    """
+    for attempt in range(max_retries + 1):
+        if bucket is not None:
+            bucket.acquire()
+        try:
+            res_data = request_candles(
+                conn=conn,
+                token=token,
+                token2=token2,
+                start=start,
+                stop=stop,
+                granularity=granularity,
+            )
+            break
+        except RetryableError:
+            if attempt == max_retries:
+                raise
+            sleep(backoff_time * 2**attempt * (1 + random.random()))  # jittered
     json_obj = json.loads(res_data.decode("utf-8"))
 
     data = pd.DataFrame(
@@ -59,15 +150,173 @@ while start < end_date:
     data["asset2"] = token2
 
     table = pa.Table.from_pandas(data, preserve_index=False, schema=SCHEMA_CANDLE)
-    running_table = pa.concat_tables([running_table, table])
+    # coinbase returns each page newest first, the streaming simulation needs the candles in time order
+    return table.sort_by("start_time")
+
+
+def last_start_time(
+    candles_path: Path, token: str, token2: str, granularity: int = granularity
+) -> datetime.datetime | None:
+    """Gets the latest stored `start_time` of a pair, reading only that column of the pair's partition, or None if the
+    pair has no candles.
+    """
+    if not Path(candles_path).exists():
+        return None
+    candles = open_candles(candles_path)
+    if not candles.files:
+        return None
+    start_times = candles.to_table(
+        columns=["start_time"],
+        filter=candle_filter(asset1=token, asset2=token2, granularity=granularity),
+    )["start_time"]
+    last = pc.max(start_times).as_py()
+    return None if last is None else last.replace(tzinfo=None)
 
-    start = stop + datetime.timedelta(seconds=granularity)
-    stop = min(
-        start + datetime.timedelta(seconds=(res_agg_lim - 1) * granularity), end_date
+
+def update_candles(
+    conn: http.client.HTTPConnection,
+    token: str,
+    token2: str,
+    candles_path: Path = candles_path,
+    granularity: int = granularity,
+    start_date: datetime.datetime = start_date,
+    end_date: datetime.datetime | None = None,
+    bucket: TokenBucket | None = None,
+) -> int:
+    """Fetches the candles of a pair newer than the last one stored in `candles_path`, or from `start_date` if it has
+    none, up to `end_date` (naive UTC, as the stored start times, and the last closed candle by default). The pages
+    are buffered until their year is complete and then appended to the store together (see `write_candles`), so an
+    update adds a single file to each year partition rather than one per page. This checkpoints the update: the pages
+    buffered are written even if it fails, and an interrupted run resumes after the last candle written. Returns the
+    number of candles added. Requests are paced by `bucket`, by default one allowing `req_per_sec_lim` requests per
+    second.
+    """
+    if bucket is None:
+        bucket = TokenBucket(rate=req_per_sec_lim)
+    step = datetime.timedelta(seconds=granularity)
+    # the candle start times are naive UTC, whatever the timezone of the host
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    if end_date is None:
+        end_date = now
+    end_date = min(end_date, now - step)  # skip the open candle
+
+    start = start_date
+    last = last_start_time(
+        candles_path=candles_path, token=token, token2=token2, granularity=granularity
+    )
+    if last is not None:
+        start = max(start, last + step)
+    Path(candles_path).mkdir(parents=True, exist_ok=True)
+
+    n_added = 0
+    pending = []  # pages of the year being fetched, not written yet
+    try:
+        while start <= end_date:
+            stop = min(start + (res_agg_lim - 1) * step, end_date)
+            table = fetch_candles(
+                conn=conn,
+                token=token,
+                token2=token2,
+                start=start,
+                stop=stop,
+                granularity=granularity,
+                bucket=bucket,
+            )
+            if last is not None:  # never store a candle twice
+                table = table.filter(
+                    pc.field("start_time")
+                    > pa.scalar(last, SCHEMA_CANDLE.field("start_time").type)
+                )
+            if table.num_rows:
+                pending.append(table)
+                last = table["start_time"][-1].as_py().replace(tzinfo=None)
+                n_added += table.num_rows
+                if last.year > pending[0]["start_time"][0].as_py().year:
+                    # the earlier years are complete, only the candles of the latest one are kept buffered
+                    buffered = pa.concat_tables(pending)
+                    complete = pc.less(pc.year(buffered["start_time"]), last.year)
+                    write_candles(
+                        table=buffered.filter(complete),
+                        candles_path=candles_path,
+                        granularity=granularity,
+                    )
+                    pending = [buffered.filter(pc.invert(complete))]
+
+            start = stop + step
+    finally:
+        if pending:
+            write_candles(
+                table=pa.concat_tables(pending),
+                candles_path=candles_path,
+                granularity=granularity,
+            )
+    return n_added
+
+
+def fetch_pairs(
+    pairs: list[tuple[str, str]],
+    granularities: list[int] | None = None,
+    conn_factory: Callable[[], http.client.HTTPConnection] | None = None,
+    rate: float = req_per_sec_lim,
+    n_workers: int = 8,
+    candles_path: Path = candles_path,
+    start_date: datetime.datetime = start_date,
+    end_date: datetime.datetime | None = None,
+) -> dict[tuple[str, str, int], int]:
+    """Runs `update_candles` for every (pair, granularity) concurrently on `n_workers` threads, daily candles by
+    default. All requests share one `TokenBucket` of `rate` requests per second, so the throughput is set by the API
+    limit rather than by the latency of each request. The default `rate` is the conservative `req_per_sec_lim`, as
+    requests over the API limit are only retried `max_retries` times. Each (pair, granularity) is fetched in order on its own connection from `conn_factory`
+    (an HTTPS connection to `host` by default), which keeps its candles checkpointed in order.
+
+    Returns:
+        dict[tuple[str, str, int], int]: number of candles added for each (token, token2, granularity)
+    """
+    if granularities is None:
+        granularities = [granularity]
+    if conn_factory is None:
+        conn_factory = lambda: http.client.HTTPSConnection(host)
+    bucket = TokenBucket(rate=rate)
+
+    def update(token: str, token2: str, granularity: int) -> int:
+        conn = conn_factory()
+        try:
+            return update_candles(
+                conn=conn,
+                token=token,
+                token2=token2,
+                candles_path=candles_path,
+                granularity=granularity,
+                start_date=start_date,
+                end_date=end_date,
+                bucket=bucket,
+            )
+        finally:
+            conn.close()
+
+    jobs = [
+        (token, token2, granularity)
+        for (token, token2), granularity in product(pairs, granularities)
+    ]
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = {job: executor.submit(update, *job) for job in jobs}
+        return {job: future.result() for job, future in futures.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Fetches the candles of a pair newer than those stored."
+    )
+    parser.add_argument("--token", default=token)
+    parser.add_argument("--token2", default=token2)
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=req_per_sec_lim,
+        help=f"requests per second shared by every fetch, {req_per_sec_lim:.3g} by default",
     )
-    sleep(sleep_time)  # sleep to prevent over requesting from API
+    args = parser.parse_args()
 
-running_table = running_table.combine_chunks()
-pq.write_table(
-    running_table, (database / f"{token}-{token2}_candles.parquet").absolute()
-)
+    n_added = fetch_pairs(pairs=[(args.token, args.token2)], rate=args.rate)
+    for (token, token2, granularity), n_candles in n_added.items():
+        print(f"{token}-{token2} ({granularity} s): {n_candles} new candles")
@@ -0,0 +1,247 @@
+import numpy as np
+import pyarrow as pa
+from pyarrow import compute as pc
+from pyarrow import parquet as pq
+from pathlib import Path
+import hashlib
+import json
+import os
+import re
+from dtypes import SCHEMA_CANDLE, SCHEMA_CANDLE_COMPACT
+from candle_store import DAILY, candle_filter, open_candles, pair_key
+
+PRICE_COLUMNS = ["low", "high", "open", "close"]
+VERSION_DIGITS = 16  # hex digits of the recipe version in the name of a cached file
+
+
+def stored_granularities(candles_path: Path, asset1: str, asset2: str) -> list[int]:
+    """Gets the granularities stored for a pair, from the partition directories of the candle store."""
+    pair_dir = Path(candles_path) / f"pair={pair_key(asset1, asset2)}"
+    if not pair_dir.exists():
+        return []
+    return sorted(
+        int(path.name.split("=", 1)[1]) for path in pair_dir.glob("granularity=*")
+    )
+
+
+def plan_candles(
+    candles_path: Path,
+    asset1: str,
+    asset2: str,
+    granularity: int = DAILY,
+    via: str | None = None,
+) -> tuple:
+    """Plans how to obtain the candles of asset1-asset2 at `granularity` from the candle store. Stored candles are
+    used as they are, inverted if only asset2-asset1 is stored, and resampled from the coarsest stored granularity
+    that divides `granularity` if it isn't stored itself. With `via` the pair is the cross of asset1-via and
+    via-asset2, each planned the same way.
+
+    Returns:
+        tuple: nested recipe of ("load", asset1, asset2, granularity), ("invert", recipe), ("resample", recipe, granularity) and ("cross", recipe, recipe) steps
+    """
+    if via is not None:
+        return (
+            "cross",
+            plan_candles(candles_path, asset1, via, granularity),
+            plan_candles(candles_path, via, asset2, granularity),
+        )
+
+    direct = stored_granularities(candles_path, asset1, asset2)
+    inverse = stored_granularities(candles_path, asset2, asset1)
+    if granularity in direct:
+        return ("load", asset1, asset2, granularity)
+    if granularity in inverse:
+        return ("invert", ("load", asset2, asset1, granularity))
+
+    finer = [g for g in direct + inverse if g < granularity and granularity % g == 0]
+    if not finer:
+        raise ValueError(
+            f"No stored candles to derive {asset1}-{asset2} at {granularity} s from, give an intermediate asset with `via`"
+        )
+    source = max(finer)
+    if source in direct:
+        return ("resample", ("load", asset1, asset2, source), granularity)
+    return ("resample", ("invert", ("load", asset2, asset1, source)), granularity)
+
+
+def recipe_granularity(recipe: tuple) -> int:
+    """Gets the granularity of the candles produced by a recipe of `plan_candles`."""
+    if recipe[0] == "load":
+        return recipe[3]
+    if recipe[0] == "resample":
+        return recipe[2]
+    return recipe_granularity(recipe[1])
+
+
+def recipe_sources(candles_path: Path, recipe: tuple) -> list[Path]:
+    """Gets the candle store files read by a recipe of `plan_candles`."""
+    if recipe[0] == "load":
+        _, asset1, asset2, granularity = recipe
+        candles = open_candles(candles_path)
+        fragments = candles.get_fragments(
+            filter=candle_filter(asset1=asset1, asset2=asset2, granularity=granularity)
+        )
+        return [Path(fragment.path) for fragment in fragments]
+    return [
+        path
+        for step in recipe[1:]
+        if isinstance(step, tuple)
+        for path in recipe_sources(candles_path, step)
+    ]
+
+
+def recipe_version(candles_path: Path, recipe: tuple) -> str:
+    """Hashes a recipe together with the path, size and modification time of every file it reads, so the version
+    changes whenever candles are added to or rewritten in any of its sources.
+    """
+    digest = hashlib.sha256(json.dumps(recipe).encode())
+    for path in sorted(set(recipe_sources(candles_path, recipe))):
+        stat = os.stat(path)
+        digest.update(
+            f"{path.relative_to(candles_path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+        )
+    return digest.hexdigest()
+
+
+def invert_candles(table: pa.Table) -> pa.Table:
+    """Inverts the candles of asset1-asset2 into asset2-asset1. The high and low swap, and the volume (in asset1) is
+    converted to asset2 at the typical price of each candle.
+    """
+    typical_price = pc.divide(
+        pc.add(pc.add(table["high"], table["low"]), table["close"]), 3
+    )
+    columns = {
+        "asset1": table["asset2"],
+        "asset2": table["asset1"],
+        "start_time": table["start_time"],
+        "low": pc.divide(1, table["high"]),
+        "high": pc.divide(1, table["low"]),
+        "open": pc.divide(1, table["open"]),
+        "close": pc.divide(1, table["close"]),
+        "volume": pc.multiply(table["volume"], typical_price),
+    }
+    return pa.table(columns).cast(SCHEMA_CANDLE)
+
+
+def cross_candles(first: pa.Table, second: pa.Table, granularity: int) -> pa.Table:
+    """Derives asset1-asset3 from the asset1-asset2 candles `first` and asset2-asset3 candles `second` (both sorted by
+    `start_time` and of `granularity` seconds). Each candle of `first` is matched with the candle of `second` covering
+    its start time, so pairs whose candles open at different times of day are still crossed, and candles without a
+    match are dropped. The open and close are the products of the matched opens and closes, and the high and low the
+    products of the highs and lows, which bound the cross price within the candle. The volume is that of `first`, in
+    asset1.
+    """
+    first_times = first["start_time"].to_numpy()
+    second_times = second["start_time"].to_numpy().astype(first_times.dtype)
+    second_idxs = np.searchsorted(second_times, first_times, side="right") - 1
+    covered = (second_idxs >= 0) & (
+        first_times - second_times[second_idxs.clip(0)]
+        < np.timedelta64(granularity, "s")
+    )
+    first = first.filter(pa.array(covered))
+    second = second.take(second_idxs[covered])
+    columns = {
+        "asset1": first["asset1"],
+        "asset2": second["asset2"],
+        "start_time": first["start_time"],
+    }
+    for name in PRICE_COLUMNS:
+        columns[name] = pc.multiply(first[name], second[name])
+    columns["volume"] = first["volume"]
+    return pa.table(columns).cast(SCHEMA_CANDLE)
+
+
+def resample_candles(table: pa.Table, granularity: int) -> pa.Table:
+    """Resamples candles sorted by `start_time` to a coarser `granularity` (in seconds), with buckets aligned to the
+    Unix epoch. Each bucket opens at its first candle's open and closes at its last candle's close, takes the extreme
+    highs and lows and sums the volumes. Buckets at the edges of the data, or over gaps, may hold fewer candles.
+    """
+    if not len(table):
+        return table.cast(SCHEMA_CANDLE)
+    seconds = table["start_time"].cast(pa.timestamp("s")).cast(pa.int64()).to_numpy()
+    buckets = seconds // granularity * granularity
+    starts = np.flatnonzero(np.concatenate([[True], buckets[1:] != buckets[:-1]]))
+    ends = np.append(starts[1:], len(buckets)) - 1
+    arrays = {name: table[name].to_numpy() for name in PRICE_COLUMNS + ["volume"]}
+    columns = {
+        "asset1": table["asset1"].take(starts),
+        "asset2": table["asset2"].take(starts),
+        "start_time": pa.array(buckets[starts].astype("datetime64[s]")),
+        "low": np.minimum.reduceat(arrays["low"], starts),
+        "high": np.maximum.reduceat(arrays["high"], starts),
+        "open": arrays["open"][starts],
+        "close": arrays["close"][ends],
+        "volume": np.add.reduceat(arrays["volume"], starts),
+    }
+    return pa.table(columns).cast(SCHEMA_CANDLE)
+
+
+def run_recipe(candles_path: Path, recipe: tuple) -> pa.Table:
+    """Computes the candles of a recipe of `plan_candles`, sorted by `start_time`."""
+    step = recipe[0]
+    if step == "load":
+        _, asset1, asset2, granularity = recipe
+        candles = open_candles(candles_path)
+        table = candles.to_table(
+            columns=SCHEMA_CANDLE.names,
+            filter=candle_filter(asset1=asset1, asset2=asset2, granularity=granularity),
+        )
+        return table.sort_by("start_time").cast(SCHEMA_CANDLE)
+    if step == "invert":
+        return invert_candles(run_recipe(candles_path, recipe[1]))
+    if step == "resample":
+        return resample_candles(run_recipe(candles_path, recipe[1]), recipe[2])
+    if step == "cross":
+        return cross_candles(
+            first=run_recipe(candles_path, recipe[1]),
+            second=run_recipe(candles_path, recipe[2]),
+            granularity=recipe_granularity(recipe),
+        )
+    raise ValueError(f"Unknown recipe step {step}")
+
+
+def derived_candles(
+    candles_path: Path,
+    asset1: str,
+    asset2: str,
+    granularity: int = DAILY,
+    via: str | None = None,
+    cache_path: Path | None = None,
+) -> pa.Table:
+    """Gets the candles of asset1-asset2 at `granularity`, derived from the candle store as planned by `plan_candles`.
+    Candles stored as they are requested are read directly. Derived ones are materialized as Parquet in `cache_path`
+    (`derived_candles` next to the store by default), keyed by the recipe and the version of its source files (see
+    `recipe_version`). They are only recomputed once their sources change, and older versions are then removed.
+
+    Returns:
+        pa.Table: candles following SCHEMA_CANDLE, sorted by `start_time`
+    """
+    recipe = plan_candles(candles_path, asset1, asset2, granularity, via=via)
+    if recipe[0] == "load":
+        return run_recipe(candles_path, recipe)
+
+    if cache_path is None:
+        cache_path = Path(candles_path).parent / "derived_candles"
+    prefix = f"{pair_key(asset1, asset2)}_{granularity}"
+    if via is not None:
+        prefix = f"{prefix}_via-{via}"
+    path = (
+        Path(cache_path)
+        / f"{prefix}_{recipe_version(candles_path, recipe)[:VERSION_DIGITS]}.parquet"
+    )
+    if path.exists():
+        return pq.read_table(path, memory_map=True).cast(SCHEMA_CANDLE)
+
+    table = run_recipe(candles_path, recipe)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    pq.write_table(table.cast(SCHEMA_CANDLE_COMPACT), tmp_path)
+    os.replace(tmp_path, path)
+    # only older versions of this very file, not e.g. those of a cross with the same prefix
+    version_name = re.compile(
+        rf"{re.escape(prefix)}_[0-9a-f]{{{VERSION_DIGITS}}}\.parquet"
+    )
+    for stale_path in path.parent.glob(f"{prefix}_*.parquet"):
+        if stale_path != path and version_name.fullmatch(stale_path.name):
+            stale_path.unlink()
+    return table
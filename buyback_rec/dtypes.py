@@ -11,6 +11,12 @@ candle = [
     ("volume", pa.float32()),
 ]
 
+candle_partitions = [
+    ("pair", pa.string()),  # "{asset1}-{asset2}"
+    ("granularity", pa.int32()),  # candle duration in seconds
+    ("year", pa.int16()),  # year of the candle's `start_time`
+]  # directories of the candle store, e.g. `pair=BTC-USD/granularity=86400/year=2021`
+
 
 buyback = [
     ("identifier", pa.string()),  # identifier for the buyback run
@@ -145,10 +151,38 @@ settings = [
 
 
 SCHEMA_CANDLE = pa.schema(candle)
+SCHEMA_CANDLE_PARTITIONS = pa.schema(candle_partitions)
 SCHEMA_BUYBACK = pa.schema(buyback)
 SCHEMA_OVERVIEW = pa.schema(overview)
 SCHEMA_SETTINGS = pa.schema(settings)
 
+# -------Compact storage------
+# strings repeated across rows (identifiers and assets) are stored dictionary encoded, and the SCHEMA_BUYBACK columns
+# that are the same on every row of a run are stored once in its settings row
+compact_string = pa.dictionary(pa.int32(), pa.string())
+run_constants = [
+    ("start_time", pa.timestamp("s")),
+    ("start_price", pa.float32()),
+]  # `start_price` is already in the settings, `start_time` is added to them
+
+
+def compact_fields(fields: list[tuple], drop: tuple[str, ...] = ()) -> list[tuple]:
+    """Gets the compact storage fields of `fields`, with string columns dictionary encoded and the columns named in
+    `drop` left out. `fields` and `drop` are only read, so a default can be shared across calls."""
+    return [
+        (name, compact_string if dtype == pa.string() else dtype)
+        for name, dtype in fields
+        if name not in drop
+    ]
+
+
+SCHEMA_CANDLE_COMPACT = pa.schema(compact_fields(candle))
+SCHEMA_BUYBACK_COMPACT = pa.schema(
+    compact_fields(buyback, drop=tuple(name for name, _ in run_constants))
+)
+SCHEMA_OVERVIEW_COMPACT = pa.schema(compact_fields(overview))
+SCHEMA_SETTINGS_COMPACT = pa.schema(compact_fields(settings) + run_constants[:1])
+
 if __name__ == "__main__":
     print(SCHEMA_BUYBACK)
     print(SCHEMA_SETTINGS)
@@ -0,0 +1,76 @@
+import time
+from collections import defaultdict
+from collections.abc import Callable
+from contextlib import contextmanager, nullcontext
+
+
+class Instrumentation:
+    """Collects the time spent in each stage of a simulation (e.g. candle loading, window copying, simulation, overview
+    generation and writes) and counters of its events (e.g. windows, fills, refreshes and bytes read and written).
+    Every stage timed and count added is also passed to `hook`, if given, as `hook(kind, name, value)` with `kind`
+    "stage" (`value` in seconds) or "count", e.g. to forward them to a logger or a metrics client. Stages may be nested,
+    e.g. "write_files" is timed within "save".
+
+    Functions taking an `instrumentation` do nothing more than a None check per stage when it is left as None (see
+    `stage` and `count`).
+    """
+
+    def __init__(self, hook: Callable[[str, str, float], None] | None = None):
+        self.hook = hook
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+
+    @contextmanager
+    def stage(self, name: str):
+        """Times the code run within the context as stage `name`, adding up the time of every call."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name: str, seconds: float, calls: int = 1) -> None:
+        self.seconds[name] += seconds
+        self.calls[name] += calls
+        if self.hook is not None:
+            self.hook("stage", name, seconds)
+
+    def count(self, name: str, value: int = 1) -> None:
+        self.counters[name] += value
+        if self.hook is not None:
+            self.hook("count", name, value)
+
+    def report(self) -> dict[str, dict]:
+        """Gets the stages, with their total time and number of calls, and the counters collected so far.
+
+        Returns:
+            dict[str, dict]: {"stages": {name: {"seconds": float, "calls": int}}, "counters": {name: int}}
+        """
+        return {
+            "stages": {
+                name: {"seconds": seconds, "calls": self.calls[name]}
+                for name, seconds in self.seconds.items()
+            },
+            "counters": dict(self.counters),
+        }
+
+    def merge(self, report: dict[str, dict]) -> None:
+        """Adds the `report` of another instrumentation, e.g. one collected in a worker process."""
+        for name, stage_report in report["stages"].items():
+            self.add_time(name, stage_report["seconds"], calls=stage_report["calls"])
+        for name, value in report["counters"].items():
+            self.count(name, value)
+
+
+def stage(instrumentation: Instrumentation | None, name: str):
+    """Times stage `name` with `instrumentation`, or does nothing if it is None."""
+    if instrumentation is None:
+        return nullcontext()
+    return instrumentation.stage(name)
+
+
+def count(instrumentation: Instrumentation | None, name: str, value: int = 1) -> None:
+    """Adds `value` to the counter `name` of `instrumentation`, or does nothing if it is None."""
+    if instrumentation is not None:
+        instrumentation.count(name, value)
@@ -0,0 +1,534 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import hashlib
+import json
+from functools import partial
+from collections.abc import Callable
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from dtypes import SCHEMA_BUYBACK, SCHEMA_OVERVIEW, SCHEMA_SETTINGS
+from candle_store import DAILY, load_candles
+from buyback_sim import (
+    PRICE_STATISTICS,
+    batch_simulate_buybacks,
+    candle_arrays,
+    decode_metadata,
+    grouped_buyback_overview,
+    make_settings_record,
+    price_statistics_from_sums,
+    run_identifier,
+)
+from instrumentation import Instrumentation, count, stage
+from result_store import ResultWriter
+
+HOURLY = 3600
+START_TIME = datetime(2021, 1, 1)  # start of the simulated paths, unless given
+
+
+@dataclass
+class PricePaths:
+    """Candles of a batch of simulated price paths, every price column a contiguous (path x candle) array. All paths
+    share the candle start times `start_times`. Each path is identified by its `digests` entry, which stands in for the
+    window digest of historical candles (see `buyback_sim.window_digests`) when deriving run identifiers.
+    """
+
+    start_times: np.ndarray
+    opens: np.ndarray
+    highs: np.ndarray
+    lows: np.ndarray
+    closes: np.ndarray
+    digests: list[str]
+    asset1: str = "SYN"
+    asset2: str = "USD"
+
+    def __len__(self) -> int:
+        return len(self.opens)
+
+    @property
+    def duration(self) -> np.timedelta64:
+        return self.start_times[-1] - self.start_times[0]
+
+
+def path_digests(model: dict, n_paths: int) -> list[str]:
+    """Hashes the settings `model` of a generator, seed included, along with the index of each of its `n_paths` paths."""
+    model = json.dumps(model, sort_keys=True, default=str)
+    return [
+        hashlib.sha256(f"{model}:{p_idx}".encode()).hexdigest()
+        for p_idx in range(n_paths)
+    ]
+
+
+def candle_times(
+    n_candles: int, granularity: int, start_time: datetime | None = None
+) -> np.ndarray:
+    if start_time is None:
+        start_time = START_TIME
+    return np.datetime64(start_time, "s") + np.arange(n_candles) * np.timedelta64(
+        granularity, "s"
+    )
+
+
+def log_return_candles(
+    log_returns: np.ndarray,
+    variances: np.ndarray | float,
+    start_price: float,
+    rng: np.random.Generator,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Builds (path x candle) opens, highs, lows and closes from the log return of each candle, each candle opening at
+    the previous close. The high and low are drawn from the extremes of a Brownian bridge from the open to the close
+    with the candle's variance (of the log price), so each follows its exact distribution given the open and close.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: opens, highs, lows and closes
+    """
+    log_opens = np.empty_like(log_returns)
+    log_opens[:, 0] = np.log(start_price)
+    np.cumsum(log_returns[:, :-1], axis=1, out=log_opens[:, 1:])
+    log_opens[:, 1:] += np.log(start_price)
+
+    def extreme_spread() -> np.ndarray:
+        # 1 - U is in (0, 1], so the logarithm is finite
+        return np.sqrt(
+            log_returns**2 - 2 * variances * np.log1p(-rng.random(log_returns.shape))
+        )
+
+    highs = np.exp(log_opens + (log_returns + extreme_spread()) / 2)
+    lows = np.exp(log_opens + (log_returns - extreme_spread()) / 2)
+    closes = np.exp(log_opens + log_returns)
+    return np.exp(log_opens), highs, lows, closes
+
+
+def gbm_paths(
+    n_paths: int,
+    n_candles: int,
+    granularity: int = HOURLY,
+    start_price: float = 1.0,
+    daily_drift: float = 0.0,
+    daily_volatility: float = 0.05,
+    seed: int | list[int] = 0,
+    start_time: datetime | None = None,
+) -> PricePaths:
+    """Generates `n_paths` geometric Brownian motion paths of `n_candles` candles of `granularity` seconds, with the
+    given drift and volatility of the daily log return.
+    """
+    rng = np.random.default_rng(seed)
+    step_fraction = granularity / DAILY
+    step_variance = daily_volatility**2 * step_fraction
+    log_returns = rng.normal(
+        daily_drift * step_fraction - step_variance / 2,
+        np.sqrt(step_variance),
+        (n_paths, n_candles),
+    )
+    opens, highs, lows, closes = log_return_candles(
+        log_returns=log_returns,
+        variances=step_variance,
+        start_price=start_price,
+        rng=rng,
+    )
+    model = dict(
+        model="gbm",
+        n_candles=n_candles,
+        granularity=granularity,
+        start_price=start_price,
+        daily_drift=daily_drift,
+        daily_volatility=daily_volatility,
+        seed=seed,
+        start_time=start_time,
+    )
+    return PricePaths(
+        start_times=candle_times(n_candles, granularity, start_time),
+        opens=opens,
+        highs=highs,
+        lows=lows,
+        closes=closes,
+        digests=path_digests(model, n_paths),
+    )
+
+
+def regime_switching_paths(
+    n_paths: int,
+    n_candles: int,
+    granularity: int = HOURLY,
+    start_price: float = 1.0,
+    daily_volatilities: tuple[float, ...] = (0.03, 0.12),
+    regime_days: tuple[float, ...] = (60, 15),
+    daily_drifts: tuple[float, ...] | None = None,
+    seed: int | list[int] = 0,
+    start_time: datetime | None = None,
+) -> PricePaths:
+    """Generates `n_paths` paths of `n_candles` candles of `granularity` seconds switching between volatility regimes,
+    a geometric Brownian motion with the daily volatility (and drift) of the current regime. Each regime lasts
+    `regime_days` on average (a Markov chain leaving it with the same probability at every candle) and is followed by
+    any of the others with equal probability. Paths start in each regime in proportion to its average duration.
+    """
+    rng = np.random.default_rng(seed)
+    n_regimes = len(daily_volatilities)
+    if daily_drifts is None:
+        daily_drifts = (0.0,) * n_regimes
+    step_fraction = granularity / DAILY
+    leave = np.minimum(step_fraction / np.asarray(regime_days, dtype=np.float64), 1)
+
+    # the chain is advanced one candle at a time over all paths, held (candle x path) so that each step is contiguous
+    regimes = np.empty((n_candles, n_paths), dtype=np.int8)
+    regimes[0] = rng.choice(
+        n_regimes, n_paths, p=np.divide(regime_days, sum(regime_days))
+    )
+    draws = rng.random((n_candles, n_paths))
+    shifts = rng.integers(1, max(n_regimes, 2), (n_candles, n_paths), dtype=np.int8)
+    for c_idx in range(1, n_candles):
+        previous = regimes[c_idx - 1]
+        regimes[c_idx] = np.where(
+            draws[c_idx] < leave[previous],
+            (previous + shifts[c_idx]) % n_regimes,
+            previous,
+        )
+    regimes = np.ascontiguousarray(regimes.T)
+
+    step_variances = (np.asarray(daily_volatilities) ** 2 * step_fraction)[regimes]
+    step_drifts = np.asarray(daily_drifts) * step_fraction
+    log_returns = rng.standard_normal((n_paths, n_candles))
+    log_returns *= np.sqrt(step_variances)
+    log_returns += step_drifts[regimes] - step_variances / 2
+    opens, highs, lows, closes = log_return_candles(
+        log_returns=log_returns,
+        variances=step_variances,
+        start_price=start_price,
+        rng=rng,
+    )
+    model = dict(
+        model="regime_switching",
+        n_candles=n_candles,
+        granularity=granularity,
+        start_price=start_price,
+        daily_volatilities=list(daily_volatilities),
+        regime_days=list(regime_days),
+        daily_drifts=list(daily_drifts),
+        seed=seed,
+        start_time=start_time,
+    )
+    return PricePaths(
+        start_times=candle_times(n_candles, granularity, start_time),
+        opens=opens,
+        highs=highs,
+        lows=lows,
+        closes=closes,
+        digests=path_digests(model, n_paths),
+    )
+
+
+def bootstrap_paths(
+    history: pd.DataFrame | pa.Table,
+    n_paths: int,
+    n_candles: int,
+    block_candles: int = 30,
+    start_price: float = 1.0,
+    seed: int | list[int] = 0,
+    start_time: datetime | None = None,
+) -> PricePaths:
+    """Generates `n_paths` paths of `n_candles` candles by a moving block bootstrap of the candles of `history`, e.g.
+    of INDY-ADA: blocks of `block_candles` consecutive historical candles, starting at random, are chained end to end.
+    Every candle keeps the shape of its historical counterpart relative to the previous close (its opening gap, and
+    its high, low and close relative to its open), so the returns keep their distribution and, within blocks, their
+    autocorrelation and volatility clustering. The paths have the granularity of `history`.
+    """
+    candles = candle_arrays(
+        history, columns=["start_time", "open", "high", "low", "close"]
+    )
+    opens, highs, lows, closes = [
+        candles[name].astype(np.float64) for name in ["open", "high", "low", "close"]
+    ]
+    # the first historical candle has no previous close, so only the others are drawn
+    n_moves = len(opens) - 1
+    if n_moves < block_candles:
+        raise ValueError(
+            f"The history has {len(opens)} candles, too few for blocks of {block_candles}"
+        )
+    gaps = np.log(opens[1:] / closes[:-1])
+    bodies = np.log(closes[1:] / opens[1:])
+    high_moves = np.log(highs[1:] / opens[1:])
+    low_moves = np.log(lows[1:] / opens[1:])
+
+    rng = np.random.default_rng(seed)
+    n_blocks = -(-n_candles // block_candles)
+    block_starts = rng.integers(0, n_moves - block_candles + 1, (n_paths, n_blocks))
+    idxs = (block_starts[:, :, np.newaxis] + np.arange(block_candles)).reshape(
+        n_paths, -1
+    )[:, :n_candles]
+    path_bodies = bodies[idxs]
+    moves = gaps[idxs]  # from the previous close to the open
+    moves[:, 0] = 0  # the paths open at `start_price`
+    moves[:, 1:] += path_bodies[:, :-1]
+    path_opens = start_price * np.exp(np.cumsum(moves, axis=1))
+
+    granularity = int(
+        np.median(np.diff(candles["start_time"])) / np.timedelta64(1, "s")
+    )
+    history_digest = hashlib.sha256()
+    for values in [
+        candles["start_time"].astype("datetime64[s]"),
+        opens,
+        closes,
+        highs,
+        lows,
+    ]:
+        history_digest.update(np.ascontiguousarray(values).tobytes())
+    model = dict(
+        model="block_bootstrap",
+        history=history_digest.hexdigest(),
+        n_candles=n_candles,
+        block_candles=block_candles,
+        start_price=start_price,
+        seed=seed,
+        start_time=start_time,
+    )
+    return PricePaths(
+        start_times=candle_times(n_candles, granularity, start_time),
+        opens=path_opens,
+        highs=path_opens * np.exp(high_moves[idxs]),
+        lows=path_opens * np.exp(low_moves[idxs]),
+        closes=path_opens * np.exp(path_bodies),
+        digests=path_digests(model, n_paths),
+    )
+
+
+def path_price_statistics(paths: PricePaths) -> np.ndarray:
+    """Gets the `get_price_statistics` of every path from sums over its candles (see `price_statistics_from_sums`).
+
+    Returns:
+        np.ndarray: (path x statistic) array with the columns of `PRICE_STATISTICS`
+    """
+    n_paths, n_candles = paths.opens.shape
+    days = (paths.start_times - paths.start_times[0]) / np.timedelta64(1, "D")
+    # prices are taken relative to each path's first open to keep the sums small
+    offsets = paths.opens[:, :1]
+    candle_sums = np.zeros((n_paths, n_candles))
+    candle_squares = np.zeros((n_paths, n_candles))
+    for prices in [paths.opens, paths.closes, paths.highs, paths.lows]:
+        relative = prices - offsets
+        candle_sums += relative
+        candle_squares += relative**2
+    return price_statistics_from_sums(
+        n_prices=np.full(n_paths, 4 * n_candles),
+        sum_days=np.full(n_paths, 4 * days.sum()),
+        sum_days_sq=np.full(n_paths, 4 * (days**2).sum()),
+        sum_prices=candle_sums.sum(axis=1),
+        sum_prices_sq=candle_squares.sum(axis=1),
+        sum_days_prices=candle_sums @ days,
+        offset=offsets[:, 0],
+        start_prices=paths.opens[:, 0],
+        final_prices=paths.closes[:, -1],
+    )
+
+
+def simulate_paths(
+    paths: PricePaths,
+    ratios: list,
+    discounts: list,
+    initial_allocation: float,
+    refresh_amount: float,
+    refresh_interval: timedelta,
+    redistribute_on_refresh: bool = False,
+    instrumentation: Instrumentation | None = None,
+) -> tuple[pa.Table, pa.Table, pa.Table]:
+    """Simulates a buyback ladder over every path of `paths` at once with `batch_simulate_buybacks`, straight from
+    their arrays: the start times shared by the paths are broadcast rather than copied, and no DataFrame is built.
+    Each path is a run whose identifier is derived from its digest (see `buyback_sim.run_identifier`). Each stage is
+    timed by `instrumentation` if given.
+
+    Returns:
+        tuple[pa.Table, pa.Table, pa.Table]: results, settings and overviews of the runs
+    """
+    identifiers = [
+        run_identifier(
+            window_digest=digest,
+            ratios=ratios,
+            discounts=discounts,
+            initial_allocation=initial_allocation,
+            refresh_amount=refresh_amount,
+            refresh_interval=refresh_interval,
+            run_window=paths.duration,
+            redistribute_on_refresh=redistribute_on_refresh,
+        )
+        for digest in paths.digests
+    ]
+    with stage(instrumentation, "simulate"):
+        results = batch_simulate_buybacks(
+            identifiers=identifiers,
+            ratios=ratios,
+            discounts=discounts,
+            amount_allocated=initial_allocation,
+            start_times=np.broadcast_to(paths.start_times, paths.opens.shape),
+            opens=paths.opens,
+            lows=paths.lows,
+            refresh_amounts=refresh_amount,
+            refresh_intervals=refresh_interval,
+            redistribute_on_refresh=redistribute_on_refresh,
+            instrumentation=instrumentation,
+        )
+
+    with stage(instrumentation, "settings"):
+        settings = pa.Table.from_batches(
+            [
+                make_settings_record(
+                    ratios=ratios,
+                    discounts=discounts,
+                    initial_allocations=initial_allocation,
+                    refresh_amounts=refresh_amount,
+                    refresh_intervals=refresh_interval,
+                    run_duration=paths.duration,
+                    asset1=paths.asset1,
+                    asset2=paths.asset2,
+                    redistribute_on_refresh=redistribute_on_refresh,
+                    start_price=paths.opens[0, 0],
+                )
+            ]
+        ).take(np.zeros(len(paths), dtype=np.int64))
+        for name, values in [
+            ("identifier", identifiers),
+            ("start_price", paths.opens[:, 0]),
+        ]:
+            settings = settings.set_column(
+                SCHEMA_SETTINGS.get_field_index(name),
+                SCHEMA_SETTINGS.field(name),
+                pa.array(values, type=SCHEMA_SETTINGS.field(name).type),
+            )
+
+    with stage(instrumentation, "overview"):
+        metadata = decode_metadata(results.schema.metadata)
+        overviews = grouped_buyback_overview(
+            result=results,
+            ratios=metadata["ratios"],
+            discounts=metadata["discounts"],
+            price_statistics=pd.DataFrame(
+                path_price_statistics(paths),
+                index=identifiers,
+                columns=PRICE_STATISTICS,
+            ),
+        )
+    return results, settings, pa.Table.from_batches([overviews])
+
+
+def monte_carlo_buyback_sim(
+    generate: Callable[..., PricePaths],
+    n_paths: int,
+    ratios: list,
+    discounts: list,
+    initial_allocation: float,
+    refresh_amount: float,
+    refresh_interval_days: int,
+    redistribute_on_refresh: bool = False,
+    chunk_paths: int = 1000,
+    seed: int = 0,
+    save_to_db: bool = False,
+    writer: ResultWriter | None = None,
+    instrumentation: Instrumentation | None = None,
+) -> tuple[pa.Table, pa.Table, pa.Table]:
+    """Simulates a buyback ladder over `n_paths` simulated price paths, the Monte Carlo counterpart of
+    `simple_buyback_sim`. The paths are drawn by `generate`, one of `gbm_paths`, `regime_switching_paths` or
+    `bootstrap_paths` with its other arguments bound (e.g. with `functools.partial`), called as
+    `generate(n_paths=..., seed=[seed, chunk index])` for chunks of up to `chunk_paths` paths, so that only one chunk of
+    candles is held at a time. The paths are therefore the same for a given `seed` and `chunk_paths`. Each chunk is
+    simulated by `simulate_paths`, and written to the database if `save_to_db` is set, buffered by `writer` (or by a
+    writer of its own closed at the end).
+
+    Returns:
+        tuple[pa.Table, pa.Table, pa.Table]: results, settings and overviews of all paths
+    """
+    if save_to_db and writer is None:
+        db_path = Path.cwd() / "buyback_rec/database"
+        with ResultWriter(db_path, instrumentation=instrumentation) as writer:
+            return monte_carlo_buyback_sim(
+                generate=generate,
+                n_paths=n_paths,
+                ratios=ratios,
+                discounts=discounts,
+                initial_allocation=initial_allocation,
+                refresh_amount=refresh_amount,
+                refresh_interval_days=refresh_interval_days,
+                redistribute_on_refresh=redistribute_on_refresh,
+                chunk_paths=chunk_paths,
+                seed=seed,
+                save_to_db=save_to_db,
+                writer=writer,
+                instrumentation=instrumentation,
+            )
+
+    outputs = {"results": [], "settings": [], "overviews": []}
+    for c_idx, chunk_start in enumerate(range(0, n_paths, chunk_paths)):
+        with stage(instrumentation, "generate"):
+            paths = generate(
+                n_paths=min(chunk_paths, n_paths - chunk_start), seed=[seed, c_idx]
+            )
+        count(instrumentation, "paths", len(paths))
+        results, settings, overviews = simulate_paths(
+            paths=paths,
+            ratios=ratios,
+            discounts=discounts,
+            initial_allocation=initial_allocation,
+            refresh_amount=refresh_amount,
+            refresh_interval=timedelta(days=refresh_interval_days),
+            redistribute_on_refresh=redistribute_on_refresh,
+            instrumentation=instrumentation,
+        )
+        if save_to_db:
+            with stage(instrumentation, "save"):
+                writer.write(results=results, settings=settings, overviews=overviews)
+        for name, table in [
+            ("results", results),
+            ("settings", settings),
+            ("overviews", overviews),
+        ]:
+            outputs[name].append(table)
+
+    with stage(instrumentation, "collect"):
+        return tuple(
+            pa.concat_tables([schema.empty_table()] + outputs[name])
+            for name, schema in [
+                ("results", SCHEMA_BUYBACK),
+                ("settings", SCHEMA_SETTINGS),
+                ("overviews", SCHEMA_OVERVIEW),
+            ]
+        )
+
+
+if __name__ == "__main__":
+    history = load_candles(
+        Path.cwd() / "buyback_rec/database/candlestick_data",
+        asset1="INDY",
+        asset2="ADA",
+        granularity=DAILY,
+    )
+    generators = {
+        "gbm": partial(gbm_paths, n_candles=365 * 24, granularity=HOURLY),
+        "regime_switching": partial(
+            regime_switching_paths, n_candles=365 * 24, granularity=HOURLY
+        ),
+        "bootstrap INDY-ADA": partial(bootstrap_paths, history=history, n_candles=365),
+    }
+    for name, generate in generators.items():
+        instrumentation = Instrumentation()
+        results, settings, overviews = monte_carlo_buyback_sim(
+            generate=generate,
+            n_paths=10_000,
+            ratios=[0.4, 0.3, 0.2, 0.1],
+            discounts=[0, 23.6, 38.2, 61.8],
+            initial_allocation=100_000,
+            refresh_amount=10_000,
+            refresh_interval_days=5,
+            redistribute_on_refresh=True,
+            instrumentation=instrumentation,
+        )
+        seconds = sum(
+            stage_report["seconds"]
+            for stage_report in instrumentation.report()["stages"].values()
+        )
+        print(
+            f"{name}: {len(settings)} paths, {results.num_rows} buybacks in {seconds:.1f} s,",
+            "mean final return",
+            overviews.group_by("identifier")
+            .aggregate([("end_running_return", "max")])["end_running_return_max"]
+            .to_numpy()
+            .mean(),
+        )
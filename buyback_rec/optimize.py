@@ -0,0 +1,393 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from collections.abc import Callable
+from datetime import datetime, timedelta
+from functools import partial
+from pathlib import Path
+from buyback_sim import (
+    PRICE_STATISTICS,
+    get_breakpoints,
+    grouped_buyback_overview,
+    history_table,
+    load_candle_pairs,
+    rolling_price_statistics,
+    run_tasks,
+)
+from dtypes import SCHEMA_OVERVIEW
+from sweep import get_sweep_configs, simulate_sweep_pair
+
+
+def ladder_objective(
+    overviews: pd.DataFrame,
+    identifiers: pd.Index,
+    run_duration: timedelta,
+    delay_penalty: float = 0.0,
+) -> np.ndarray:
+    """Scores the runs `identifiers` from their SCHEMA_OVERVIEW rows `overviews`, by their `end_running_return` less
+    `delay_penalty` per day of the ratio-weighted mean fill delay of their discounts. Discounts never filled count as
+    waiting the whole `run_duration`, and runs without any buyback (which have no overview rows) as a return of 1,
+    the funds keeping their value.
+
+    Returns:
+        np.ndarray: score of each run of `identifiers`, higher is better
+    """
+    run_days = run_duration / timedelta(days=1)
+    by_run = overviews.groupby("identifier", sort=False)
+    returns = by_run["end_running_return"].first().reindex(identifiers).fillna(1.0)
+    delays = (overviews["delay_mean"] / pd.Timedelta(days=1)).fillna(run_days)
+    mean_delays = (
+        (delays * overviews["ratio"])
+        .groupby(overviews["identifier"], sort=False)
+        .sum()
+        .reindex(identifiers)
+        .fillna(run_days)
+    )
+    return (returns - delay_penalty * mean_delays).to_numpy(dtype=np.float64)
+
+
+def sample_ladders(
+    rng: np.random.Generator,
+    n_ladders: int,
+    n_discounts: int,
+    max_discount: float,
+    min_discount: float = 0.0,
+) -> list[tuple[np.ndarray, np.ndarray]]:
+    """Draws ladders uniformly, their ratios from the simplex and their discounts (in increasing order, to 0.1) from
+    [`min_discount`, `max_discount`].
+
+    Returns:
+        list[tuple[np.ndarray, np.ndarray]]: (ratios, discounts) of each ladder
+    """
+    ratios = rng.dirichlet(np.ones(n_discounts), size=n_ladders)
+    discounts = [
+        _spread_discounts(ladder_discounts, min_discount, max_discount)
+        for ladder_discounts in rng.uniform(
+            min_discount, max_discount, size=(n_ladders, n_discounts)
+        )
+    ]
+    return list(zip(ratios, discounts))
+
+
+def perturb_ladders(
+    rng: np.random.Generator,
+    ladders: list[tuple[np.ndarray, np.ndarray]],
+    n_ladders: int,
+    max_discount: float,
+    min_discount: float = 0.0,
+    concentration: float = 50.0,
+    discount_scale: float = 0.05,
+) -> list[tuple[np.ndarray, np.ndarray]]:
+    """Draws ladders around `ladders`, taken in turn: the ratios from a Dirichlet distribution centred on the
+    ladder's with `concentration`, and the discounts moved by normal steps of `discount_scale` of the discount range.
+
+    Returns:
+        list[tuple[np.ndarray, np.ndarray]]: (ratios, discounts) of each ladder
+    """
+    perturbed = []
+    for l_idx in range(n_ladders):
+        ratios, discounts = ladders[l_idx % len(ladders)]
+        ratios = rng.dirichlet(concentration * ratios + 1)
+        discounts = discounts + rng.normal(
+            0, discount_scale * (max_discount - min_discount), size=len(discounts)
+        )
+        discounts = _spread_discounts(discounts, min_discount, max_discount)
+        perturbed.append((ratios, discounts))
+    return perturbed
+
+
+def _spread_discounts(
+    discounts: np.ndarray, min_discount: float, max_discount: float
+) -> np.ndarray:
+    """Sorts and rounds `discounts` to 0.1 within [`min_discount`, `max_discount`], moving the ones that coincide 0.1
+    apart, as the orders of a ladder must have distinct discounts.
+    """
+    tenths = np.sort(
+        np.clip(
+            np.round(np.asarray(discounts) * 10), min_discount * 10, max_discount * 10
+        )
+    )
+    for d_idx in range(1, len(tenths)):
+        tenths[d_idx] = max(tenths[d_idx], tenths[d_idx - 1] + 1)
+    tenths[-1] = min(tenths[-1], np.floor(max_discount * 10))
+    for d_idx in range(len(tenths) - 2, -1, -1):
+        tenths[d_idx] = min(tenths[d_idx], tenths[d_idx + 1] - 1)
+    return tenths / 10
+
+
+def evaluate_ladders(
+    asset_pair: pd.DataFrame,
+    break_indicies: list[tuple[int, int]],
+    ladders: list[tuple[np.ndarray, np.ndarray]],
+    settings: dict,
+    run_duration: timedelta,
+    sim_start_price: float | None = None,
+    objective: Callable = ladder_objective,
+) -> np.ndarray:
+    """Scores each of `ladders` over the `break_indicies` windows of a single asset pair with `objective` (see
+    `ladder_objective`). The ladders share the other parameters of `sweep.SWEEP_PARAMETERS`, given in `settings`, and
+    are all simulated together by `sweep.simulate_sweep_pair`.
+
+    Returns:
+        np.ndarray: (ladder x window) scores
+    """
+    configs = get_sweep_configs(
+        [
+            dict(settings, ratios=list(ratios), discounts=list(discounts))
+            for ratios, discounts in ladders
+        ]
+    )
+    columns, row_configs, row_windows = simulate_sweep_pair(
+        asset_pair=asset_pair,
+        break_indicies=break_indicies,
+        configs=configs,
+        sim_start_price=sim_start_price,
+    )
+    n_windows = len(break_indicies)
+    identifiers = [str(r_idx) for r_idx in range(len(configs) * n_windows)]
+    run_idxs = [
+        c_idxs * n_windows + w_idxs for c_idxs, w_idxs in zip(row_configs, row_windows)
+    ]
+    results = history_table(columns=columns, run_idxs=run_idxs, identifiers=identifiers)
+    sorted_runs = np.sort(np.concatenate(run_idxs)) if run_idxs else np.array([])
+    config_bounds = np.searchsorted(
+        sorted_runs, np.arange(len(configs) + 1) * n_windows
+    )
+
+    window_statistics = rolling_price_statistics(
+        asset_pair=asset_pair,
+        break_indicies=break_indicies,
+        sim_start_price=sim_start_price,
+    )
+    overviews = [
+        grouped_buyback_overview(
+            result=results.slice(
+                config_bounds[c_idx], config_bounds[c_idx + 1] - config_bounds[c_idx]
+            ),
+            ratios=ratios,
+            discounts=discounts,
+            price_statistics=pd.DataFrame(
+                window_statistics,
+                index=identifiers[c_idx * n_windows : (c_idx + 1) * n_windows],
+                columns=PRICE_STATISTICS,
+            ),
+        )
+        for c_idx, (ratios, discounts) in enumerate(ladders)
+    ]
+    scores = objective(
+        pa.Table.from_batches(overviews, schema=SCHEMA_OVERVIEW).to_pandas(),
+        identifiers=pd.Index(identifiers),
+        run_duration=run_duration,
+    )
+    return np.asarray(scores, dtype=np.float64).reshape(len(configs), n_windows)
+
+
+def halving_rungs(
+    n_candidates: int, n_windows: int, eta: int = 3, min_windows: int = 1
+) -> list[tuple[int, int]]:
+    """Gets the rungs of successive halving: the candidates kept shrink by `eta` from `n_candidates` to one while the
+    windows they are scored on grow by `eta` up to all `n_windows`, starting from at least `min_windows`.
+
+    Returns:
+        list[tuple[int, int]]: number of candidates and of windows of each rung
+    """
+    candidates = [n_candidates]
+    while candidates[-1] > 1:
+        candidates.append(max(1, candidates[-1] // eta))
+    n_rungs = len(candidates)
+    return [
+        (
+            n_rung_candidates,
+            min(
+                n_windows,
+                max(
+                    min_windows, int(np.ceil(n_windows / eta ** (n_rungs - 1 - r_idx)))
+                ),
+            ),
+        )
+        for r_idx, n_rung_candidates in enumerate(candidates)
+    ]
+
+
+def optimize_ladder(
+    n_discounts: int,
+    initial_allocation: float,
+    refresh_amount: float,
+    refresh_interval_days: int,
+    sim_len_days: int,
+    step_days: float,
+    redistribute_on_refresh: bool = False,
+    sim_start_price: float | None = None,
+    max_discount: float = 80.0,
+    min_discount: float = 0.0,
+    n_candidates: int = 81,
+    n_rounds: int = 2,
+    eta: int = 3,
+    min_windows: int = 1,
+    objective: Callable = ladder_objective,
+    invert_pair: bool = False,
+    pairs: list[tuple[str, str] | tuple[str, str, str]] | None = None,
+    start_time: datetime | None = None,
+    end_time: datetime | None = None,
+    n_workers: int | None = None,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """Searches for the ladder (`ratios` and `discounts` of `n_discounts` orders) scoring best with `objective` over
+    the `simple_buyback_sim` windows of the candles, by successive halving (see `halving_rungs`). Each round draws
+    `n_candidates` ladders and scores them on a few windows, then keeps the best `1 / eta` of them and scores those
+    on `eta` times more windows, until a single ladder is scored on all of them. The windows are taken in one random
+    order shared by every candidate, so each rung extends the scores of the last rather than starting over. The
+    first round draws its ladders uniformly (see `sample_ladders`), the later ones half uniformly and half around the
+    best ladders scored on every window so far (see `perturb_ladders`).
+
+    The candidates of a rung are scored pair by pair, in chunks spread across `n_workers` processes (see
+    `run_tasks`). The search only depends on `seed`, not on `n_workers`. With 81 candidates and `eta` 3, each round
+    costs about 5 times the windows, where scoring every candidate on every window would cost 81 times.
+
+    Returns:
+        pd.DataFrame: `ratios`, `discounts`, `score` (mean over the windows scored), `n_windows` scored and `round` of
+        each candidate, the best first among those scored on every window
+    """
+    run_window = timedelta(days=sim_len_days)
+    step_size = timedelta(days=step_days)
+    db_path = Path.cwd() / "buyback_rec/database"
+    settings = dict(
+        initial_allocation=initial_allocation,
+        refresh_amount=refresh_amount,
+        refresh_interval_days=refresh_interval_days,
+        redistribute_on_refresh=redistribute_on_refresh,
+    )
+    rng = np.random.default_rng(seed)
+
+    data = load_candle_pairs(
+        candles_path=db_path / "candlestick_data",
+        invert_pair=invert_pair,
+        pairs=pairs,
+        start_time=start_time,
+        end_time=end_time,
+    )
+    windows = [
+        (p_idx, window)
+        for p_idx, asset_pair in enumerate(data)
+        for window in get_breakpoints(
+            timestamps=asset_pair.start_time,
+            window_time=run_window,
+            step_time=step_size,
+        )
+    ]
+    if not windows:
+        raise ValueError("The candles are too short for a single window")
+    window_order = rng.permutation(len(windows))
+    rungs = halving_rungs(
+        n_candidates=n_candidates,
+        n_windows=len(windows),
+        eta=eta,
+        min_windows=min_windows,
+    )
+
+    ladders = []
+    rounds = []
+    scores = np.empty((0, len(windows)))  # (candidate x window), NaN until scored
+    n_chunks = 1 if n_workers is None else max(1, n_workers)
+    for r_idx in range(n_rounds):
+        if r_idx == 0:
+            new_ladders = sample_ladders(
+                rng, n_candidates, n_discounts, max_discount, min_discount
+            )
+        else:
+            full = np.flatnonzero(~np.isnan(scores).any(axis=1))
+            best = full[np.argsort(-scores[full].mean(axis=1), kind="stable")]
+            n_perturbed = n_candidates // 2
+            new_ladders = perturb_ladders(
+                rng,
+                [ladders[c_idx] for c_idx in best[: max(1, n_candidates // eta)]],
+                n_perturbed,
+                max_discount,
+                min_discount,
+            ) + sample_ladders(
+                rng, n_candidates - n_perturbed, n_discounts, max_discount, min_discount
+            )
+        alive = np.arange(len(ladders), len(ladders) + len(new_ladders))
+        ladders.extend(new_ladders)
+        rounds.extend([r_idx] * len(new_ladders))
+        scores = np.concatenate(
+            [scores, np.full((len(new_ladders), len(windows)), np.nan)]
+        )
+
+        n_scored = 0
+        for n_rung_candidates, n_rung_windows in rungs:
+            if n_rung_candidates < len(alive):
+                rung_scores = scores[alive][:, window_order[:n_scored]].mean(axis=1)
+                alive = alive[np.argsort(-rung_scores, kind="stable")][
+                    :n_rung_candidates
+                ]
+            new_windows = window_order[n_scored:n_rung_windows]
+            if not len(new_windows):
+                continue
+            chunks = np.array_split(alive, min(n_chunks, len(alive)))
+            tasks = []
+            task_cells = []
+            for p_idx, asset_pair in enumerate(data):
+                pair_windows = [
+                    w_idx for w_idx in new_windows if windows[w_idx][0] == p_idx
+                ]
+                if not pair_windows:
+                    continue
+                for chunk in chunks:
+                    tasks.append(
+                        (
+                            evaluate_ladders,
+                            dict(
+                                asset_pair=asset_pair,
+                                break_indicies=[
+                                    windows[w_idx][1] for w_idx in pair_windows
+                                ],
+                                ladders=[ladders[c_idx] for c_idx in chunk],
+                                settings=settings,
+                                run_duration=run_window,
+                                sim_start_price=sim_start_price,
+                                objective=objective,
+                            ),
+                        )
+                    )
+                    task_cells.append(np.ix_(chunk, pair_windows))
+            for cells, task_scores in zip(
+                task_cells, run_tasks(tasks, n_workers=n_workers)
+            ):
+                scores[cells] = task_scores
+            n_scored = n_rung_windows
+
+    n_scored_windows = (~np.isnan(scores)).sum(axis=1)
+    candidates = pd.DataFrame(
+        {
+            "ratios": [ratios.tolist() for ratios, _ in ladders],
+            "discounts": [discounts.tolist() for _, discounts in ladders],
+            "score": np.nanmean(scores, axis=1),
+            "n_windows": n_scored_windows,
+            "round": rounds,
+        }
+    )
+    return candidates.sort_values(
+        ["n_windows", "score"], ascending=False, kind="stable"
+    ).reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    candidates = optimize_ladder(
+        n_discounts=4,
+        initial_allocation=100_000,
+        refresh_amount=10_000,
+        refresh_interval_days=5,
+        sim_len_days=120,
+        step_days=5,
+        redistribute_on_refresh=True,
+        sim_start_price=1,
+        objective=partial(ladder_objective, delay_penalty=0.001),
+    )
+    print(candidates.head(10))
+    print(
+        candidates["n_windows"].sum(),
+        "runs simulated,",
+        len(candidates) * candidates["n_windows"].max(),
+        "for a grid of the same candidates",
+    )
@@ -0,0 +1,460 @@
+import pyarrow as pa
+from pyarrow import compute as pc
+from pyarrow import dataset as ds
+from pyarrow import parquet as pq
+import os
+import queue
+import threading
+from pathlib import Path
+from uuid import uuid4
+from instrumentation import Instrumentation, stage
+from dtypes import (
+    SCHEMA_BUYBACK,
+    SCHEMA_BUYBACK_COMPACT,
+    SCHEMA_OVERVIEW,
+    SCHEMA_OVERVIEW_COMPACT,
+    SCHEMA_SETTINGS,
+    SCHEMA_SETTINGS_COMPACT,
+    compact_string,
+    run_constants,
+)
+
+RESULT_DATASETS = {
+    "results": "sim_records",
+    "overviews": "overviews",
+    "settings": "sim_ids",
+}  # directory of each simulation output in the database, settings last since they mark a run as stored
+COMPACT_SCHEMAS = {
+    "results": SCHEMA_BUYBACK_COMPACT,
+    "settings": SCHEMA_SETTINGS_COMPACT,
+    "overviews": SCHEMA_OVERVIEW_COMPACT,
+}
+STORED_SCHEMAS = {
+    **COMPACT_SCHEMAS,
+    "results": pa.schema(list(SCHEMA_BUYBACK_COMPACT) + run_constants),
+}  # reads datasets written with either encoding, the run constants of compact records are null
+TARGET_FILE_BYTES = 128 * 1024**2  # in-memory size of the rows buffered into each file
+TARGET_ROW_GROUP_BYTES = 16 * 1024**2  # in-memory size of each row group
+FLUSH_WINDOWS = 1024  # runs buffered by the writer of a pipelined simulation before every dataset is written
+
+
+def conform(table: pa.Table, schema: pa.Schema) -> pa.Table:
+    """Selects and casts the columns of `schema` from `table`, filling those it doesn't have with nulls."""
+    return pa.table(
+        {
+            field.name: (
+                table[field.name].cast(field.type)
+                if field.name in table.column_names
+                else pa.nulls(len(table), field.type)
+            )
+            for field in schema
+        },
+        schema=schema,
+    )
+
+
+def compact_outputs(
+    results: pa.Table | None = None,
+    settings: pa.Table | None = None,
+    overviews: pa.Table | None = None,
+) -> tuple[pa.Table | None, pa.Table | None, pa.Table | None]:
+    """Converts simulation outputs to their compact encodings (see `dtypes.SCHEMA_BUYBACK_COMPACT`). The run constants
+    of `results` are moved to the runs' `settings`, so each run's results and settings must be given together.
+    """
+    if settings is not None:
+        start_times = pa.nulls(len(settings), pa.timestamp("s"))
+        if results is not None and results.num_rows:
+            run_starts = results.group_by("identifier").aggregate(
+                [("start_time", "min")]
+            )
+            start_times = run_starts["start_time_min"].take(
+                pc.index_in(settings["identifier"], value_set=run_starts["identifier"])
+            )
+        settings = conform(
+            settings.append_column("start_time", start_times), SCHEMA_SETTINGS_COMPACT
+        )
+    if results is not None:
+        results = conform(results, SCHEMA_BUYBACK_COMPACT)
+    if overviews is not None:
+        overviews = conform(overviews, SCHEMA_OVERVIEW_COMPACT)
+    return results, settings, overviews
+
+
+def fill_run_constants(results: pa.Table, settings: pa.Table) -> pa.Table:
+    """Fills the run constants (see `dtypes.run_constants`) that compact `results` leave null from the runs' `settings`
+    rows, both read with `STORED_SCHEMAS`.
+    """
+    run_idxs = pc.index_in(
+        results["identifier"].cast(pa.string()),
+        value_set=settings["identifier"].cast(pa.string()).combine_chunks(),
+    )
+    for name, dtype in run_constants:
+        constants = settings[name].take(run_idxs)
+        if name in results.column_names:
+            field_idx = results.schema.get_field_index(name)
+            results = results.set_column(
+                field_idx, name, pc.coalesce(results[name], constants)
+            )
+        else:
+            results = results.append_column(name, constants)
+    return results
+
+
+def dictionary_strings(table: pa.Table) -> pa.Table:
+    """Dictionary encodes the string columns of `table`."""
+    return table.cast(
+        pa.schema(
+            [
+                field.with_type(compact_string) if field.type == pa.string() else field
+                for field in table.schema
+            ]
+        )
+    )
+
+
+def write_sorted(
+    table: pa.Table, path: Path, row_group_bytes: int = TARGET_ROW_GROUP_BYTES
+) -> Path:
+    """Writes `table` sorted by `identifier` (keeping the order of each run's rows) as a new file in the dataset
+    directory `path`, in row groups of about `row_group_bytes` with column statistics, so that scans filtering on
+    `identifier` skip the row groups that can't match. The file is renamed into place once complete.
+    """
+    table = table.replace_schema_metadata(None).unify_dictionaries()
+    table = table.take(pc.sort_indices(table["identifier"].cast(pa.string())))
+    row_bytes = max(1, table.nbytes // max(1, table.num_rows))
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    file_path = path / f"{uuid4().hex}-0.parquet"
+    tmp_path = path / f".{file_path.name}.tmp"
+    pq.write_table(
+        table,
+        tmp_path,
+        row_group_size=max(1, row_group_bytes // row_bytes),
+        write_statistics=True,
+        sorting_columns=[pq.SortingColumn(table.schema.get_field_index("identifier"))],
+    )
+    os.replace(tmp_path, file_path)
+    return file_path
+
+
+class ResultWriter:
+    """Buffers simulation outputs across any number of runs and writes each dataset of `RESULT_DATASETS` in files of
+    about `file_bytes`, split into row groups of about `row_group_bytes` (see `write_sorted`), instead of one small
+    file per call. The datasets are always written together, in the order of `RESULT_DATASETS`, so the settings of a
+    run (which mark it as stored) never reach the disk before its results and overview. They are written once any
+    of their buffers reaches `file_bytes`, and with `flush_windows` also once the settings of that many runs are
+    buffered, so that no more runs than that are lost if the process dies. Use as a context manager, or call `close`
+    to write the rows still buffered. With `compact` the outputs are stored with their compact encodings (see
+    `compact_outputs`). With `instrumentation` the file writes are timed ("write_files") and the files and bytes
+    written counted.
+    """
+
+    def __init__(
+        self,
+        db_path: Path,
+        file_bytes: int = TARGET_FILE_BYTES,
+        row_group_bytes: int = TARGET_ROW_GROUP_BYTES,
+        compact: bool = True,
+        instrumentation: Instrumentation | None = None,
+        flush_windows: int | None = None,
+    ):
+        self.db_path = Path(db_path)
+        self.compact = compact
+        self.instrumentation = instrumentation
+        self.file_bytes = file_bytes
+        self.row_group_bytes = row_group_bytes
+        self.flush_windows = flush_windows
+        self._buffers = {name: [] for name in RESULT_DATASETS}
+        self._buffered_bytes = {name: 0 for name in RESULT_DATASETS}
+        self._buffered_runs = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(
+        self,
+        results: pa.Table | None = None,
+        settings: pa.Table | None = None,
+        overviews: pa.Table | None = None,
+    ) -> None:
+        """Buffers the outputs of a simulation, writing every dataset once one of their buffers reached `file_bytes`
+        or `flush_windows` runs are buffered.
+        """
+        if self.compact:
+            results, settings, overviews = compact_outputs(
+                results=results, settings=settings, overviews=overviews
+            )
+        for name, table in [
+            ("results", results),
+            ("settings", settings),
+            ("overviews", overviews),
+        ]:
+            if table is None or not table.num_rows:
+                continue
+            self._buffers[name].append(table.replace_schema_metadata(None))
+            self._buffered_bytes[name] += table.nbytes
+        if settings is not None:
+            self._buffered_runs += settings.num_rows
+        if max(self._buffered_bytes.values()) >= self.file_bytes or (
+            self.flush_windows is not None and self._buffered_runs >= self.flush_windows
+        ):
+            self._flush()
+
+    def flush(self) -> None:
+        """Writes the buffered rows of every dataset, in the order of `RESULT_DATASETS`."""
+        self._flush()
+
+    def _flush(self) -> None:
+        self._buffered_runs = 0
+        for name in RESULT_DATASETS:
+            if not self._buffers[name]:
+                continue
+            with stage(self.instrumentation, "write_files"):
+                file_path = write_sorted(
+                    table=pa.concat_tables(self._buffers[name]),
+                    path=self.db_path / RESULT_DATASETS[name],
+                    row_group_bytes=self.row_group_bytes,
+                )
+            if self.instrumentation is not None:
+                self.instrumentation.count("files_written")
+                self.instrumentation.count("bytes_written", file_path.stat().st_size)
+            self._buffers[name] = []
+            self._buffered_bytes[name] = 0
+
+    def close(self) -> None:
+        self.flush()
+
+    def buffered(self, name: str) -> pa.Table:
+        """Gets the rows of dataset `name` that are buffered but not written yet, following `STORED_SCHEMAS`."""
+        return pa.concat_tables(
+            [STORED_SCHEMAS[name].empty_table()]
+            + [conform(table, STORED_SCHEMAS[name]) for table in self._buffers[name]]
+        )
+
+
+class BackgroundWriter(ResultWriter):
+    """`ResultWriter` whose outputs are encoded and written by a background thread, so that simulations carry on
+    while files are written. `write` hands the outputs to the thread through a queue holding at most `max_pending`
+    of them, and blocks while it is full, so memory stays bounded when writing falls behind. An error raised in the
+    thread is raised again by the next call, and the outputs handed over after it are dropped.
+    """
+
+    def __init__(self, db_path: Path, max_pending: int = 8, **kwargs):
+        super().__init__(db_path, **kwargs)
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                method, kwargs = task
+                if self._error is None:
+                    method(**kwargs)
+            except Exception as error:
+                self._error = error
+            finally:
+                self._queue.task_done()
+
+    def _submit(self, method, **kwargs) -> None:
+        self._raise_error()
+        if not self._thread.is_alive():
+            raise ValueError("The writer is closed")
+        self._queue.put((method, kwargs))
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def write(
+        self,
+        results: pa.Table | None = None,
+        settings: pa.Table | None = None,
+        overviews: pa.Table | None = None,
+    ) -> None:
+        self._submit(
+            super().write, results=results, settings=settings, overviews=overviews
+        )
+
+    def flush(self) -> None:
+        self._submit(self._flush)
+
+    def wait(self) -> None:
+        """Blocks until the outputs handed over so far are buffered or written."""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self) -> None:
+        if self._thread.is_alive():
+            self._queue.put((self._flush, {}))
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def buffered(self, name: str) -> pa.Table:
+        self.wait()
+        return super().buffered(name)
+
+
+def save_results(
+    db_path: Path,
+    results: pa.Table | None = None,
+    settings: pa.Table | None = None,
+    overviews: pa.Table | None = None,
+    writer: ResultWriter | None = None,
+    instrumentation: Instrumentation | None = None,
+) -> None:
+    """Writes simulation outputs to the database through `writer`, which keeps buffering them across runs, or through
+    a writer of its own, given `instrumentation`, closed straight away if none is given.
+    """
+    if writer is not None:
+        writer.write(results=results, settings=settings, overviews=overviews)
+        return
+    with ResultWriter(db_path, instrumentation=instrumentation) as writer:
+        writer.write(results=results, settings=settings, overviews=overviews)
+
+
+def read_runs(
+    path: Path, identifiers: list[str] | pa.Array, schema: pa.Schema
+) -> pa.Table:
+    """Reads the rows of the runs `identifiers` from the dataset directory `path`, following `schema` (one of
+    `STORED_SCHEMAS`). A run stored in more than one file (e.g. by an interrupted `compact_dataset`) is only read from
+    the first of them.
+    """
+    if not Path(path).exists():
+        return schema.empty_table()
+    dataset = ds.dataset(path, format="parquet", schema=schema)
+    in_runs = pc.field("identifier").isin(pa.array(identifiers, pa.string()))
+    tables = []
+    seen = pa.array([], pa.string())
+    for fragment in dataset.get_fragments(filter=in_runs):
+        table = fragment.to_table(schema=schema, columns=schema.names, filter=in_runs)
+        table = table.filter(~pc.field("identifier").isin(seen))
+        seen = pa.concat_arrays(
+            [seen, pc.unique(table["identifier"].cast(pa.string()))]
+        )
+        tables.append(table.cast(schema))  # Parquet stores second timestamps as ms
+    return pa.concat_tables([schema.empty_table()] + tables)
+
+
+def load_runs(
+    db_path: Path, identifiers: list[str], writer: ResultWriter | None = None
+) -> tuple[pa.Table, pa.Table, pa.Table]:
+    """Reads the results, settings and overviews already stored for the runs `identifiers`, from the database and from
+    the rows `writer` still buffers. Runs are found by their settings row, so the identifiers missing from the returned
+    settings are the runs that still have to be simulated.
+
+    Returns:
+        tuple[pa.Table, pa.Table, pa.Table]: results, settings and overviews of the stored runs
+    """
+    db_path = Path(db_path)
+    outputs = {}
+    found = pa.array(identifiers, pa.string())
+    for name in ["settings", "results", "overviews"]:  # then only the runs found
+        table = read_runs(db_path / RESULT_DATASETS[name], found, STORED_SCHEMAS[name])
+        if writer is not None:
+            buffered = writer.buffered(name).filter(
+                pc.field("identifier").isin(found)
+                & ~pc.field("identifier").isin(
+                    table["identifier"].cast(pa.string()).combine_chunks()
+                )
+            )
+            table = pa.concat_tables([table, buffered])
+        if name == "settings":
+            found = pc.unique(table["identifier"].cast(pa.string()))
+        outputs[name] = table
+
+    results = fill_run_constants(outputs["results"], outputs["settings"])
+    return (
+        conform(results, SCHEMA_BUYBACK),
+        conform(outputs["settings"], SCHEMA_SETTINGS),
+        conform(outputs["overviews"], SCHEMA_OVERVIEW),
+    )
+
+
+def stored_identifiers(
+    db_path: Path, identifiers: list[str], writer: ResultWriter | None = None
+) -> set[str]:
+    """Gets which of the runs `identifiers` are already stored in the database or buffered by `writer`, reading only
+    the identifiers of their settings rows (see `load_runs`).
+    """
+    schema = pa.schema([STORED_SCHEMAS["settings"].field("identifier")])
+    settings = read_runs(
+        Path(db_path) / RESULT_DATASETS["settings"], identifiers, schema
+    )
+    stored = set(settings["identifier"].cast(pa.string()).to_pylist())
+    if writer is not None:
+        buffered = writer.buffered("settings")["identifier"].cast(pa.string())
+        stored.update(set(buffered.to_pylist()) & set(identifiers))
+    return stored
+
+
+def sort_runs(table: pa.Table, identifiers: list[str]) -> pa.Table:
+    """Orders the rows of `table` by the position of their run in `identifiers`, keeping the order within each run."""
+    positions = pc.index_in(table["identifier"], value_set=pa.array(identifiers))
+    return table.take(pc.sort_indices(positions))
+
+
+def compact_dataset(
+    path: Path,
+    file_bytes: int = TARGET_FILE_BYTES,
+    row_group_bytes: int = TARGET_ROW_GROUP_BYTES,
+) -> int:
+    """Merges the files of the dataset directory `path` that are smaller than `file_bytes` on disk into files of about
+    `file_bytes` in memory, written by `write_sorted` with their string columns dictionary encoded. Merged files are only removed once their replacement is in
+    place, so an interrupted compaction may duplicate rows but never loses them. Returns the number of files removed.
+    """
+    small_files = sorted(
+        file_path
+        for file_path in Path(path).glob("*.parquet")
+        if file_path.stat().st_size < file_bytes
+    )
+    n_removed = 0
+    group = []
+    group_bytes = 0
+    for i_file, file_path in enumerate(small_files):
+        table = dictionary_strings(
+            pq.read_table(file_path).replace_schema_metadata(None)
+        )
+        group.append((file_path, table))
+        group_bytes += table.nbytes
+        if group_bytes < file_bytes and i_file < len(small_files) - 1:
+            continue
+        if len(group) > 1:
+            write_sorted(
+                table=pa.concat_tables(
+                    [table for _, table in group], promote_options="default"
+                ),
+                path=path,
+                row_group_bytes=row_group_bytes,
+            )
+            for merged_path, _ in group:
+                merged_path.unlink()
+            n_removed += len(group)
+        group = []
+        group_bytes = 0
+    return n_removed
+
+
+def compact_database(db_path: Path | None = None, **kwargs) -> dict[str, int]:
+    """Compacts every dataset of `RESULT_DATASETS` (see `compact_dataset`), returning the number of files merged in each."""
+    if db_path is None:
+        db_path = Path.cwd() / "buyback_rec/database"
+    return {
+        directory: compact_dataset(Path(db_path) / directory, **kwargs)
+        for directory in RESULT_DATASETS.values()
+        if (Path(db_path) / directory).exists()
+    }
+
+
+if __name__ == "__main__":
+    for directory, n_merged in compact_database().items():
+        print(f"{directory}: merged {n_merged} files")
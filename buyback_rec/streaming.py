@@ -0,0 +1,686 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pyarrow import compute as pc
+from pyarrow import dataset as ds
+from pyarrow import parquet as pq
+from collections.abc import Iterator
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from buyback_sim import (
+    PRICE_STATISTICS,
+    Buyback,
+    WindowDigest,
+    encode_metadata,
+    first_touch_indicies,
+    get_breakpoints,
+    get_refresh_schedule,
+    grouped_buyback_overview,
+    make_settings_record,
+    price_statistics_from_sums,
+    run_identifier,
+)
+from candle_store import candle_filter, candle_pairs, open_candles
+from result_store import ResultWriter, stored_identifiers
+
+CANDLE_COLUMNS = ["start_time", "low", "high", "open", "close"]
+
+
+class BuybackStream:
+    """Runs a `Buyback` over candles fed in consecutive chunks with `update`, giving the same history as
+    `Buyback.simulate_buybacks` over all of the candles at once. Between chunks only the state of the current refresh
+    period is kept: its reference price, the first time each discount was traded through, and the last candle, which
+    may turn out to be the candle nearest to the next refresh time once the first candle past that time arrives.
+    """
+
+    def __init__(
+        self,
+        buyback: Buyback,
+        refresh_amount: float | None = None,
+        refresh_interval: timedelta | None = None,
+        redistribute_on_refresh: bool = False,
+    ):
+        self.buyback = buyback
+        self.refresh_amount = 0 if refresh_amount is None else refresh_amount
+        self.refresh_interval = refresh_interval
+        self.redistribute_on_refresh = redistribute_on_refresh
+        self.run_start_time = None
+        self.run_start_price = None
+        self.reset_time = None
+        self.n_refreshes = 0
+        self._prices = None
+        self._trigger_times = None
+        self._last = None  # (start_time, open, low) of the last candle fed
+
+    def _start_period(self, start_time: np.datetime64, open_price: float) -> None:
+        self.buyback.ref_price = open_price
+        self.reset_time = start_time
+        self._prices = self.buyback.ref_price * (100 - self.buyback.discounts) / 100
+        self._trigger_times = np.full(
+            len(self._prices), np.datetime64("NaT"), np.asarray(start_time).dtype
+        )
+
+    def _scan(self, start_times: np.ndarray, lows: np.ndarray) -> None:
+        """Records the first candle trading below each limit price not yet touched in the current period."""
+        pending = np.flatnonzero(np.isnat(self._trigger_times))
+        if not len(pending) or not len(lows):
+            return
+        hit_idxs = first_touch_indicies(lows, self._prices[pending])
+        hit = hit_idxs < len(lows)
+        self._trigger_times[pending[hit]] = start_times[hit_idxs[hit]]
+
+    def _refresh(self) -> None:
+        self.buyback.fill_orders(
+            trigger_times=self._trigger_times,
+            last_reset_time=self.reset_time,
+            run_start_time=self.run_start_time,
+            run_start_price=self.run_start_price,
+        )
+        if self.redistribute_on_refresh:
+            self.buyback.redistribute_amount()
+        self.buyback.add_amount_proportionally(self.refresh_amount)
+        self.n_refreshes += 1
+
+    def update(self, start_times: np.ndarray, opens: np.ndarray, lows: np.ndarray):
+        """Feeds the next chunk of candles, which must follow the previous ones in increasing `start_time` order."""
+        if not len(start_times):
+            return
+        cursor = 0
+        if self._last is None:
+            self.run_start_time = start_times[0]
+            self.run_start_price = opens[0]
+            self._start_period(start_times[0], opens[0])
+        else:
+            # the last candle is kept in front of the chunk, the next refresh may fall on it
+            last_time, last_open, last_low = self._last
+            start_times = np.concatenate([[last_time], start_times])
+            opens = np.concatenate([[last_open], opens])
+            lows = np.concatenate([[last_low], lows])
+            cursor = 1
+        if (np.diff(start_times) <= np.timedelta64(0)).any():
+            raise ValueError("Candles must be fed in increasing `start_time` order")
+
+        while self.refresh_interval is not None:
+            refresh_time = self.run_start_time + (self.n_refreshes + 1) * (
+                self.refresh_interval
+            )
+            after = np.searchsorted(start_times, refresh_time)
+            if after == len(start_times):
+                break  # the candle nearest to the refresh time can't be known yet
+            before = after - 1
+            refresh_idx = (
+                after
+                if start_times[after] - refresh_time
+                < refresh_time - start_times[before]
+                else before
+            )  # the earlier candle on ties, as in `nearest_indicies`
+            self._scan(
+                start_times[cursor : refresh_idx + 1], lows[cursor : refresh_idx + 1]
+            )
+            self._refresh()
+            self._start_period(start_times[refresh_idx], opens[refresh_idx])
+            cursor = refresh_idx  # the refresh candle belongs to both periods
+        self._scan(start_times[cursor:], lows[cursor:])
+        self._last = (start_times[-1], opens[-1], lows[-1])
+
+    def finish(self) -> pa.Table:
+        """Ends the run at the last candle fed, making the refreshes still due there, and returns the buyback history."""
+        if self._last is None:
+            raise ValueError("No candles were fed to the stream")
+        last_time, last_open, last_low = self._last
+        refresh_amounts, refresh_intervals, _, _ = get_refresh_schedule(
+            start_times=np.array([self.run_start_time, last_time]),
+            refresh_amounts=self.refresh_amount,
+            refresh_intervals=self.refresh_interval,
+        )
+        # the refreshes still due fall after the last candle, so they are all made on it
+        for r_idx in range(len(refresh_amounts) - self.n_refreshes):
+            if r_idx:
+                self._start_period(last_time, last_open)
+                self._scan(np.array([last_time]), np.array([last_low]))
+            self._refresh()
+
+        schema = self.buyback._schema.with_metadata(
+            encode_metadata(
+                ratios=self.buyback.ratios,
+                discounts=self.buyback.discounts,
+                refresh_amounts=refresh_amounts,
+                refresh_intervals=refresh_intervals,
+            )
+        )
+        return self.buyback.history.to_table(schema=schema)
+
+
+class OnlineBuyback(BuybackStream):
+    """Runs a `Buyback` over candles pushed one at a time with `push`, e.g. from a live feed, giving the same history
+    as `Buyback.simulate_buybacks` over all of the candles at once. Each candle takes constant time: the next refresh
+    time is compared with the candle's start, and its low with the highest limit price not yet traded through in the
+    current period, as lows reach the limit prices from the highest down.
+
+    Orders are filled, and their SCHEMA_BUYBACK rows returned by `push`, as soon as a candle trades through their
+    limit price, rather than at the end of the refresh period. A refresh falling between two candles is made on the
+    nearer one, so it is only made once the candle after it arrives. The rows come in the order of the batch history
+    when `discounts` increase, as their limit prices are then reached in ladder order. Otherwise the same orders are
+    filled, but each refresh period's rows come in the order the candles trade through their limit prices (in ladder
+    order on the same candle) rather than in ladder order, and their running columns accumulate in that order.
+    """
+
+    def __init__(
+        self,
+        buyback: Buyback,
+        refresh_amount: float | None = None,
+        refresh_interval: timedelta | None = None,
+        redistribute_on_refresh: bool = False,
+    ):
+        super().__init__(
+            buyback=buyback,
+            refresh_amount=refresh_amount,
+            refresh_interval=refresh_interval,
+            redistribute_on_refresh=redistribute_on_refresh,
+        )
+        # accounts from the highest limit price down, on ties in account order
+        self._order = np.argsort(self.buyback.discounts, kind="stable")
+        self._order_prices = None
+        self._n_touched = 0
+
+    def _start_period(self, start_time: np.datetime64, open_price: float) -> None:
+        super()._start_period(start_time, open_price)
+        self._order_prices = self._prices[self._order].tolist()
+        self._n_touched = 0
+
+    def _touch(self, start_time: np.datetime64, low: float) -> None:
+        """Fills the orders of the current period whose limit price the candle trades through."""
+        n_touched = self._n_touched
+        while (
+            self._n_touched < len(self._order_prices)
+            and low < self._order_prices[self._n_touched]
+        ):
+            self._n_touched += 1
+        if self._n_touched == n_touched:
+            return
+        touched = self._order[n_touched : self._n_touched]
+        self._trigger_times[touched] = start_time
+        trigger_times = np.full_like(self._trigger_times, np.datetime64("NaT"))
+        trigger_times[touched] = start_time
+        self.buyback.fill_orders(
+            trigger_times=trigger_times,
+            last_reset_time=self.reset_time,
+            run_start_time=self.run_start_time,
+            run_start_price=self.run_start_price,
+        )
+
+    def _scan(self, start_times: np.ndarray, lows: np.ndarray) -> None:
+        for start_time, low in zip(start_times, lows.tolist()):
+            self._touch(start_time, low)
+
+    def push(
+        self, start_time: np.datetime64, open_price: float, low: float
+    ) -> list[dict]:
+        """Feeds the next candle, which must start after the previous one.
+
+        Returns:
+            list[dict]: SCHEMA_BUYBACK rows of the orders filled
+        """
+        start_time = np.datetime64(start_time)
+        open_price = float(open_price)
+        low = float(low)
+        n_rows = len(self.buyback.history)
+        if self._last is None:
+            self.run_start_time = start_time
+            self.run_start_price = open_price
+            self._start_period(start_time, open_price)
+        else:
+            last_time, last_open, last_low = self._last
+            if start_time <= last_time:
+                raise ValueError("Candles must be fed in increasing `start_time` order")
+            while self.refresh_interval is not None:
+                refresh_time = self.run_start_time + (self.n_refreshes + 1) * (
+                    self.refresh_interval
+                )
+                if start_time < refresh_time:
+                    break  # the candle nearest to the refresh time can't be known yet
+                if start_time - refresh_time < refresh_time - last_time:
+                    # the refresh candle ends the current period and starts the next
+                    self._touch(start_time, low)
+                    self._refresh()
+                    self._start_period(start_time, open_price)
+                else:  # the earlier candle on ties, as in `nearest_indicies`
+                    self._refresh()
+                    self._start_period(last_time, last_open)
+                    self._touch(last_time, last_low)
+        self._touch(start_time, low)
+        self._last = (start_time, open_price, low)
+        if len(self.buyback.history) == n_rows:
+            return []
+        return self.buyback.history.rows(n_rows)
+
+
+def replay_online(
+    candles: ds.Dataset,
+    in_pair: pc.Expression,
+    buyback: Buyback,
+    refresh_amount: float | None = None,
+    refresh_interval: timedelta | None = None,
+    redistribute_on_refresh: bool = False,
+    invert_pair: bool = False,
+    chunk_size: int = 65_536,
+) -> pa.Table:
+    """Pushes the stored candles selected by `in_pair` (see `candle_filter`) one at a time through an `OnlineBuyback`,
+    e.g. to compare its history with `Buyback.simulate_buybacks` over the same candles.
+
+    Returns:
+        pa.Table: the buyback history, with the schema of `Buyback.simulate_buybacks`
+    """
+    online = OnlineBuyback(
+        buyback=buyback,
+        refresh_amount=refresh_amount,
+        refresh_interval=refresh_interval,
+        redistribute_on_refresh=redistribute_on_refresh,
+    )
+    for chunk in iter_pair_chunks(
+        candles=candles,
+        in_pair=in_pair,
+        chunk_size=chunk_size,
+        invert_pair=invert_pair,
+    ):
+        for start_time, open_price, low in zip(
+            chunk["start_time"], chunk["open"].tolist(), chunk["low"].tolist()
+        ):
+            online.push(start_time, open_price, low)
+    return online.finish()
+
+
+class RunningPriceStatistics:
+    """Accumulates the sums `price_statistics_from_sums` needs over candles fed in consecutive chunks."""
+
+    def __init__(self):
+        self.start_time = None
+        self.offset = None
+        self.start_price = None
+        self.final_price = None
+        self.n_prices = 0
+        self.sums = np.zeros(5)  # days, days^2, prices, prices^2 and days * prices
+
+    def update(
+        self,
+        start_times: np.ndarray,
+        opens: np.ndarray,
+        closes: np.ndarray,
+        highs: np.ndarray,
+        lows: np.ndarray,
+    ) -> None:
+        if not len(start_times):
+            return
+        prices = np.stack([opens, closes, highs, lows], axis=1).astype(np.float64)
+        if self.start_time is None:
+            self.start_time = start_times[0]
+            self.offset = prices[0, 0]  # keeps the sums small
+            self.start_price = opens[0]
+        days = (start_times - self.start_time) / np.timedelta64(1, "D")
+        candle_sums = (prices - self.offset).sum(axis=1)
+        candle_squares = ((prices - self.offset) ** 2).sum(axis=1)
+        self.n_prices += 4 * len(days)  # every candle time is counted once per price
+        self.sums += [
+            4 * days.sum(),
+            4 * (days**2).sum(),
+            candle_sums.sum(),
+            candle_squares.sum(),
+            (days * candle_sums).sum(),
+        ]
+        self.final_price = closes[-1]
+
+    def statistics(self, scale_factor: float | None = None) -> np.ndarray:
+        """Gets the statistics of all candles fed, with the columns of `PRICE_STATISTICS`."""
+        sum_days, sum_days_sq, sum_prices, sum_prices_sq, sum_days_prices = self.sums[
+            :, np.newaxis
+        ]
+        return price_statistics_from_sums(
+            n_prices=np.array([self.n_prices]),
+            sum_days=sum_days,
+            sum_days_sq=sum_days_sq,
+            sum_prices=sum_prices,
+            sum_prices_sq=sum_prices_sq,
+            sum_days_prices=sum_days_prices,
+            offset=self.offset,
+            start_prices=np.array([self.start_price], dtype=np.float64),
+            final_prices=np.array([self.final_price], dtype=np.float64),
+            scale_factors=None if scale_factor is None else np.array([scale_factor]),
+        )[0]
+
+
+@dataclass
+class StreamWindow:
+    digest: WindowDigest  # digest of the candles fed so far, the run identifier is derived from it once they all are
+    start: int  # candle index of the window's first candle within its pair
+    stop: int  # candle index of the window's last candle (inclusive)
+    stream: BuybackStream
+    statistics: RunningPriceStatistics
+    scale_factor: np.ndarray | None = None
+
+
+def pair_breakpoints(
+    candles: ds.Dataset,
+    in_pair: pc.Expression,
+    window_time: timedelta,
+    step_time: timedelta,
+) -> list[tuple[int, int]]:
+    """Gets the `get_breakpoints` windows of the candles selected by `in_pair` (see `candle_filter`) from their start
+    times alone, without reading their prices.
+    """
+    start_times = candles.to_table(columns=["start_time"], filter=in_pair)
+    return get_breakpoints(
+        timestamps=start_times["start_time"].to_numpy(),
+        window_time=window_time,
+        step_time=step_time,
+    )
+
+
+def iter_pair_chunks(
+    candles: ds.Dataset,
+    in_pair: pc.Expression,
+    chunk_size: int,
+    invert_pair: bool = False,
+) -> Iterator[dict[str, np.ndarray]]:
+    """Reads the candles selected by `in_pair` (see `candle_filter`) in record batches of up to `chunk_size` rows, as
+    NumPy arrays of `CANDLE_COLUMNS`. The candles must be stored in `start_time` order (see `sort_candles`), which is
+    checked as they are read.
+    """
+    last_time = None
+    for batch in candles.to_batches(
+        columns=CANDLE_COLUMNS,
+        filter=in_pair,
+        batch_size=chunk_size,
+    ):
+        if not batch.num_rows:
+            continue
+        chunk = {name: batch.column(name).to_numpy() for name in CANDLE_COLUMNS}
+        start_times = chunk["start_time"]
+        if (np.diff(start_times) <= np.timedelta64(0)).any() or (
+            last_time is not None and start_times[0] <= last_time
+        ):
+            raise ValueError(
+                "The candles are not stored in `start_time` order, rewrite them with `sort_candles`"
+            )
+        last_time = start_times[-1]
+        if invert_pair:
+            chunk["low"], chunk["high"] = 1 / chunk["high"], 1 / chunk["low"]
+            chunk["open"] = 1 / chunk["open"]
+            chunk["close"] = 1 / chunk["close"]
+        yield chunk
+
+
+def sort_candles(candles_path: Path) -> None:
+    """Rewrites each file of the candlestick dataset sorted by pair and `start_time`, one file at a time."""
+    for path in sorted(Path(candles_path).glob("**/*.parquet")):
+        table = pq.read_table(path)
+        table = table.sort_by(
+            [
+                ("asset1", "ascending"),
+                ("asset2", "ascending"),
+                ("start_time", "ascending"),
+            ]
+        )
+        pq.write_table(table, path)
+
+
+def stream_buyback_sim(
+    ratios: list,
+    discounts: list,
+    initial_allocation: float,
+    refresh_amount: float,
+    refresh_interval_days: int,
+    sim_len_days: int,
+    step_days: float,
+    sim_start_price: float | None = None,
+    redistribute_on_refresh: bool = False,
+    invert_pair: bool = False,
+    save_to_db: bool = False,
+    chunk_size: int = 65_536,
+    pairs: list[tuple[str, str]] | None = None,
+    start_time: datetime | None = None,
+    end_time: datetime | None = None,
+    writer: ResultWriter | None = None,
+) -> Iterator[tuple[pa.Table, pa.Table, pa.Table]]:
+    """Streaming equivalent of `simple_buyback_sim`. The candles of each pair are read in ordered chunks of up to
+    `chunk_size` rows and fed to a `BuybackStream` for every open window, so only one chunk and the state of the open
+    windows are held in memory at a time. The outputs of the windows ending in a chunk are yielded as soon as it is
+    processed, and written to the database if `save_to_db` is set, buffered by `writer` (or by a writer of the stream's
+    own, closed once the stream ends) so that chunks are not written one small file each. Runs get the same identifiers
+    as in `simple_buyback_sim` (see `run_identifier`), so those already stored are not written again. The buyback
+    histories are the same as the batched `simple_buyback_sim`, and the price statistics match it to float tolerance.
+
+    Yields:
+        tuple[pa.Table, pa.Table, pa.Table]: results, settings and overviews of the windows ending in each chunk
+    """
+    run_window = timedelta(days=sim_len_days)
+    step_size = timedelta(days=step_days)
+    refresh_interval = timedelta(days=refresh_interval_days)
+    db_path = Path.cwd() / "buyback_rec/database"
+    candles_path = db_path / "candlestick_data"
+    candles = open_candles(candles_path)
+    if pairs is None:
+        pairs = candle_pairs(candles)
+    if save_to_db and writer is None:
+        with ResultWriter(db_path) as writer:
+            yield from stream_buyback_sim(
+                ratios=ratios,
+                discounts=discounts,
+                initial_allocation=initial_allocation,
+                refresh_amount=refresh_amount,
+                refresh_interval_days=refresh_interval_days,
+                sim_len_days=sim_len_days,
+                step_days=step_days,
+                sim_start_price=sim_start_price,
+                redistribute_on_refresh=redistribute_on_refresh,
+                invert_pair=invert_pair,
+                save_to_db=save_to_db,
+                chunk_size=chunk_size,
+                pairs=pairs,
+                start_time=start_time,
+                end_time=end_time,
+                writer=writer,
+            )
+        return
+
+    for asset1, asset2 in pairs:
+        in_pair = candle_filter(
+            asset1=asset1, asset2=asset2, start_time=start_time, end_time=end_time
+        )
+        # the inverted candles are those of asset2-asset1, as loaded by `simple_buyback_sim`
+        run_asset1, run_asset2 = (asset2, asset1) if invert_pair else (asset1, asset2)
+        break_indicies = pair_breakpoints(
+            candles=candles,
+            in_pair=in_pair,
+            window_time=run_window,
+            step_time=step_size,
+        )
+        n_opened = 0
+        windows = []
+        chunk_start = 0
+        for chunk in iter_pair_chunks(
+            candles=candles,
+            in_pair=in_pair,
+            chunk_size=chunk_size,
+            invert_pair=invert_pair,
+        ):
+            chunk_stop = chunk_start + len(chunk["start_time"])
+            while (
+                n_opened < len(break_indicies)
+                and break_indicies[n_opened][0] < chunk_stop
+            ):
+                start, stop = break_indicies[n_opened]
+                buyback = Buyback(
+                    identifier=None,
+                    ratios=ratios,
+                    discounts=discounts,
+                    amount_allocated=initial_allocation,
+                )
+                stream = BuybackStream(
+                    buyback=buyback,
+                    refresh_amount=refresh_amount,
+                    refresh_interval=refresh_interval,
+                    redistribute_on_refresh=redistribute_on_refresh,
+                )
+                windows.append(
+                    StreamWindow(
+                        digest=WindowDigest(run_asset1, run_asset2),
+                        start=start,
+                        stop=stop,
+                        stream=stream,
+                        statistics=RunningPriceStatistics(),
+                    )
+                )
+                n_opened += 1
+
+            finished = []
+            for window in windows:
+                rows = slice(
+                    max(window.start, chunk_start) - chunk_start,
+                    min(window.stop + 1, chunk_stop) - chunk_start,
+                )
+                window_chunk = {name: values[rows] for name, values in chunk.items()}
+                window.digest.update(window_chunk)
+                window.statistics.update(
+                    start_times=window_chunk["start_time"],
+                    opens=window_chunk["open"],
+                    closes=window_chunk["close"],
+                    highs=window_chunk["high"],
+                    lows=window_chunk["low"],
+                )
+                opens = window_chunk["open"]
+                lows = window_chunk["low"]
+                if sim_start_price is not None:
+                    if window.scale_factor is None:
+                        window.scale_factor = sim_start_price / opens[:1]
+                    opens = opens * window.scale_factor
+                    lows = lows * window.scale_factor
+                window.stream.update(
+                    start_times=window_chunk["start_time"], opens=opens, lows=lows
+                )
+                if window.stop < chunk_stop:
+                    finished.append(window)
+            windows = [window for window in windows if window.stop >= chunk_stop]
+            chunk_start = chunk_stop
+            if not finished:
+                continue
+
+            results, settings, overviews = finish_windows(
+                windows=finished,
+                settings_kwargs=dict(
+                    ratios=ratios,
+                    discounts=discounts,
+                    initial_allocations=initial_allocation,
+                    refresh_amounts=refresh_amount,
+                    refresh_intervals=refresh_interval,
+                    run_duration=run_window,
+                    asset1=run_asset1,
+                    asset2=run_asset2,
+                    redistribute_on_refresh=redistribute_on_refresh,
+                ),
+                run_kwargs=dict(
+                    ratios=ratios,
+                    discounts=discounts,
+                    initial_allocation=initial_allocation,
+                    refresh_amount=refresh_amount,
+                    refresh_interval=refresh_interval,
+                    run_window=run_window,
+                    sim_start_price=sim_start_price,
+                    redistribute_on_refresh=redistribute_on_refresh,
+                ),
+            )
+            if save_to_db:
+                # runs already stored, e.g. by an earlier stream or `simple_buyback_sim`, aren't written again
+                stored = stored_identifiers(
+                    db_path, settings["identifier"].to_pylist(), writer=writer
+                )
+                new_runs = {
+                    name: table.filter(
+                        pc.invert(
+                            pc.is_in(
+                                table["identifier"],
+                                value_set=pa.array(stored, pa.string()),
+                            )
+                        )
+                    )
+                    for name, table in [
+                        ("results", results),
+                        ("settings", settings),
+                        ("overviews", overviews),
+                    ]
+                }
+                writer.write(**new_runs)
+            yield results, settings, overviews
+
+
+def finish_windows(
+    windows: list[StreamWindow], settings_kwargs: dict, run_kwargs: dict
+) -> tuple[pa.Table, pa.Table, pa.Table]:
+    """Ends the runs of `windows`, which share a ladder, and builds their results, settings and overviews.
+    `settings_kwargs` are the arguments of `make_settings_record` shared by every window, and `run_kwargs` those of
+    `run_identifier`, which identifies each run by its settings and the digest of its window's candles.
+    """
+    identifiers = [
+        run_identifier(window_digest=window.digest.hexdigest(), **run_kwargs)
+        for window in windows
+    ]
+    histories = []
+    for window, identifier in zip(windows, identifiers):
+        history = window.stream.finish()
+        histories.append(
+            history.set_column(
+                history.schema.get_field_index("identifier"),
+                history.schema.field("identifier"),
+                pa.array([identifier] * history.num_rows, pa.string()),
+            )
+        )
+    results = pa.concat_tables(histories)
+    settings = [
+        make_settings_record(
+            **settings_kwargs,
+            identifier=identifier,
+            start_price=window.stream.run_start_price,
+        )
+        for window, identifier in zip(windows, identifiers)
+    ]
+
+    price_statistics = np.stack(
+        [
+            window.statistics.statistics(
+                scale_factor=(
+                    None if window.scale_factor is None else window.scale_factor[0]
+                )
+            )
+            for window in windows
+        ]
+    )
+    buyback = windows[0].stream.buyback
+    overviews = grouped_buyback_overview(
+        result=results,
+        ratios=buyback.ratios,
+        discounts=buyback.discounts,
+        price_statistics=pd.DataFrame(
+            price_statistics, index=identifiers, columns=PRICE_STATISTICS
+        ),
+    )
+    return (
+        results,
+        pa.Table.from_batches(settings),
+        pa.Table.from_batches([overviews]),
+    )
+
+
+if __name__ == "__main__":
+    for results, settings, overviews in stream_buyback_sim(
+        ratios=[0.4, 0.3, 0.2, 0.1],
+        discounts=[0, 23.6, 38.2, 61.8],
+        initial_allocation=100_000,
+        refresh_amount=10_000,
+        refresh_interval_days=5,
+        sim_len_days=120,
+        step_days=5,
+        redistribute_on_refresh=True,
+        sim_start_price=1,
+        chunk_size=256,
+    ):
+        print(len(settings), "windows,", results.num_rows, "buybacks")
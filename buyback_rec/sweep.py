@@ -0,0 +1,408 @@
+import numpy as np
+import pyarrow as pa
+from datetime import timedelta
+from itertools import product
+from pathlib import Path
+from buyback_sim import (
+    PRICE_STATISTICS,
+    Buyback,
+    batch_refresh_history,
+    get_breakpoints,
+    group_refresh_schedules,
+    grouped_buyback_overview,
+    history_table,
+    load_candle_pairs,
+    make_settings_record,
+    rolling_price_statistics,
+    run_identifier,
+    run_tasks,
+    stack_pair_windows,
+    window_digests,
+    window_length_groups,
+    window_start_prices,
+)
+import pandas as pd
+from dtypes import SCHEMA_BUYBACK, SCHEMA_OVERVIEW, SCHEMA_SETTINGS
+from result_store import ResultWriter, load_runs, save_results, sort_runs
+
+SWEEP_PARAMETERS = {
+    "ratios": None,
+    "discounts": None,
+    "initial_allocation": None,
+    "refresh_amount": None,
+    "refresh_interval_days": None,
+    "redistribute_on_refresh": False,
+}  # parameters of `simple_buyback_sim` that can be swept, and their defaults (None if required)
+
+
+def get_sweep_configs(param_grid: dict[str, list] | list[dict]) -> list[dict]:
+    """Expands a parameter grid into a list of configurations. A dict maps each parameter of `SWEEP_PARAMETERS` to a
+    list of values and every combination is returned, a list of dicts is taken as the configurations themselves.
+    """
+    if isinstance(param_grid, dict):
+        names = list(param_grid.keys())
+        param_grid = [
+            dict(zip(names, values))
+            for values in product(*[param_grid[name] for name in names])
+        ]
+
+    configs = []
+    for config in param_grid:
+        unknown = set(config.keys()) - set(SWEEP_PARAMETERS.keys())
+        if unknown:
+            raise ValueError(f"Unknown sweep parameters {sorted(unknown)}")
+        config = {**SWEEP_PARAMETERS, **config}
+        missing = [name for name, value in config.items() if value is None]
+        if missing:
+            raise ValueError(f"Sweep parameters {missing} must be given")
+        if len(config["ratios"]) != len(config["discounts"]):
+            raise ValueError(
+                f"`ratios` {config['ratios']} and `discounts` {config['discounts']} must be the same length"
+            )
+        configs.append(config)
+    return configs
+
+
+def simulate_sweep_pair(
+    asset_pair: pd.DataFrame,
+    break_indicies: list[tuple[int, int]],
+    configs: list[dict],
+    sim_start_price: float | None = None,
+    batch_size: int = 4096,
+    skip_runs: np.ndarray | None = None,
+) -> tuple[dict[str, list[np.ndarray]], list[np.ndarray], list[np.ndarray]]:
+    """Simulates every configuration of `configs` over the `break_indicies` windows of a single asset pair. All
+    configurations sharing a refresh interval and number of discounts are simulated together with
+    `batch_refresh_history`, up to `batch_size` runs (configuration x window) at a time, one stack of windows per
+    window length (see `window_length_groups`). The runs set in the
+    (configuration x window) mask `skip_runs` are left out.
+
+    Returns:
+        tuple[dict[str, list[np.ndarray]], list[np.ndarray], list[np.ndarray]]: SCHEMA_BUYBACK columns (without `identifier`), and the configuration and window index of each row
+    """
+    ladders = [
+        Buyback(
+            identifier=None,
+            ratios=config["ratios"],
+            discounts=config["discounts"],
+            amount_allocated=config["initial_allocation"],
+        )
+        for config in configs
+    ]
+    config_groups = {}
+    for c_idx, config in enumerate(configs):
+        key = (config["refresh_interval_days"], len(ladders[c_idx].ratios))
+        config_groups.setdefault(key, []).append(c_idx)
+
+    columns = {}
+    row_configs = []
+    row_windows = []
+    for length_group in window_length_groups(break_indicies):
+        # only equally long windows can be stacked, their positions in `break_indicies` are mapped back for each row
+        stacked, scale_factors = stack_pair_windows(
+            asset_pair=asset_pair,
+            break_indicies=[break_indicies[w_idx] for w_idx in length_group],
+            sim_start_price=sim_start_price,
+        )
+        for (interval_days, _), group_configs in config_groups.items():
+            schedules = group_refresh_schedules(
+                start_times=stacked["start_time"],
+                refresh_amounts=1.0,
+                refresh_intervals=timedelta(days=interval_days),
+            )
+            for (unit_amounts, _, start_idxs, refresh_idxs), windows in schedules:
+                chunk_len = max(1, batch_size // len(windows))
+                for chunk_start in range(0, len(group_configs), chunk_len):
+                    chunk = np.array(
+                        group_configs[chunk_start : chunk_start + chunk_len]
+                    )
+                    run_configs = np.repeat(chunk, len(windows))
+                    run_windows = np.tile(windows, len(chunk))
+                    per_run = np.repeat(np.arange(len(chunk)), len(windows))
+                    if skip_runs is not None:
+                        new_runs = ~skip_runs[run_configs, length_group[run_windows]]
+                        if not new_runs.any():
+                            continue
+                        run_configs = run_configs[new_runs]
+                        run_windows = run_windows[new_runs]
+                        per_run = per_run[new_runs]
+                    ratios = np.stack([ladders[c_idx].ratios for c_idx in chunk])
+                    discounts = np.stack([ladders[c_idx].discounts for c_idx in chunk])
+                    amounts = np.stack([ladders[c_idx].amounts for c_idx in chunk])
+                    allocated = np.array(
+                        [ladders[c_idx].amount_allocated for c_idx in chunk],
+                        dtype=np.float64,
+                    )
+                    refresh_amount = np.array(
+                        [configs[c_idx]["refresh_amount"] for c_idx in chunk],
+                        dtype=np.float64,
+                    )
+                    redistribute = np.array(
+                        [configs[c_idx]["redistribute_on_refresh"] for c_idx in chunk]
+                    )
+                    chunk_columns, chunk_run_idxs = batch_refresh_history(
+                        ratios=ratios[per_run],
+                        discounts=discounts[per_run],
+                        amounts=amounts[per_run],
+                        allocated=allocated[per_run],
+                        refresh_amounts=unit_amounts[:, np.newaxis]
+                        * refresh_amount[per_run][np.newaxis, :],
+                        redistribute_on_refresh=redistribute[per_run],
+                        start_times=stacked["start_time"],
+                        opens=stacked["open"],
+                        lows=stacked["low"],
+                        start_idxs=start_idxs,
+                        refresh_idxs=refresh_idxs,
+                        run_windows=run_windows,
+                        scale_factors=scale_factors,
+                    )
+                    for name, values in chunk_columns.items():
+                        columns.setdefault(name, []).extend(values)
+                    row_configs.extend(run_configs[r_idx] for r_idx in chunk_run_idxs)
+                    row_windows.extend(
+                        length_group[run_windows[r_idx]] for r_idx in chunk_run_idxs
+                    )
+
+    return columns, row_configs, row_windows
+
+
+def sweep_buyback_sim(
+    param_grid: dict[str, list] | list[dict],
+    sim_len_days: int,
+    step_days: float,
+    sim_start_price: float | None = None,
+    invert_pair: bool = False,
+    save_to_db: bool = False,
+    batch_size: int = 4096,
+    n_workers: int | None = None,
+    writer: ResultWriter | None = None,
+    reuse_results: bool | None = None,
+):
+    """Runs `simple_buyback_sim` for every configuration of `param_grid` (see `get_sweep_configs`). The candles are
+    loaded and split into windows once, and all configurations sharing a refresh interval and number of discounts are
+    simulated together with `batch_refresh_history`, up to `batch_size` runs (configuration x window) at a time.
+    With `n_workers` the asset pairs are spread across a process pool (see `run_tasks`). With `save_to_db` the
+    outputs are buffered by `writer` if given, so that successive sweeps share files (see `ResultWriter`). With
+    `reuse_results` the runs already stored (see `run_identifier`) are read from the database instead of simulated,
+    which by default is only done with `save_to_db`.
+
+    Returns:
+        tuple[pa.Table, pa.Table, pa.Table]: results, settings and overviews of every run, ordered by configuration,
+        asset pair and window. Each run is keyed by its `identifier` and its configuration is its settings row.
+    """
+    if reuse_results is None:
+        reuse_results = save_to_db
+    run_window = timedelta(days=sim_len_days)
+    step_size = timedelta(days=step_days)
+    db_path = Path.cwd() / "buyback_rec/database"
+    candles_path = db_path / "candlestick_data"
+
+    configs = get_sweep_configs(param_grid)
+    ladders = [
+        Buyback(
+            identifier=None,
+            ratios=config["ratios"],
+            discounts=config["discounts"],
+            amount_allocated=config["initial_allocation"],
+        )
+        for config in configs
+    ]
+
+    pairs = []
+    pair_windows = []
+    digests = []
+    for asset_pair in load_candle_pairs(
+        candles_path=candles_path, invert_pair=invert_pair
+    ):
+        break_indicies = get_breakpoints(
+            timestamps=asset_pair.start_time,
+            window_time=run_window,
+            step_time=step_size,
+        )
+        pairs.append(
+            (
+                asset_pair["asset1"].iloc[0],
+                asset_pair["asset2"].iloc[0],
+                window_start_prices(asset_pair, break_indicies, sim_start_price),
+            )
+        )
+        pair_windows.append((asset_pair, break_indicies))
+        digests.extend(window_digests(asset_pair, break_indicies))
+
+    # runs are numbered by configuration, then asset pair, then window
+    n_pair_windows = np.array([len(start_prices) for _, _, start_prices in pairs])
+    pair_offsets = np.concatenate([[0], np.cumsum(n_pair_windows)])
+    n_windows = pair_offsets[-1]
+    identifiers = [
+        run_identifier(
+            window_digest=digest,
+            ratios=config["ratios"],
+            discounts=config["discounts"],
+            initial_allocation=config["initial_allocation"],
+            refresh_amount=config["refresh_amount"],
+            refresh_interval=timedelta(days=config["refresh_interval_days"]),
+            run_window=run_window,
+            sim_start_price=sim_start_price,
+            redistribute_on_refresh=config["redistribute_on_refresh"],
+        )
+        for config in configs
+        for digest in digests
+    ]
+    stored_results = SCHEMA_BUYBACK.empty_table()
+    stored_settings = SCHEMA_SETTINGS.empty_table()
+    stored_overviews = SCHEMA_OVERVIEW.empty_table()
+    if reuse_results:
+        stored_results, stored_settings, stored_overviews = load_runs(
+            db_path=db_path, identifiers=identifiers, writer=writer
+        )
+    stored = set(stored_settings["identifier"].to_pylist())
+    stored_runs = np.array(
+        [identifier in stored for identifier in identifiers], dtype=bool
+    ).reshape(len(configs), n_windows)
+
+    new_pairs = [
+        p_idx
+        for p_idx in range(len(pair_windows))
+        if not stored_runs[:, pair_offsets[p_idx] : pair_offsets[p_idx + 1]].all()
+    ]
+    tasks = [
+        (
+            simulate_sweep_pair,
+            dict(
+                asset_pair=asset_pair,
+                break_indicies=break_indicies,
+                configs=configs,
+                sim_start_price=sim_start_price,
+                batch_size=batch_size,
+                skip_runs=stored_runs[:, pair_offsets[p_idx] : pair_offsets[p_idx + 1]],
+            ),
+        )
+        for p_idx in new_pairs
+        for asset_pair, break_indicies in [pair_windows[p_idx]]
+    ]
+    columns = {}
+    run_idxs = []
+    for p_idx, (pair_columns, row_configs, row_windows) in zip(
+        new_pairs, run_tasks(tasks, n_workers=n_workers)
+    ):
+        for name, values in pair_columns.items():
+            columns.setdefault(name, []).extend(values)
+        run_idxs.extend(
+            c_idxs * n_windows + pair_offsets[p_idx] + w_idxs
+            for c_idxs, w_idxs in zip(row_configs, row_windows)
+        )
+
+    results = history_table(columns=columns, run_idxs=run_idxs, identifiers=identifiers)
+    sorted_runs = np.sort(np.concatenate(run_idxs)) if run_idxs else np.array([])
+    config_bounds = np.searchsorted(
+        sorted_runs, np.arange(len(configs) + 1) * n_windows
+    )
+
+    # the windows are shared by every configuration, so their statistics are only computed once
+    window_statistics = np.concatenate(
+        [
+            rolling_price_statistics(
+                asset_pair=asset_pair,
+                break_indicies=break_indicies,
+                sim_start_price=sim_start_price,
+            )
+            for asset_pair, break_indicies in pair_windows
+        ]
+    )
+    window_asset1 = []
+    window_asset2 = []
+    for asset1, asset2, pair_start_prices in pairs:
+        window_asset1.extend([asset1] * len(pair_start_prices))
+        window_asset2.extend([asset2] * len(pair_start_prices))
+    start_prices = np.concatenate(
+        [pair_start_prices for _, _, pair_start_prices in pairs]
+    )
+
+    settings = []
+    overviews = []
+    for c_idx, config in enumerate(configs):
+        if stored_runs[c_idx].all():
+            continue
+        config_identifiers = identifiers[c_idx * n_windows : (c_idx + 1) * n_windows]
+        config_settings = make_settings_record(
+            ratios=config["ratios"],
+            discounts=config["discounts"],
+            initial_allocations=config["initial_allocation"],
+            refresh_amounts=config["refresh_amount"],
+            refresh_intervals=timedelta(days=config["refresh_interval_days"]),
+            run_duration=run_window,
+            asset1=window_asset1[0],
+            asset2=window_asset2[0],
+            redistribute_on_refresh=config["redistribute_on_refresh"],
+            start_price=start_prices[0],
+        ).take(np.zeros(n_windows, dtype=np.int64))
+        for name, values in [
+            ("identifier", config_identifiers),
+            ("asset1", window_asset1),
+            ("asset2", window_asset2),
+            ("start_price", start_prices),
+        ]:
+            field_idx = SCHEMA_SETTINGS.get_field_index(name)
+            config_settings = config_settings.set_column(
+                field_idx,
+                SCHEMA_SETTINGS.field(name),
+                pa.array(values, type=SCHEMA_SETTINGS.field(name).type),
+            )
+        settings.append(config_settings.filter(pa.array(~stored_runs[c_idx])))
+        overviews.append(
+            grouped_buyback_overview(
+                result=results.slice(
+                    config_bounds[c_idx],
+                    config_bounds[c_idx + 1] - config_bounds[c_idx],
+                ),
+                ratios=ladders[c_idx].ratios,
+                discounts=ladders[c_idx].discounts,
+                price_statistics=pd.DataFrame(
+                    window_statistics,
+                    index=config_identifiers,
+                    columns=PRICE_STATISTICS,
+                ),
+            )
+        )
+
+    settings = pa.Table.from_batches(settings, schema=SCHEMA_SETTINGS)
+    overviews = pa.Table.from_batches(overviews, schema=SCHEMA_OVERVIEW)
+
+    if save_to_db:
+        save_results(
+            db_path=db_path,
+            results=results,
+            settings=settings,
+            overviews=overviews,
+            writer=writer,
+        )
+
+    if stored:
+        results, settings, overviews = [
+            sort_runs(pa.concat_tables([new, old]), identifiers)
+            for new, old in [
+                (results, stored_results),
+                (settings, stored_settings),
+                (overviews, stored_overviews),
+            ]
+        ]
+
+    return results, settings, overviews
+
+
+if __name__ == "__main__":
+    results, settings, overviews = sweep_buyback_sim(
+        param_grid={
+            "ratios": [[0.4, 0.3, 0.2, 0.1], [0.25, 0.25, 0.25, 0.25]],
+            "discounts": [[0, 23.6, 38.2, 61.8], [0, 10, 20, 30]],
+            "initial_allocation": [100_000],
+            "refresh_amount": [10_000],
+            "refresh_interval_days": [5, 10],
+            "redistribute_on_refresh": [True, False],
+        },
+        sim_len_days=120,
+        step_days=5,
+        sim_start_price=1,
+    )
+
+    print(settings.to_pandas())
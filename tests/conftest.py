@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the modules of buyback_rec import each other by name, as when run as scripts
+sys.path.insert(0, str(Path(__file__).parents[1] / "buyback_rec"))
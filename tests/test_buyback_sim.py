@@ -0,0 +1,291 @@
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pytest
+
+from buyback_sim import (
+    Buyback,
+    batch_simulate_buybacks,
+    batch_simulate_pair,
+    candle_arrays,
+    decode_metadata,
+    get_breakpoints,
+    get_price_statistics,
+    iter_tasks,
+    pair_window,
+    rolling_price_statistics,
+    run_tasks,
+    simple_buyback_sim,
+    simulate_window,
+    window_start_prices,
+)
+from candle_store import write_candles
+from dtypes import SCHEMA_CANDLE
+from instrumentation import Instrumentation
+
+LADDER = dict(
+    ratios=[0.4, 0.3, 0.2, 0.1],
+    discounts=[0, 5, 10, 20],
+    initial_allocation=1000,
+    refresh_amount=100,
+    redistribute_on_refresh=True,
+)
+
+
+def pair_candles(
+    asset1: str, asset2: str, n_days: int, seed: int, gap: bool = True
+) -> pd.DataFrame:
+    """Daily candles of a random walk, with a gap of a few days (if `gap`) so that windows differ in length."""
+    rng = np.random.default_rng(seed)
+    prices = 100 * np.exp(np.cumsum(rng.normal(0, 0.03, n_days)))
+    swings = np.abs(rng.normal(0, 0.02, n_days))
+    candles = pd.DataFrame(
+        {
+            "asset1": asset1,
+            "asset2": asset2,
+            "start_time": pd.date_range("2021-01-01", periods=n_days, freq="D"),
+            "low": prices * (1 - swings),
+            "high": prices * (1 + swings),
+            "open": prices,
+            "close": np.roll(prices, -1),
+            "volume": 10.0,
+        }
+    )
+    if gap:
+        candles = candles.drop(index=range(40, 44)).reset_index(drop=True)
+    return candles
+
+
+@pytest.fixture
+def candle_db(tmp_path, monkeypatch):
+    """A database of two asset pairs in a fresh working directory, where `simple_buyback_sim` looks for it."""
+    monkeypatch.chdir(tmp_path)
+    candles = pd.concat(
+        [
+            pair_candles("BTC", "USD", 200, seed=0),
+            pair_candles("ETH", "USD", 160, seed=1),
+        ]
+    )
+    write_candles(
+        pa.Table.from_pandas(candles, schema=SCHEMA_CANDLE, preserve_index=False),
+        tmp_path / "buyback_rec/database/candlestick_data",
+    )
+    return tmp_path
+
+
+@pytest.mark.parametrize("batched", [False, True])
+def test_parallel_runs_match_serial_runs(candle_db, batched):
+    sim_kwargs = dict(
+        LADDER,
+        refresh_interval_days=5,
+        sim_len_days=60,
+        step_days=5,
+        sim_start_price=1,
+        batched=batched,
+    )
+    serial = simple_buyback_sim(**sim_kwargs)
+    parallel = simple_buyback_sim(**sim_kwargs, n_workers=2)
+
+    assert serial[1].num_rows > 40
+    for serial_table, parallel_table in zip(serial, parallel):
+        assert parallel_table.equals(serial_table)
+
+
+def test_iter_tasks_match_run_tasks():
+    asset_pair = pair_candles("BTC", "USD", 200, seed=0)
+    candles = candle_arrays(asset_pair, columns=list(asset_pair.columns))
+    break_indicies = get_breakpoints(
+        asset_pair.start_time, timedelta(days=60), timedelta(days=5)
+    )
+    tasks = [
+        (
+            simulate_window,
+            dict(
+                LADDER,
+                window_data=pair_window(candles, start, stop),
+                identifier=f"run-{w_idx}",
+                refresh_interval=timedelta(days=5),
+                run_window=timedelta(days=60),
+            ),
+        )
+        for w_idx, (start, stop) in enumerate(break_indicies)
+    ]
+    serial = run_tasks(tasks)
+
+    for outputs in [run_tasks(tasks, n_workers=2), iter_tasks(tasks, n_workers=2)]:
+        outputs = list(outputs)
+        assert len(outputs) == len(serial)
+        for (results, settings, overviews), expected in zip(outputs, serial):
+            assert results.equals(expected[0])
+            assert pa.Table.from_batches(settings).equals(
+                pa.Table.from_batches(expected[1])
+            )
+            assert pa.Table.from_batches(overviews).equals(
+                pa.Table.from_batches(expected[2])
+            )
+
+
+def test_final_period_without_refresh_is_not_counted():
+    candles = pair_candles("BTC", "USD", 30, seed=2, gap=False)
+    # the refreshes end at day 10, the candles after it are a final period ending with the data
+    refresh_intervals = np.array([5, 10], dtype="timedelta64[D]")
+    falling = candles.index >= 20
+    candles.loc[falling, "low"] = candles["low"][falling] * 0.5
+    instrumentation = Instrumentation()
+    buyback = Buyback(
+        identifier="run",
+        ratios=LADDER["ratios"],
+        discounts=LADDER["discounts"],
+        amount_allocated=LADDER["initial_allocation"],
+        instrumentation=instrumentation,
+    )
+    results = buyback.simulate_buybacks(
+        candles, refresh_amounts=100.0, refresh_intervals=refresh_intervals
+    )
+
+    n_accounts = len(LADDER["ratios"])
+    assert buyback.n_refresh == 2 * n_accounts
+    assert (buyback.n_discount_refresh == 2).all()
+    assert instrumentation.report()["counters"]["refreshes"] == 2
+    assert len(decode_metadata(results.schema.metadata)["refresh_amounts"]) == 2
+    # the orders filled in the final period only saw the two refreshes
+    in_tail = results.filter(
+        pc.greater_equal(results["trigger_time"], candles["start_time"][20])
+    )
+    assert in_tail.num_rows
+    assert set(in_tail["num_refresh"].to_pylist()) == {2 * n_accounts}
+    assert set(in_tail["num_discount_refresh"].to_pylist()) == {2}
+
+    stacked = candle_arrays(candles, columns=["start_time", "open", "low"])
+    batched = batch_simulate_buybacks(
+        identifiers=["run"],
+        ratios=LADDER["ratios"],
+        discounts=LADDER["discounts"],
+        amount_allocated=LADDER["initial_allocation"],
+        start_times=stacked["start_time"][np.newaxis],
+        opens=stacked["open"][np.newaxis],
+        lows=stacked["low"][np.newaxis],
+        refresh_amounts=100.0,
+        refresh_intervals=refresh_intervals,
+    )
+    assert batched.equals(results)
+
+
+def test_overview_of_repeated_discounts():
+    asset_pair = pair_candles("BTC", "USD", 200, seed=0)
+    window_kwargs = dict(
+        identifier="run",
+        initial_allocation=1000,
+        refresh_amount=100,
+        refresh_interval=timedelta(days=5),
+        run_window=timedelta(days=200),
+    )
+    _, _, [single] = simulate_window(
+        asset_pair, ratios=[1.0], discounts=[10], **window_kwargs
+    )
+    fill_columns = [
+        "delay_min",
+        "delay_max",
+        "delay_mean",
+        "end_num_discount_buybacks",
+        "end_num_discount_refresh",
+        "end_discount_running_return",
+    ]
+    single = single.select(fill_columns).to_pylist()[0]
+    assert single["end_num_discount_buybacks"]
+
+    # accounts sharing a ratio and a discount fill together, each gets the fills of a single account
+    for ratios, discounts, twins in [
+        ([0.5, 0.5], [10, 10], [0, 1]),
+        ([0.3, 0.4, 0.3], [10, 20, 10], [0, 2]),
+    ]:
+        _, _, [overview] = simulate_window(
+            asset_pair, ratios=ratios, discounts=discounts, **window_kwargs
+        )
+        assert overview["discount"].to_pylist() == discounts
+        rows = overview.select(fill_columns).to_pylist()
+        assert [rows[a_idx] for a_idx in twins] == [pytest.approx(single, rel=1e-6)] * 2
+
+        break_indicies = get_breakpoints(
+            asset_pair.start_time, timedelta(days=60), timedelta(days=5)
+        )
+        identifiers = [f"run-{w_idx}" for w_idx in range(len(break_indicies))]
+        sim_kwargs = dict(
+            ratios=ratios,
+            discounts=discounts,
+            initial_allocation=1000,
+            refresh_amount=100,
+            refresh_interval=timedelta(days=5),
+            run_window=timedelta(days=60),
+        )
+        _, _, [batched] = batch_simulate_pair(
+            asset_pair, break_indicies, identifiers=identifiers, **sim_kwargs
+        )
+        candles = candle_arrays(asset_pair, columns=list(asset_pair.columns))
+        per_window = [
+            simulate_window(pair_window(candles, start, stop), identifier, **sim_kwargs)
+            for (start, stop), identifier in zip(break_indicies, identifiers)
+        ]
+        per_window = pa.Table.from_batches(
+            [batch for _, _, overviews in per_window for batch in overviews]
+        )
+        assert batched.num_rows
+        assert (
+            pa.Table.from_batches([batched])
+            .select(fill_columns)
+            .equals(per_window.select(fill_columns))
+        )
+
+
+@pytest.mark.parametrize("sim_start_price", [None, 1.0])
+def test_rolling_price_statistics_match_get_price_statistics(sim_start_price):
+    asset_pair = pair_candles("BTC", "USD", 200, seed=0)
+    break_indicies = get_breakpoints(
+        asset_pair.start_time, timedelta(days=60), timedelta(days=5)
+    )
+    rolling = rolling_price_statistics(asset_pair, break_indicies, sim_start_price)
+
+    candles = candle_arrays(asset_pair, columns=list(asset_pair.columns))
+    for (start, stop), statistics in zip(break_indicies, rolling):
+        window = pair_window(candles, start, stop)
+        scale_factor = None
+        if sim_start_price is not None:
+            scale_factor = sim_start_price / window["open"][0]
+        expected = get_price_statistics(window, scale_factor=scale_factor)
+        np.testing.assert_allclose(statistics, expected, rtol=1e-6, atol=1e-9)
+
+
+def test_price_slope_of_a_linear_trend():
+    days = np.arange(30)
+    prices = 100 + 2 * days  # rising by 2 a day
+    candles = pd.DataFrame(
+        {
+            "start_time": pd.date_range("2021-01-01", periods=len(days), freq="D"),
+            "open": prices,
+            "close": prices + 1.0,
+            "high": prices + 3.0,
+            "low": prices - 3.0,
+        }
+    )
+    # each price is regressed against the time of its own candle
+    _, price_slope, price_slope_ppd, *_ = get_price_statistics(candles)
+    assert price_slope == pytest.approx(2)
+    assert price_slope_ppd == pytest.approx(2)  # % of the first open a day
+
+    [rolling] = rolling_price_statistics(candles, [(0, len(days) - 1)])
+    assert rolling[1:3] == pytest.approx([2, 2])
+
+
+def test_window_start_prices():
+    asset_pair = pair_candles("BTC", "USD", 30, seed=0, gap=False)
+    asset_pair.loc[10, "open"] = 0.0
+    break_indicies = [(0, 9), (5, 14), (10, 19)]
+
+    start_prices = window_start_prices(asset_pair, break_indicies)
+    assert start_prices.tolist() == asset_pair["open"][[0, 5, 10]].tolist()
+    # rescaled windows open at `sim_start_price`, whatever their own open
+    start_prices = window_start_prices(asset_pair, break_indicies, sim_start_price=1)
+    assert start_prices.tolist() == [1.0, 1.0, 1.0]
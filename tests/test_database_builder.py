@@ -0,0 +1,215 @@
+import datetime
+import http.client
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pyarrow.dataset as ds
+import pytest
+
+import database_builder
+from candle_store import open_candles
+from database_builder import TokenBucket, fetch_pairs, update_candles
+
+HOURLY = 3600
+
+
+def utc_now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def page_candles(url: str, now: datetime.datetime) -> list[list]:
+    """Candles the exchange returns for a request: newest first, and only those that have started by `now`."""
+    query = parse_qs(urlparse(url).query)
+    start = datetime.datetime.fromisoformat(query["start"][0])
+    stop = min(datetime.datetime.fromisoformat(query["end"][0]), now)
+    granularity = int(query["granularity"][0])
+    epoch = datetime.datetime(1970, 1, 1)
+    first = -(-int((start - epoch).total_seconds()) // granularity) * granularity
+    last = int((stop - epoch).total_seconds())
+    return [
+        [start_time, 1.0, 2.0, 1.5, 1.5, 10.0]
+        for start_time in range(first, last + 1, granularity)
+    ][::-1]
+
+
+class FakeResponse:
+    status = 200
+    reason = "OK"
+
+    def __init__(self, body: bytes):
+        self.body = body
+
+    def read(self) -> bytes:
+        return self.body
+
+
+class FakeCandlesConnection:
+    """Answers candle requests like the exchange does: newest first, and only candles that have started by now."""
+
+    def request(self, method, url, payload, headers):
+        self.candles = page_candles(url, utc_now())
+
+    def getresponse(self) -> FakeResponse:
+        return FakeResponse(json.dumps(self.candles).encode())
+
+    def close(self):
+        pass
+
+
+@pytest.fixture(params=["JST-9", "EST+5"])
+def local_timezone(request, monkeypatch):
+    """Runs the test on a host east or west of UTC."""
+    monkeypatch.setenv("TZ", request.param)
+    time.tzset()
+    yield request.param
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_update_candles_stops_at_last_closed_utc_candle(local_timezone, tmp_path):
+    step = datetime.timedelta(seconds=HOURLY)
+    before = utc_now()
+    n_added = update_candles(
+        conn=FakeCandlesConnection(),
+        token="BTC",
+        token2="USD",
+        candles_path=tmp_path,
+        granularity=HOURLY,
+        start_date=before.replace(minute=0, second=0, microsecond=0) - 12 * step,
+    )
+    after = utc_now()
+
+    start_times = ds.dataset(tmp_path, partitioning="hive").to_table()["start_time"]
+    last = max(start_times.to_pylist()).replace(tzinfo=None)
+    # the still open candle is never stored, and every closed one is
+    last_closed = {
+        now.replace(minute=0, second=0, microsecond=0) - step for now in [before, after]
+    }
+    assert last in last_closed
+    assert n_added in {12, 13}
+
+
+def test_update_candles_writes_each_year_partition_once(tmp_path):
+    bucket = TokenBucket(rate=1e6)
+    n_added = update_candles(
+        conn=FakeCandlesConnection(),
+        token="BTC",
+        token2="USD",
+        candles_path=tmp_path,
+        granularity=HOURLY,
+        start_date=datetime.datetime(2023, 12, 1),
+        end_date=datetime.datetime(2024, 1, 31, 23),
+        bucket=bucket,
+    )
+    # a page per 300 hours, one of them spanning both years
+    assert n_added == 62 * 24
+    files = {
+        year: list(tmp_path.glob(f"pair=BTC-USD/granularity={HOURLY}/year={year}/*"))
+        for year in [2023, 2024]
+    }
+    assert [len(year_files) for year_files in files.values()] == [1, 1]
+
+    n_added += update_candles(
+        conn=FakeCandlesConnection(),
+        token="BTC",
+        token2="USD",
+        candles_path=tmp_path,
+        granularity=HOURLY,
+        end_date=datetime.datetime(2024, 3, 31, 23),
+        bucket=bucket,
+    )
+    assert len(list(tmp_path.glob("pair=BTC-USD/*/year=2024/*"))) == 2
+    start_times = ds.dataset(tmp_path, partitioning="hive").to_table()["start_time"]
+    assert len(start_times) == len(set(start_times.to_pylist())) == n_added
+    assert n_added == (31 + 31 + 29 + 31) * 24
+
+
+class FlakyCandlesHandler(BaseHTTPRequestHandler):
+    """Answers each distinct candles request with a 429, then a 502, and only then with its candles, recording the
+    time of every attempt."""
+
+    protocol_version = "HTTP/1.1"
+    failures = [429, 502]
+
+    def do_GET(self):
+        with self.server.lock:
+            attempts = self.server.attempts.setdefault(self.path, [])
+            attempts.append(time.monotonic())
+            n_attempts = len(attempts)
+        if n_attempts <= len(self.failures):
+            self.send_response(self.failures[n_attempts - 1])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = json.dumps(page_candles(self.path, utc_now())).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def candles_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyCandlesHandler)
+    server.lock = threading.Lock()
+    server.attempts = {}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_pairs_retries_under_the_rate_limit(
+    candles_server, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(database_builder, "backoff_time", 0.02)
+    rate = 20
+    pairs = [("BTC", "USD"), ("ETH", "USD"), ("ETH", "BTC")]
+    n_added = fetch_pairs(
+        pairs=pairs,
+        granularities=[86400, HOURLY],
+        conn_factory=lambda: http.client.HTTPConnection(
+            "127.0.0.1", candles_server.server_port
+        ),
+        rate=rate,
+        n_workers=6,
+        candles_path=tmp_path,
+        start_date=datetime.datetime(2021, 1, 1),
+        end_date=datetime.datetime(2021, 2, 28, 23),
+    )
+
+    # every page was retried after a 429 and a 502, each time after a longer backoff
+    attempts = candles_server.attempts
+    assert len(attempts) == len(pairs) * (1 + 5)  # a daily page and 5 hourly ones
+    for times in attempts.values():
+        assert len(times) == 3
+        waits = [later - earlier for earlier, later in zip(times, times[1:])]
+        assert waits[0] >= 0.02 and waits[1] >= 0.04
+
+    # no more requests than the bucket allows: a full bucket of `rate` tokens, then `rate` a second
+    times = sorted(t for pair_times in attempts.values() for t in pair_times)
+    for first in range(len(times)):
+        for last in range(first, len(times)):
+            allowed = rate + rate * (times[last] - times[first])
+            assert last - first + 1 <= allowed + 1
+
+    # every candle is stored exactly once
+    expected = {"daily": 59, "hourly": 59 * 24}
+    assert n_added == {
+        (token, token2, granularity): expected[
+            "daily" if granularity == 86400 else "hourly"
+        ]
+        for token, token2 in pairs
+        for granularity in [86400, HOURLY]
+    }
+    candles = open_candles(tmp_path).to_table().to_pandas()
+    keys = candles[["pair", "granularity", "start_time"]]
+    assert not keys.duplicated().any()
+    assert len(candles) == sum(n_added.values())
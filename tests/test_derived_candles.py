@@ -0,0 +1,49 @@
+import datetime
+
+import pyarrow as pa
+
+from candle_store import DAILY, write_candles
+from derived_candles import derived_candles
+from dtypes import SCHEMA_CANDLE
+
+
+def daily_candles(asset1: str, asset2: str, n_candles: int) -> pa.Table:
+    start = datetime.datetime(2021, 1, 1)
+    return pa.table(
+        {
+            "asset1": [asset1] * n_candles,
+            "asset2": [asset2] * n_candles,
+            "start_time": [
+                start + datetime.timedelta(days=d_idx) for d_idx in range(n_candles)
+            ],
+            "low": [1.0] * n_candles,
+            "high": [2.0] * n_candles,
+            "open": [1.5] * n_candles,
+            "close": [1.5] * n_candles,
+            "volume": [10.0] * n_candles,
+        },
+        schema=SCHEMA_CANDLE,
+    )
+
+
+def test_derived_candles_removes_only_older_versions(tmp_path):
+    candles_path = tmp_path / "candlestick_data"
+    cache_path = tmp_path / "derived_candles"
+    write_candles(daily_candles("BTC", "USD", 10), candles_path, DAILY)
+    cache_path.mkdir()
+    stale = cache_path / f"USD-BTC_{DAILY}_{'0' * 16}.parquet"
+    kept = [
+        # same length as a cached version, but not one
+        cache_path / f"USD-BTC_{DAILY}_backup-of-ver-01.parquet",
+        # a cross sharing the prefix of the pair
+        cache_path / f"USD-BTC_{DAILY}_via-ETH_{'0' * 16}.parquet",
+    ]
+    for path in [stale, *kept]:
+        path.write_bytes(b"")
+
+    table = derived_candles(candles_path, "USD", "BTC", DAILY, cache_path=cache_path)
+
+    assert table.num_rows == 10
+    assert not stale.exists()
+    assert all(path.exists() for path in kept)
+    assert len(list(cache_path.glob("*.parquet"))) == len(kept) + 1
@@ -0,0 +1,77 @@
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pytest
+
+from buyback_sim import batch_simulate_pair, get_breakpoints
+from result_store import RESULT_DATASETS, BackgroundWriter, ResultWriter
+
+
+def window_outputs(n_days: int = 150) -> list[tuple[pa.Table, pa.Table, pa.Table]]:
+    """Simulates 30-day windows of a falling, oscillating price and splits the outputs by window."""
+    days = np.arange(n_days)
+    prices = 100 * np.exp(-days / 200) * (1 + 0.2 * np.sin(days / 3))
+    asset_pair = pd.DataFrame(
+        {
+            "asset1": "SYN",
+            "asset2": "USD",
+            "start_time": pd.date_range("2021-01-01", periods=n_days, freq="D"),
+            "low": prices * 0.95,
+            "high": prices * 1.05,
+            "open": prices,
+            "close": prices,
+        }
+    )
+    break_indicies = get_breakpoints(
+        asset_pair.start_time, timedelta(days=30), timedelta(days=5)
+    )
+    results, settings, overviews = batch_simulate_pair(
+        asset_pair=asset_pair,
+        break_indicies=break_indicies,
+        ratios=[0.5, 0.3, 0.2],
+        discounts=[0, 10, 20],
+        initial_allocation=1000,
+        refresh_amount=100,
+        refresh_interval=timedelta(days=5),
+        run_window=timedelta(days=30),
+    )
+    overviews = pa.Table.from_batches(overviews)
+    outputs = []
+    for record in settings:
+        in_run = lambda table: table.filter(
+            pc.equal(table["identifier"], record["identifier"][0])
+        )
+        outputs.append(
+            (in_run(results), pa.Table.from_batches([record]), in_run(overviews))
+        )
+    return outputs
+
+
+def stored_runs(db_path, name: str) -> set[str]:
+    path = db_path / RESULT_DATASETS[name]
+    if not path.exists():
+        return set()
+    identifiers = ds.dataset(path).to_table(columns=["identifier"])["identifier"]
+    return set(identifiers.cast(pa.string()).to_pylist())
+
+
+@pytest.mark.parametrize("writer_class", [ResultWriter, BackgroundWriter])
+@pytest.mark.parametrize("file_bytes", [1, 2_000, 20_000])
+def test_settings_never_stored_without_their_records(
+    tmp_path, writer_class, file_bytes
+):
+    outputs = window_outputs()
+    with writer_class(tmp_path, file_bytes=file_bytes) as writer:
+        for results, settings, overviews in outputs:
+            assert results.num_rows and overviews.num_rows
+            writer.write(results=results, settings=settings, overviews=overviews)
+            if isinstance(writer, BackgroundWriter):
+                writer.wait()
+            stored = stored_runs(tmp_path, "settings")
+            assert stored <= stored_runs(tmp_path, "results")
+            assert stored <= stored_runs(tmp_path, "overviews")
+    assert len(stored_runs(tmp_path, "settings")) == len(outputs)
@@ -0,0 +1,135 @@
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from buyback_sim import Buyback
+from candle_store import candle_filter, load_candles, open_candles, write_candles
+from dtypes import SCHEMA_CANDLE
+from streaming import replay_online
+
+# columns of a fill that don't depend on the order the fills of a refresh period are recorded in
+FILL_COLUMNS = [
+    "identifier",
+    "start_time",
+    "last_reset_time",
+    "trigger_time",
+    "amount",
+    "price",
+    "purchased",
+    "ref_price",
+    "ratio",
+    "discount",
+    "start_price",
+    "running_allocated",
+    "num_discount_buybacks",
+    "num_discount_refresh",
+    "num_refresh",
+]
+
+
+@pytest.fixture
+def candles_path(tmp_path):
+    """A store holding 300 daily candles of a random walk."""
+    rng = np.random.default_rng(3)
+    n_days = 300
+    prices = 100 * np.exp(np.cumsum(rng.normal(0, 0.03, n_days)))
+    swings = np.abs(rng.normal(0, 0.04, n_days))
+    candles = pd.DataFrame(
+        {
+            "asset1": "BTC",
+            "asset2": "USD",
+            "start_time": pd.date_range("2021-01-01", periods=n_days, freq="D"),
+            "low": prices * (1 - swings),
+            "high": prices * (1 + swings),
+            "open": prices,
+            "close": np.roll(prices, -1),
+            "volume": 10.0,
+        }
+    )
+    write_candles(
+        pa.Table.from_pandas(candles, schema=SCHEMA_CANDLE, preserve_index=False),
+        tmp_path,
+    )
+    return tmp_path
+
+
+def replay_and_simulate(
+    candles_path, discounts: list[float], chunk_size: int
+) -> tuple[pa.Table, pa.Table]:
+    """Replays the stored candles through `replay_online` and simulates them with `Buyback.simulate_buybacks`."""
+    ladder = dict(
+        identifier="run",
+        ratios=[0.4, 0.3, 0.2, 0.1],
+        discounts=discounts,
+        amount_allocated=1000,
+    )
+    refresh = dict(
+        refresh_amount=100,
+        refresh_interval=timedelta(days=7),
+        redistribute_on_refresh=True,
+    )
+    online = replay_online(
+        candles=open_candles(candles_path),
+        in_pair=candle_filter(asset1="BTC", asset2="USD"),
+        buyback=Buyback(**ladder),
+        chunk_size=chunk_size,
+        **refresh,
+    )
+    batch = Buyback(**ladder).simulate_buybacks(
+        load_candles(candles_path, "BTC", "USD"),
+        refresh_amounts=refresh["refresh_amount"],
+        refresh_intervals=refresh["refresh_interval"],
+        redistribute_on_refresh=refresh["redistribute_on_refresh"],
+    )
+    return online, batch
+
+
+@pytest.mark.parametrize("chunk_size", [7, 65_536])
+def test_replay_matches_batch_with_increasing_discounts(candles_path, chunk_size):
+    online, batch = replay_and_simulate(candles_path, [0, 5, 10, 20], chunk_size)
+
+    assert batch.num_rows > 20
+    assert online.equals(batch)
+
+
+def test_replay_orders_fills_by_trigger_time(candles_path):
+    discounts = [20, 0, 10, 5]
+    online, batch = replay_and_simulate(candles_path, discounts, chunk_size=7)
+
+    # the same fills are made, only the order they are recorded in within a refresh period differs
+    account = lambda table: pa.array(
+        [discounts.index(discount) for discount in table["discount"].to_pylist()]
+    )
+    online = online.append_column("account", account(online))
+    batch = batch.append_column("account", account(batch))
+    in_trigger_order = batch.sort_by(
+        [
+            ("last_reset_time", "ascending"),
+            ("trigger_time", "ascending"),
+            ("account", "ascending"),
+        ]
+    )
+    assert online.select(FILL_COLUMNS).equals(in_trigger_order.select(FILL_COLUMNS))
+    assert not online.select(FILL_COLUMNS).equals(batch.select(FILL_COLUMNS))
+    # the batch records each period's fills in ladder order, the replay as the candles trade through them
+    assert batch.equals(
+        batch.sort_by([("last_reset_time", "ascending"), ("account", "ascending")])
+    )
+
+    # the running columns follow the order the fills are recorded in, and end at the same totals
+    for table in [online, batch]:
+        np.testing.assert_allclose(
+            table["running_spent"].to_numpy(),
+            np.cumsum(table["amount"].to_numpy().astype(np.float64)),
+            rtol=1e-6,
+        )
+        assert table["num_buybacks"].to_pylist() == list(range(1, table.num_rows + 1))
+    assert online["running_spent"][-1].as_py() == pytest.approx(
+        batch["running_spent"][-1].as_py()
+    )
+    assert online["running_purchased"][-1].as_py() == pytest.approx(
+        batch["running_purchased"][-1].as_py()
+    )